@@ -0,0 +1,22 @@
+import os
+
+# connections per ML API process; requests beyond `POSTGRES_POOL_MAX_SIZE` wait for one to be returned
+POSTGRES_POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN_SIZE", "1"))
+POSTGRES_POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX_SIZE", "16"))
+
+# write-behind ingestion: a flush runs once `INGEST_FLUSH_SIZE` events are buffered, or every
+# `INGEST_FLUSH_INTERVAL` seconds; past `INGEST_MAX_BUFFERED` (e.g. while Postgres is down) events are refused
+INGEST_FLUSH_SIZE = int(os.getenv("INGEST_FLUSH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", "1"))
+INGEST_MAX_BUFFERED = int(os.getenv("INGEST_MAX_BUFFERED", "100000"))
+# flushes a visited URL waits for its search query to be written, which another process may still buffer
+INGEST_MAX_ATTEMPTS = 10
+# search query ids reserved from the sequence per round trip
+INGEST_ID_BLOCK_SIZE = 100
+# search query ids a client may reserve per request, to log its search queries under later
+RESERVE_MAX_IDS = 1000
+
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_PAGE_SIZE = 1000
+# rows the export pulls from its server-side cursor per round trip
+EXPORT_FETCH_SIZE = 500
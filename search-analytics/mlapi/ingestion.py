@@ -0,0 +1,163 @@
+import atexit
+import logging
+import threading
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+import psycopg2
+
+from .constants import (
+    INGEST_FLUSH_INTERVAL,
+    INGEST_FLUSH_SIZE,
+    INGEST_ID_BLOCK_SIZE,
+    INGEST_MAX_ATTEMPTS,
+    INGEST_MAX_BUFFERED,
+)
+from .custom_exc import InsertionError
+from .repository import PostgresMLAPIRepository
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Buffers search queries and visited URLs in the process and writes them in batches.
+
+    Search queries get their ids up front, reserved from the sequence in blocks, so callers have them before
+    the rows exist. A background thread flushes whatever is buffered when `INGEST_FLUSH_SIZE` events are
+    waiting or every `INGEST_FLUSH_INTERVAL` seconds, and once more at exit. While the process lives, delivery
+    is at least once: a failed flush puts its events back for the next one, and writing search queries twice is
+    a no-op. The buffer is only in memory, so whatever it holds when the process crashes is lost.
+    """
+
+    def __init__(self, repo: PostgresMLAPIRepository) -> None:
+        self.repo = repo
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.ids_lock = threading.Lock()
+        self.search_queries: List[Tuple[int, int, str, List[str]]] = []
+        # (search query id, url, flushes attempted)
+        self.visited_urls: List[Tuple[int, str, int]] = []
+        self.reserved_ids: Deque[int] = deque()
+        # ids only grow: every id up to this one was taken from the sequence
+        self.last_reserved_id = 0
+        self.wakeup = threading.Event()
+
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.try_flush)
+
+    def add_search_queries(
+        self, search_queries: List[Tuple[int, str, List[str]]], search_query_ids: Optional[List[int]] = None
+    ) -> List[int]:
+        """Buffers `(user profile id, query, visited urls)` entries; returns their ids, which are taken from the
+        reserved blocks unless the caller reserved them itself and passes them as `search_query_ids`.
+        """
+        if search_query_ids is None:
+            search_query_ids = self._take_ids(len(search_queries))
+        rows = [(search_query_id, *entry) for search_query_id, entry in zip(search_query_ids, search_queries)]
+        self._buffer(self.search_queries, rows)
+        return search_query_ids
+
+    def add_visited_urls(self, visited_urls: List[Tuple[int, str]]) -> None:
+        """Buffers `(search query id, url)` entries."""
+        self._buffer(self.visited_urls, [(search_query_id, url, 0) for search_query_id, url in visited_urls])
+
+    def is_reserved(self, search_query_id: int) -> bool:
+        """Whether `search_query_id` was taken from the sequence, by this process or another; the sequence is
+        only read again for ids past the last one seen.
+        """
+        if search_query_id > self.last_reserved_id:
+            self.last_reserved_id = max(self.last_reserved_id, self.repo.fetch_last_search_query_id())
+        return 0 < search_query_id <= self.last_reserved_id
+
+    def _buffer(self, events: List[Tuple], new_events: List[Tuple]) -> None:
+        with self.lock:
+            buffered = len(self.search_queries) + len(self.visited_urls)
+            if buffered + len(new_events) > INGEST_MAX_BUFFERED:
+                raise InsertionError
+            events.extend(new_events)
+            if buffered + len(new_events) >= INGEST_FLUSH_SIZE:
+                self.wakeup.set()
+
+    def _take_ids(self, count: int) -> List[int]:
+        with self.ids_lock:
+            while len(self.reserved_ids) < count:
+                self.reserved_ids.extend(
+                    self.repo.reserve_search_query_ids(max(INGEST_ID_BLOCK_SIZE, count - len(self.reserved_ids)))
+                )
+            return [self.reserved_ids.popleft() for _ in range(count)]
+
+    def run(self) -> None:
+        while True:
+            self.wakeup.wait(INGEST_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.try_flush()
+
+    def try_flush(self) -> None:
+        try:
+            self.flush()
+        except InsertionError as e:
+            logger.error("Write-behind flush failed: %r.", e.__cause__)
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.lock:
+                search_queries, self.search_queries = self.search_queries, []
+                visited_urls, self.visited_urls = self.visited_urls, []
+
+            try:
+                # first, so the visited URLs of the search queries in the same flush find their rows
+                self._insert_search_queries(search_queries)
+            except InsertionError:
+                self._requeue(search_queries, visited_urls)
+                raise
+
+            if not visited_urls:
+                return
+
+            try:
+                appended_ids = set(
+                    self.repo.append_visited_urls([(search_query_id, url) for search_query_id, url, _ in visited_urls])
+                )
+            except InsertionError:
+                self._requeue([], visited_urls)
+                raise
+
+            # search queries another process has not flushed yet, or that never existed
+            pending = []
+            dropped = []
+            for search_query_id, url, attempts in visited_urls:
+                if search_query_id in appended_ids:
+                    continue
+                if attempts + 1 < INGEST_MAX_ATTEMPTS:
+                    pending.append((search_query_id, url, attempts + 1))
+                else:
+                    dropped.append((search_query_id, url))
+            if dropped:
+                logger.warning("Dropping visited URLs of search queries that were never written: %r.", dropped)
+            self._requeue([], pending)
+
+    def _insert_search_queries(self, search_queries: List[Tuple[int, int, str, List[str]]]) -> None:
+        if not search_queries:
+            return
+
+        try:
+            self.repo.insert_search_queries(search_queries)
+        except InsertionError as e:
+            if not isinstance(e.__cause__, psycopg2.IntegrityError):
+                raise
+            # one bad row (e.g. an unknown user profile) fails the whole batch: write the rows one by one and
+            # drop the ones that can never be written
+            for row in search_queries:
+                try:
+                    self.repo.insert_search_queries([row])
+                except InsertionError as row_error:
+                    if not isinstance(row_error.__cause__, psycopg2.IntegrityError):
+                        raise
+                    logger.warning("Dropping search query %d: %r.", row[0], row_error.__cause__)
+
+    def _requeue(
+        self, search_queries: List[Tuple[int, int, str, List[str]]], visited_urls: List[Tuple[int, str, int]]
+    ) -> None:
+        with self.lock:
+            self.search_queries[:0] = search_queries
+            self.visited_urls[:0] = visited_urls
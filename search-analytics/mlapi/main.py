@@ -1,13 +1,17 @@
+import json
 from typing import Any, Dict, List, Tuple
 
-from flask import Flask, request
+from flask import Flask, Response, request
 
+from .constants import CHANGES_MAX_PAGE_SIZE, CHANGES_PAGE_SIZE, RESERVE_MAX_IDS
 from .custom_exc import FetchError, InsertionError, NotFoundError
+from .ingestion import WriteBehindBuffer
 from .repository import PostgresMLAPIRepository
 
 app = Flask(__name__)
 
 repo = PostgresMLAPIRepository()
+write_buffer = WriteBehindBuffer(repo)
 
 
 @app.route("/user_profiles/", methods=["POST"])
@@ -43,6 +47,18 @@ def get_user_profile(user_ip: str) -> Tuple[Dict[str, Any], int]:
     return {"user_profile": user_profile_dict}, 200
 
 
+@app.route("/user_profiles/<user_ip>/id/", methods=["GET"])
+def get_user_profile_id(user_ip: str) -> Tuple[Dict[str, Any], int]:
+    """Only the profile id, without aggregating the search history."""
+    try:
+        user_profile_id = repo.fetch_user_profile_id(user_ip)
+    except FetchError:
+        return {"status": "Error fetching user profile."}, 500
+    except NotFoundError:
+        return {"status": "User profile not found."}, 404
+    return {"id": user_profile_id}, 200
+
+
 @app.route("/user_profiles/", methods=["GET"])
 def get_user_profiles() -> Tuple[Dict[str, List[Any]], int]:
     try:
@@ -52,6 +68,38 @@ def get_user_profiles() -> Tuple[Dict[str, List[Any]], int]:
     return {"user_profiles": user_profiles}, 200
 
 
+@app.route("/user_profiles/export/", methods=["GET"])
+def export_user_profiles() -> Tuple[Any, int]:
+    """Streams every user with search history as NDJSON, one `[user profile id, search queries]` per line, in
+    the shape of the entries of `GET /user_profiles/`. The `X-Activity-Cursor` header is the cursor to pass as
+    `since` to `GET /user_profiles/changes/` afterwards.
+    """
+    try:
+        activity_cursor, user_profiles = repo.export_user_profiles()
+    except FetchError:
+        return {"status": "Error fetching user profiles."}, 500
+
+    lines = (json.dumps(user_profile, separators=(",", ":")) + "\n" for user_profile in user_profiles)
+    return Response(lines, mimetype="application/x-ndjson", headers={"X-Activity-Cursor": str(activity_cursor)}), 200
+
+
+@app.route("/user_profiles/changes/", methods=["GET"])
+def get_changed_user_profiles() -> Tuple[Dict[str, Any], int]:
+    """Query parameters: `since`, the cursor returned by the previous call (0 at first); `limit`, the maximum
+    number of user profiles to return.
+    """
+    try:
+        since = int(request.args.get("since", 0))
+        limit = int(request.args.get("limit", CHANGES_PAGE_SIZE))
+    except ValueError:
+        return {"status": "Malformed request: `since` and `limit` must be integers."}, 400
+    try:
+        user_profiles, cursor = repo.fetch_changed_user_profiles(since, min(max(limit, 1), CHANGES_MAX_PAGE_SIZE))
+    except FetchError:
+        return {"status": "Error fetching user profiles."}, 500
+    return {"user_profiles": user_profiles, "cursor": cursor}, 200
+
+
 @app.route("/search_queries/", methods=["POST"])
 def create_search_query() -> Tuple[Dict[str, Any], int]:
     """Incoming request shape:
@@ -60,22 +108,83 @@ def create_search_query() -> Tuple[Dict[str, Any], int]:
         "user_profile_id":  user profile id, int
         "query":            search query, string
         "visited_urls":     optional; visited urls, list
+        "id":               optional; id reserved through `POST /search_queries/ids/`, int
     }
     ```
+    The search query is buffered in this process and written within `INGEST_FLUSH_INTERVAL` seconds, unless the
+    process crashes first; posting the same reserved id again writes it once. An `id` that was never reserved is
+    rejected.
     """
+    payload = request.get_json()
     try:
-        user_profile_id = request.json["user_profile_id"]
-        query = request.json["query"]
-    except KeyError:
+        user_profile_id = payload["user_profile_id"]
+        query = payload["query"]
+    except (KeyError, TypeError):
         return {"status": "Malformed request: missing fields."}, 400
-    visited_urls = request.json.get("visited_urls", [])
+    visited_urls = payload.get("visited_urls", [])
+    reserved_ids = None
+    if "id" in payload:
+        search_query_id = payload["id"]
+        try:
+            reserved = type(search_query_id) is int and write_buffer.is_reserved(search_query_id)
+        except FetchError:
+            return {"status": "Error checking the search query id."}, 500
+        if not reserved:
+            return {"status": "Malformed request: `id` must be reserved through `POST /search_queries/ids/`."}, 400
+        reserved_ids = [search_query_id]
     try:
-        search_query_id = repo.insert_search_query(user_profile_id, query, visited_urls)
+        (search_query_id,) = write_buffer.add_search_queries([(user_profile_id, query, visited_urls)], reserved_ids)
     except InsertionError:
         return {"status": "Error inserting search query."}, 500
     return {"id": search_query_id}, 201
 
 
+@app.route("/search_queries/ids/", methods=["POST"])
+def reserve_search_query_ids() -> Tuple[Dict[str, Any], int]:
+    """Incoming request shape:
+    ```json
+    {
+        "count":    number of ids to reserve, at most `RESERVE_MAX_IDS`, int
+    }
+    ```
+    Reserved ids let a client know the id of a search query before logging it with `POST /search_queries/`.
+    """
+    try:
+        count = int(request.get_json()["count"])
+    except (KeyError, TypeError, ValueError):
+        return {"status": "Malformed request: `count` must be an integer."}, 400
+    try:
+        search_query_ids = repo.reserve_search_query_ids(min(max(count, 1), RESERVE_MAX_IDS))
+    except InsertionError:
+        return {"status": "Error reserving search query ids."}, 500
+    return {"ids": search_query_ids}, 201
+
+
+@app.route("/search_queries/bulk/", methods=["POST"])
+def create_search_queries() -> Tuple[Dict[str, Any], int]:
+    """Incoming request shape:
+    ```json
+    {
+        "search_queries":   list of search queries, each in the shape `POST /search_queries/` takes
+    }
+    ```
+    The ids in the response are in the order of the search queries. The search queries are written behind, like
+    those of `POST /search_queries/`.
+    """
+    try:
+        search_queries = [
+            (entry["user_profile_id"], entry["query"], entry.get("visited_urls", []))
+            for entry in request.get_json()["search_queries"]
+        ]
+    except (KeyError, TypeError):
+        return {"status": "Malformed request: missing fields."}, 400
+    try:
+        search_query_ids = write_buffer.add_search_queries(search_queries)
+    except InsertionError:
+        return {"status": "Error inserting search queries."}, 500
+    return {"ids": search_query_ids}, 201
+
+
 @app.route("/search-queries/<int:search_query_id>/", methods=["GET"])
 def get_search_query(search_query_id: int) -> Tuple[Dict[str, Any], int]:
     try:
@@ -95,13 +204,36 @@ def add_visited_url(search_query_id: int) -> Tuple[Dict[str, Any], int]:
         "url":  URL to append, string
     }
     ```
+    The URL is buffered in this process and appended within `INGEST_FLUSH_INTERVAL` seconds, unless the process
+    crashes first or the search query is still not written after `INGEST_MAX_ATTEMPTS` flushes.
     """
     try:
         new_url = request.json["url"]
     except KeyError:
         return {"status": "Malformed request: missing URL."}, 400
     try:
-        repo.append_visited_url(search_query_id, new_url)
+        write_buffer.add_visited_urls([(search_query_id, new_url)])
     except InsertionError:
         return {"status": "Error appending URL."}, 500
     return {"status": "URL appended successfully."}, 204
+
+
+@app.route("/search-queries/visited-urls/bulk/", methods=["POST"])
+def add_visited_urls() -> Tuple[Dict[str, Any], int]:
+    """Incoming request shape:
+    ```json
+    {
+        "visited_urls": list of {"search_query_id": search query id, int, "url": URL to append, string}
+    }
+    ```
+    The URLs are appended behind, like that of `PATCH /search-queries/<id>/visited-urls/`.
+    """
+    try:
+        visited_urls = [(entry["search_query_id"], entry["url"]) for entry in request.get_json()["visited_urls"]]
+    except (KeyError, TypeError):
+        return {"status": "Malformed request: missing fields."}, 400
+    try:
+        write_buffer.add_visited_urls(visited_urls)
+    except InsertionError:
+        return {"status": "Error appending URLs."}, 500
+    return {"status": "URLs appended successfully."}, 204
@@ -1,126 +1,381 @@
-from typing import Any, Dict, List, Tuple
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
 
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 
+from .constants import EXPORT_FETCH_SIZE, POSTGRES_POOL_MAX_SIZE
 from .custom_exc import FetchError, InsertionError, NotFoundError
-from .db import MLAPI_DB_SCM, get_postgres_connection
+from .db import get_postgres_connection, get_postgres_connection_pool, migrate
+
+# the `search_queries` entries of the user profile aggregations, with the URLs visited in click order
+SEARCH_QUERY_OBJECT = """jsonb_build_object(
+    'search_id', search_queries.id,
+    'body', search_queries.body,
+    'visited_urls', array(
+        select clicks.url from clicks where clicks.search_query_id = search_queries.id order by clicks.id
+    )
+)"""
 
 
 class PostgresMLAPIRepository:
+    """Safe to share between threads: every call checks a connection out of a pool for its own transaction."""
+
     def __init__(self) -> None:
-        self.conn: psycopg2.extensions.connection = get_postgres_connection()
-        self.cursor: psycopg2.extensions.cursor = self.conn.cursor()
-        self.cursor.execute(MLAPI_DB_SCM)
-        self.conn.commit()
+        conn = get_postgres_connection()
+        try:
+            migrate(conn)
+        finally:
+            conn.close()
+
+        self.pool = get_postgres_connection_pool()
+        # the pool raises rather than blocks when it runs out of connections
+        self.pool_slots = threading.BoundedSemaphore(POSTGRES_POOL_MAX_SIZE)
+
+    @contextmanager
+    def cursor(self) -> Iterator[psycopg2.extensions.cursor]:
+        """A cursor in a transaction of its own, committed if the block succeeds and rolled back otherwise.
+
+        A connection the server dropped, or that failed in a way that leaves it unusable, is closed instead of
+        being returned to the pool, so the next checkout gets a fresh one.
+        """
+        with self.pool_slots:
+            conn = self.pool.getconn()
+            broken = False
+            try:
+                with conn.cursor() as cursor:
+                    yield cursor
+                conn.commit()
+            except psycopg2.Error as e:
+                broken = bool(conn.closed) or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+                if not broken:
+                    conn.rollback()
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn, close=broken or bool(conn.closed))
 
     def insert_user_profile(self, ip: str, info: Dict[str, Any]) -> int:
         try:
-            self.cursor.execute("insert into user_profiles (ip, info) values (%s, %s) returning id;", (ip, info))
+            with self.cursor() as cursor:
+                cursor.execute("insert into user_profiles (ip, info) values (%s, %s) returning id;", (ip, info))
+                (user_profile_id,) = cursor.fetchone()
         except psycopg2.Error as e:
             raise InsertionError from e
 
-        (user_profile_id,) = self.cursor.fetchone()
-        self.conn.commit()
-
         return user_profile_id
 
     def fetch_user_profile(self, user_ip: int) -> Dict[str, Any]:
         try:
-            self.cursor.execute(
-                """
-                select
-                    user_profiles.id,
-                    user_profiles.ip,
-                    user_profiles.info,
-                    coalesce(json_agg(json_build_object(
-                        'id', search_queries.id,
-                        'body', search_queries.body,
-                        'visited_urls', search_queries.visited_urls
-                    ) order by search_queries.id) filter (where search_queries.id is not null), '[]') queries
-                from
-                    user_profiles
-                left join
-                    search_queries ON user_profiles.id = search_queries.user_profile_id
-                where
-                    user_profiles.ip = %s
-                group by
-                    user_profiles.id, user_profiles.ip, user_profiles.info;
-                """,
-                (user_ip,),
-            )
+            with self.cursor() as cursor:
+                cursor.execute(
+                    """
+                    select
+                        user_profiles.id,
+                        user_profiles.ip,
+                        user_profiles.info,
+                        coalesce(json_agg(json_build_object(
+                            'id', search_queries.id,
+                            'body', search_queries.body,
+                            'visited_urls', array(
+                                select clicks.url from clicks where clicks.search_query_id = search_queries.id
+                                order by clicks.id
+                            )
+                        ) order by search_queries.id) filter (where search_queries.id is not null), '[]') queries
+                    from
+                        user_profiles
+                    left join
+                        search_queries ON user_profiles.id = search_queries.user_profile_id
+                    where
+                        user_profiles.ip = %s
+                    group by
+                        user_profiles.id, user_profiles.ip, user_profiles.info;
+                    """,
+                    (user_ip,),
+                )
+                row = cursor.fetchone()
         except psycopg2.Error as e:
             raise FetchError from e
 
         try:
-            id_, ip, info, search_queries = self.cursor.fetchone()
+            id_, ip, info, search_queries = row
         except Exception:
             raise NotFoundError
 
         return {"id": id_, "ip": ip, "info": info, "search_queries": search_queries}
 
+    def fetch_user_profile_id(self, user_ip: str) -> int:
+        try:
+            with self.cursor() as cursor:
+                cursor.execute("execute fetch_user_profile_id (%s);", (user_ip,))
+                row = cursor.fetchone()
+        except psycopg2.Error as e:
+            raise FetchError from e
+
+        if row is None:
+            raise NotFoundError
+
+        return row[0]
+
     def fetch_user_profiles(self) -> List[Tuple[Any, ...]]:
         try:
-            self.cursor.execute(
-                """
+            with self.cursor() as cursor:
+                cursor.execute(f"""
+                    select
+                        user_profiles.id,
+                        jsonb_agg({SEARCH_QUERY_OBJECT}) as search_queries
+                    from
+                        user_profiles
+                    inner join
+                        search_queries ON user_profiles.id = search_queries.user_profile_id
+                    group by
+                        user_profiles.id
+                    order by
+                        user_profiles.id;
+                    """)
+                return cursor.fetchall()
+        except psycopg2.Error as e:
+            raise FetchError from e
+
+    def fetch_changed_user_profiles(self, since: int, limit: int) -> Tuple[List[Tuple[Any, ...]], int]:
+        """Returns the full histories of the next `limit` or so users with activity from the `since` cursor on,
+        and the cursor to pass next.
+
+        Every search query and every click records the id of the transaction that wrote it, and users come in
+        the order of their latest activity. Transactions commit out of order, so only activity below the
+        horizon of the current snapshot is read: every transaction below it has ended, and nothing can commit
+        behind the cursor later. A page ends after a whole transaction, so it may hold a few more users than
+        `limit`; the cursor is the transaction after the page, or the horizon once the changes are exhausted.
+        """
+        try:
+            with self.cursor() as cursor:
+                cursor.execute("select pg_snapshot_xmin(pg_current_snapshot())::text::bigint;")
+                (horizon,) = cursor.fetchone()
+                cursor.execute(
+                    f"""
+                    with activity as (
+                        select
+                            user_profile_id,
+                            activity_xid
+                        from
+                            search_queries
+                        where
+                            activity_xid >= %(since)s and activity_xid < %(horizon)s
+                        union all
+                        select
+                            search_queries.user_profile_id,
+                            clicks.activity_xid
+                        from
+                            clicks
+                        inner join
+                            search_queries ON clicks.search_query_id = search_queries.id
+                        where
+                            clicks.activity_xid >= %(since)s and clicks.activity_xid < %(horizon)s
+                    ), changed as (
+                        select
+                            user_profile_id,
+                            max(activity_xid) as xid
+                        from
+                            activity
+                        group by
+                            user_profile_id
+                    ), page_end as (
+                        select
+                            xid
+                        from
+                            changed
+                        order by
+                            xid
+                        offset %(limit)s - 1
+                        limit 1
+                    )
+                    select
+                        changed.user_profile_id,
+                        changed.xid,
+                        jsonb_agg({SEARCH_QUERY_OBJECT} order by search_queries.id) as search_queries
+                    from
+                        changed
+                    inner join
+                        search_queries ON changed.user_profile_id = search_queries.user_profile_id
+                    where
+                        changed.xid <= coalesce((select xid from page_end), %(horizon)s)
+                    group by
+                        changed.user_profile_id, changed.xid
+                    order by
+                        changed.xid;
+                    """,
+                    {"since": since, "horizon": horizon, "limit": limit},
+                )
+                rows = cursor.fetchall()
+        except psycopg2.Error as e:
+            raise FetchError from e
+
+        next_cursor = rows[-1][1] + 1 if len(rows) >= limit else max(horizon, since)
+        return [(user_profile_id, search_queries) for user_profile_id, _, search_queries in rows], next_cursor
+
+    def export_user_profiles(self) -> Tuple[int, Iterator[Tuple[Any, ...]]]:
+        """Returns the cursor to pass to `fetch_changed_user_profiles` next and an iterator over every user with
+        search history, as of the same snapshot.
+
+        The cursor is the horizon of the snapshot: transactions from there on may have committed after it, and
+        the changes from the cursor on return their users again.
+
+        The rows come from a server-side cursor on a connection of their own, `EXPORT_FETCH_SIZE` at a time, and
+        each one aggregates the history of a single user, so nothing holds the whole export in memory.
+        """
+        conn = get_postgres_connection()
+        try:
+            conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+            with conn.cursor() as cursor:
+                # the first statement takes the snapshot of the transaction
+                cursor.execute("select pg_snapshot_xmin(pg_current_snapshot())::text::bigint;")
+                (activity_cursor,) = cursor.fetchone()
+
+            export_cursor = conn.cursor(name="user_profiles_export")
+            export_cursor.itersize = EXPORT_FETCH_SIZE
+            export_cursor.execute(f"""
                 select
                     user_profiles.id,
-                    jsonb_agg(jsonb_build_object(
-                        'search_id', search_queries.id,
-                        'body', search_queries.body,
-                        'visited_urls', search_queries.visited_urls
-                    )) as search_queries
+                    (
+                        select
+                            jsonb_agg({SEARCH_QUERY_OBJECT} order by search_queries.id)
+                        from
+                            search_queries
+                        where
+                            search_queries.user_profile_id = user_profiles.id
+                    ) as search_queries
                 from
                     user_profiles
-                inner join
-                    search_queries ON user_profiles.id = search_queries.user_profile_id
-                group by
-                    user_profiles.id
+                where
+                    exists (select 1 from search_queries where search_queries.user_profile_id = user_profiles.id)
                 order by
                     user_profiles.id;
-            """
-            )
+                """)
         except psycopg2.Error as e:
+            conn.close()
             raise FetchError from e
 
-        return self.cursor.fetchall()
+        def rows() -> Iterator[Tuple[Any, ...]]:
+            try:
+                yield from export_cursor
+            finally:
+                conn.close()
+
+        return activity_cursor, rows()
 
-    def insert_search_query(self, user_profile_id: int, query: str, visited_urls: List[str]) -> int:
+    def reserve_search_query_ids(self, count: int) -> List[int]:
+        """Takes `count` ids from the sequence, for search queries written later."""
         try:
-            self.cursor.execute(
-                "insert into search_queries (user_profile_id, body, visited_urls) values (%s, %s, %s) returning id;",
-                (user_profile_id, query, visited_urls),
-            )
+            with self.cursor() as cursor:
+                cursor.execute("execute reserve_search_query_ids (%s);", (count,))
+                return [search_query_id for (search_query_id,) in cursor.fetchall()]
         except psycopg2.Error as e:
             raise InsertionError from e
 
-        (search_query_id,) = self.cursor.fetchone()
-        self.conn.commit()
+    def fetch_last_search_query_id(self) -> int:
+        """The last id taken from the sequence, by an insert or a reservation; 0 if none was yet."""
+        try:
+            with self.cursor() as cursor:
+                cursor.execute(
+                    "select pg_sequence_last_value(pg_get_serial_sequence('search_queries', 'id')::regclass);"
+                )
+                (last_value,) = cursor.fetchone()
+        except psycopg2.Error as e:
+            raise FetchError from e
+
+        return last_value or 0
 
-        return search_query_id
+    def insert_search_queries(self, rows: List[Tuple[int, int, str, List[str]]]) -> None:
+        """Writes `(id, user profile id, query, visited urls)` rows, and their clicks, in one transaction; rows
+        already written by an earlier attempt are skipped along with their clicks.
+        """
+        try:
+            with self.cursor() as cursor:
+                inserted = psycopg2.extras.execute_values(
+                    cursor,
+                    """
+                    insert into search_queries (id, user_profile_id, body)
+                    values %s
+                    on conflict (id) do nothing
+                    returning id;
+                    """,
+                    [(search_query_id, user_profile_id, body) for search_query_id, user_profile_id, body, _ in rows],
+                    page_size=len(rows),
+                    fetch=True,
+                )
+                inserted_ids = {search_query_id for (search_query_id,) in inserted}
+                clicks = [
+                    (search_query_id, url)
+                    for search_query_id, _, _, visited_urls in rows
+                    if search_query_id in inserted_ids
+                    for url in visited_urls or []
+                ]
+                if clicks:
+                    psycopg2.extras.execute_values(
+                        cursor, "insert into clicks (search_query_id, url) values %s;", clicks, page_size=len(clicks)
+                    )
+        except psycopg2.Error as e:
+            raise InsertionError from e
 
     def fetch_search_query(self, search_query_id: int) -> Dict[str, Any]:
         try:
-            self.cursor.execute(
-                "select * from search_queries where id = %s;",
-                search_query_id,
-            )
+            with self.cursor() as cursor:
+                cursor.execute(
+                    """
+                    select
+                        id,
+                        user_profile_id,
+                        body,
+                        array(
+                            select clicks.url from clicks where clicks.search_query_id = search_queries.id
+                            order by clicks.id
+                        )
+                    from
+                        search_queries
+                    where
+                        id = %s;
+                    """,
+                    (search_query_id,),
+                )
+                row = cursor.fetchone()
         except psycopg2.Error as e:
             raise FetchError from e
 
         try:
-            id_, user_profile_id, body, visited_urls = self.cursor.fetchone()
+            id_, user_profile_id, body, visited_urls = row
         except Exception:
             raise NotFoundError
 
         return {"id": id_, "user_profile_id": user_profile_id, "body": body, "visited_urls": visited_urls}
 
-    def append_visited_url(self, search_query_id: int, new_url: str) -> None:
+    def append_visited_urls(self, visited_urls: List[Tuple[int, str]]) -> List[int]:
+        """Records `(search query id, url)` clicks in one statement; returns the search query ids that exist."""
         try:
-            self.cursor.execute(
-                "update search_queries set visited_urls = array_append(visited_urls, %s) where id = %s;",
-                (new_url, search_query_id),
-            )
+            with self.cursor() as cursor:
+                rows = psycopg2.extras.execute_values(
+                    cursor,
+                    """
+                    insert into clicks (search_query_id, url)
+                    select
+                        new.search_query_id,
+                        new.url
+                    from
+                        (values %s) as new (search_query_id, url)
+                    inner join
+                        search_queries ON new.search_query_id = search_queries.id
+                    returning
+                        search_query_id;
+                    """,
+                    visited_urls,
+                    page_size=len(visited_urls),
+                    fetch=True,
+                )
         except psycopg2.Error as e:
             raise InsertionError from e
 
-        self.conn.commit()
+        return list({search_query_id for (search_query_id,) in rows})
@@ -3,3 +3,17 @@ import os
 MLAPI_BASE_URL = os.getenv("MLAPI_BASE_URL")
 PIPELINE_RUN_PERIOD = int(os.getenv("PIPELINE_RUN_PERIOD", "300"))
 REDIS_RESULTS_CONN_STR = os.getenv("REDIS_RESULTS_CONN_STR", "redis://localhost:6379/0")
+RECOMMENDER_KEY = "recommender:%s"
+GLOBAL_RECOMMENDER_KEY = "recommender:global"
+GLOBAL_RECOMMENDER_VERSION_KEY = "recommender:global:version"
+# seconds between rebuilds of the global index, which reads the whole history
+GLOBAL_INDEX_PERIOD = int(os.getenv("GLOBAL_INDEX_PERIOD", "3600"))
+PIPELINE_CURSOR_KEY = "pipeline:cursor"
+PIPELINE_BATCH_SIZE = int(os.getenv("PIPELINE_BATCH_SIZE", "100"))
+# training processes; 1 trains in the pipeline process itself
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", str(os.cpu_count() or 1)))
+# users fetched but not yet published, which bounds the histories and models held in memory
+PIPELINE_MAX_IN_FLIGHT = int(os.getenv("PIPELINE_MAX_IN_FLIGHT", "256"))
+NEIGHBORS_K = int(os.getenv("NEIGHBORS_K", "10"))
+NEIGHBORS_THRESHOLD = float(os.getenv("NEIGHBORS_THRESHOLD", "0.1"))
+NEIGHBORS_BLOCK_CELLS = 1_000_000
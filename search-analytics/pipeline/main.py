@@ -1,54 +1,151 @@
 # NOTE: The pipeline control flow is controlled by custom exceptions for now.
-import json
+import logging
+import math
 import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Deque, Iterable, Iterator, List, Optional, Tuple, cast
 
 import redis
-from sklearn.feature_extraction.text import TfidfVectorizer
 
-from .constants import PIPELINE_RUN_PERIOD, REDIS_RESULTS_CONN_STR
+from .constants import (
+    GLOBAL_INDEX_PERIOD,
+    GLOBAL_RECOMMENDER_KEY,
+    GLOBAL_RECOMMENDER_VERSION_KEY,
+    PIPELINE_BATCH_SIZE,
+    PIPELINE_CURSOR_KEY,
+    PIPELINE_MAX_IN_FLIGHT,
+    PIPELINE_RUN_PERIOD,
+    PIPELINE_WORKERS,
+    RECOMMENDER_KEY,
+    REDIS_RESULTS_CONN_STR,
+)
 from .custom_exc import SearchQueriesNotFetched
-from .workflows import get_user_profiles, train_model
+from .model_codec import encode
+from .workflows import build_global_index, get_changed_user_profiles, get_user_profiles, train_user
+
+logger = logging.getLogger(__name__)
 
 redis_instance = redis.Redis.from_url(REDIS_RESULTS_CONN_STR, decode_responses=True)
 
-while True:
-    start = time.perf_counter()
+
+def changed_batches(cursor: int) -> Iterator[Tuple[Iterable[Tuple[Any, ...]], int]]:
+    """Yields the users with activity from `cursor` on in batches, each with the cursor past it."""
+    if not cursor:
+        # nothing published yet: stream every history rather than page through all the changes
+        user_profiles, cursor = get_user_profiles()
+        yield user_profiles, cursor
+    while True:
+        changed, cursor = get_changed_user_profiles(cursor)
+        yield changed, cursor
+        if len(changed) < PIPELINE_BATCH_SIZE:
+            return
+
+
+def run(executor: Optional[Executor]) -> None:
+    """Publishes the models of the users with activity since the last run.
+
+    Fetching the next batch of changes, training (in `executor`, if any) and writing to Redis overlap. At most
+    `PIPELINE_MAX_IN_FLIGHT` users are between fetched and published at any time, and the cursor only moves
+    past a batch once every model of it is in Redis. A user whose training fails is logged and skipped, and the
+    cursor stays before it so the next run retries it; a broken process pool ends the run with
+    `BrokenProcessPool`, for the caller to replace the executor.
+    """
+    # where the activity not yet reflected in the published models starts
+    cursor = int(cast(Optional[str], redis_instance.get(PIPELINE_CURSOR_KEY)) or 0)
+    in_flight: Deque[Tuple[int, "Future[Optional[bytes]]"]] = deque()
+    # (number of users submitted up to the end of a batch, cursor after that batch)
+    batch_ends: Deque[Tuple[int, int]] = deque()
+    submitted = published = 0
+    failed = False
+
+    def publish_oldest() -> None:
+        nonlocal published, failed
+        user_profile_id, future = in_flight.popleft()
+        try:
+            model = future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception:
+            logger.exception("Training the model of user profile %s failed.", user_profile_id)
+            failed = True
+        else:
+            if model is not None:
+                redis_instance.set(RECOMMENDER_KEY % user_profile_id, model)
+        published += 1
+        while not failed and batch_ends and batch_ends[0][0] <= published:
+            redis_instance.set(PIPELINE_CURSOR_KEY, batch_ends.popleft()[1])
+
     try:
-        user_profiles = get_user_profiles()
+        for user_profiles, batch_cursor in changed_batches(cursor):
+            for user_profile_id, search_queries in user_profiles:
+                if len(in_flight) >= PIPELINE_MAX_IN_FLIGHT:
+                    publish_oldest()
+                in_flight.append((user_profile_id, submit(executor, search_queries)))
+                submitted += 1
+            batch_ends.append((submitted, batch_cursor))
     except SearchQueriesNotFetched as e:
         print("%s" % e, flush=True)
-        continue
-
-    for user_profile_id, search_queries in user_profiles:
-        # `search_queries` example:
-        # [
-        #     {
-        #         "search_id": 1,
-        #         "body": "search 1",
-        #         "visited_urls": ["http://example.com", "http://example.org"]
-        #     }, {
-        #         "search_id": 2,
-        #         "body": "search 2",
-        #         "visited_urls": ["http://example.net"]
-        #     }
-        # ]
-        if not redis_instance.exists(user_profile_id):
-            vectorizer = TfidfVectorizer()
-        else:
-            vectorizer = json.loads(redis_instance.get(user_profile_id))["vectorizer"]
-
-        df, vectorizer, sim_matrix = train_model(search_queries, vectorizer)
-        redis_instance.set(
-            user_profile_id,
-            json.dumps(
-                {
-                    "vectorizer": vectorizer.get_params(),
-                    "dataframe": df.to_json(),
-                    "similarity_matrix": sim_matrix.tolist(),
-                }
-            ),
-        )
-
-    elapsed = time.perf_counter() - start
-    print("Analytics pipeline took: %.2f." % elapsed, flush=True)
-    time.sleep(PIPELINE_RUN_PERIOD - elapsed)
+
+    while in_flight:
+        publish_oldest()
+    while not failed and batch_ends:
+        redis_instance.set(PIPELINE_CURSOR_KEY, batch_ends.popleft()[1])
+
+
+def publish_global_index() -> None:
+    """Rebuilds the LSH index over the queries of every user from the full export, and bumps its version so
+    the search API workers reload it.
+    """
+    try:
+        user_profiles, _ = get_user_profiles()
+        index = build_global_index(user_profiles)
+    except SearchQueriesNotFetched as e:
+        print("%s" % e, flush=True)
+        return
+    except ValueError:
+        # nobody clicked on anything yet
+        return
+
+    with redis_instance.pipeline() as pipe:
+        pipe.set(GLOBAL_RECOMMENDER_KEY, encode(index.fields()))
+        pipe.incr(GLOBAL_RECOMMENDER_VERSION_KEY)
+        pipe.execute()
+
+
+def submit(executor: Optional[Executor], search_queries: List[dict]) -> "Future[Optional[bytes]]":
+    if executor is not None:
+        return executor.submit(train_user, search_queries)
+
+    future: "Future[Optional[bytes]]" = Future()
+    try:
+        future.set_result(train_user(search_queries))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def make_executor() -> Optional[Executor]:
+    return ProcessPoolExecutor(PIPELINE_WORKERS) if PIPELINE_WORKERS > 1 else None
+
+
+if __name__ == "__main__":
+    executor = make_executor()
+    global_index_built_at = -math.inf
+    while True:
+        start = time.perf_counter()
+        try:
+            run(executor)
+        except BrokenProcessPool:
+            logger.exception("A training process died, restarting the pool.")
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            executor = make_executor()
+        if start - global_index_built_at >= GLOBAL_INDEX_PERIOD:
+            publish_global_index()
+            global_index_built_at = start
+        elapsed = time.perf_counter() - start
+        print("Analytics pipeline took: %.2f." % elapsed, flush=True)
+        # a run longer than the period starts the next one right away
+        time.sleep(max(PIPELINE_RUN_PERIOD - elapsed, 0))
@@ -1,33 +1,163 @@
-from typing import Any, Dict, List, Tuple
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
-import pandas as pd
 import requests
+import scipy.sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
-from .constants import MLAPI_BASE_URL
+from .constants import MLAPI_BASE_URL, NEIGHBORS_BLOCK_CELLS, NEIGHBORS_K, NEIGHBORS_THRESHOLD, PIPELINE_BATCH_SIZE
 from .custom_exc import SearchQueriesNotFetched
+from .lsh import LSHIndex
+from .model_codec import encode
 
 
-def get_user_profiles() -> List[Tuple[Any, ...]]:
-    resp = requests.get("%s/user_profiles/" % MLAPI_BASE_URL)
+def get_user_profiles() -> Tuple[Iterator[Tuple[Any, ...]], int]:
+    """Streams the full history of every user from the ML API export, one user at a time, and returns the
+    cursor to fetch the changes from afterwards.
+    """
+    try:
+        resp = requests.get("%s/user_profiles/export/" % MLAPI_BASE_URL, stream=True)
+    except requests.RequestException as e:
+        raise SearchQueriesNotFetched from e
     if resp.status_code != 200:
+        resp.close()
         raise SearchQueriesNotFetched
 
-    return resp.json()["user_profiles"]
+    def user_profiles() -> Iterator[Tuple[Any, ...]]:
+        try:
+            for line in resp.iter_lines():
+                if line:
+                    yield tuple(json.loads(line))
+        except requests.RequestException as e:
+            # the export broke off midway
+            raise SearchQueriesNotFetched from e
+        finally:
+            resp.close()
 
+    return user_profiles(), int(resp.headers["X-Activity-Cursor"])
 
-def convert_to_flattened_search_queries_dataframe(queries: List[Dict[str, Any]]) -> pd.DataFrame:
-    rows = [{"search_query": entry["body"], "visited_url": url} for entry in queries for url in entry["visited_urls"]]
-    return pd.DataFrame(rows)
+
+def get_changed_user_profiles(cursor: int) -> Tuple[List[Tuple[Any, ...]], int]:
+    """Returns the full histories of the next batch of users with activity from `cursor` on, and the new cursor."""
+    resp = requests.get(
+        "%s/user_profiles/changes/" % MLAPI_BASE_URL, params={"since": cursor, "limit": PIPELINE_BATCH_SIZE}
+    )
+    if resp.status_code != 200:
+        raise SearchQueriesNotFetched
+
+    body = resp.json()
+    return body["user_profiles"], body["cursor"]
+
+
+def group_visited_urls(queries: List[Dict[str, Any]]) -> Tuple[List[str], List[List[str]]]:
+    """Returns the distinct clicked-through queries and, for each, its distinct visited URLs."""
+    visited_urls: Dict[str, Dict[str, None]] = {}
+    for entry in queries:
+        if entry["visited_urls"]:
+            visited_urls.setdefault(entry["body"], {}).update(dict.fromkeys(entry["visited_urls"]))
+
+    return list(visited_urls), [list(urls) for urls in visited_urls.values()]
+
+
+def top_k_neighbors(
+    query_matrix: scipy.sparse.csr_matrix, k: int = NEIGHBORS_K, threshold: float = NEIGHBORS_THRESHOLD
+) -> scipy.sparse.csr_matrix:
+    """Returns, for each query, its `k` most similar other queries with a similarity of at least `threshold`.
+
+    The rows of `query_matrix` are L2-normalised, so similarities are dot products. They are computed a block
+    of rows at a time, so no more than about `NEIGHBORS_BLOCK_CELLS` of them are held at once.
+    """
+    n = query_matrix.shape[0]
+    k = min(k, n - 1)
+    block_rows = max(1, NEIGHBORS_BLOCK_CELLS // max(n, 1))
+    rows, cols, sims = [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=np.int32)], [np.empty(0, np.float32)]
+    for start in range(0, n if k > 0 else 0, block_rows):
+        end = start + block_rows
+        block = (query_matrix[start:end] @ query_matrix.T).toarray()
+        # a query is not its own neighbor
+        block[np.arange(len(block)), np.arange(start, start + len(block))] = 0
+
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(block, top, axis=1)
+        keep = (top_sims >= threshold) & (top_sims > 0)
+        rows.append(np.nonzero(keep)[0] + start)
+        cols.append(top[keep])
+        sims.append(top_sims[keep])
+
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(sims).astype(np.float32), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n)
+    )
 
 
 def train_model(
-    data: List[Dict[str, Any]], vectorizer: TfidfVectorizer
-) -> Tuple[pd.DataFrame, TfidfVectorizer, np.ndarray]:
-    df = convert_to_flattened_search_queries_dataframe(data)
-    query_vectors = vectorizer.fit_transform(df["search_query"])
-    similarity_matrix = cosine_similarity(query_vectors)
+    data: List[Dict[str, Any]],
+) -> Tuple[List[str], List[List[str]], TfidfVectorizer, scipy.sparse.csr_matrix, scipy.sparse.csr_matrix]:
+    queries, urls = group_visited_urls(data)
+    vectorizer = TfidfVectorizer()
+    query_matrix = vectorizer.fit_transform(queries).tocsr()
+
+    return queries, urls, vectorizer, query_matrix, top_k_neighbors(query_matrix)
+
+
+def build_recommender_artifact(
+    urls: List[List[str]],
+    vectorizer: TfidfVectorizer,
+    query_matrix: scipy.sparse.csr_matrix,
+    neighbors: scipy.sparse.csr_matrix,
+) -> Dict[str, Any]:
+    """Everything the search API needs to serve recommendations without refitting anything."""
+    return {
+        "vocabulary": vectorizer.get_feature_names_out().tolist(),
+        "idf": vectorizer.idf_.astype(np.float32),
+        "query_matrix": query_matrix,
+        "neighbors": neighbors,
+        "urls": urls,
+    }
+
+
+def train_user(search_queries: List[Dict[str, Any]]) -> Optional[bytes]:
+    """Trains and encodes the model of one user; None if there is nothing to learn from.
+
+    Runs in the training processes, so only the history goes in and only the encoded model comes out.
+    """
+    try:
+        _, urls, vectorizer, query_matrix, neighbors = train_model(search_queries)
+    except ValueError:
+        # no clicked-through queries, or nothing left to vectorize
+        return None
+
+    return encode(build_recommender_artifact(urls, vectorizer, query_matrix, neighbors))
+
+
+def build_global_index(user_profiles: Iterable[Tuple[Any, ...]]) -> LSHIndex:
+    """Indexes the clicked-through queries of every user, with how often each URL was visited after each.
+
+    Raises `ValueError` if there is nothing to index.
+    """
+    clicks: Dict[str, Dict[int, int]] = {}
+    url_ids: Dict[str, int] = {}
+    for _, search_queries in user_profiles:
+        for entry in search_queries:
+            if not entry["visited_urls"]:
+                continue
+            query_clicks = clicks.setdefault(" ".join(entry["body"].lower().split()), {})
+            for url in entry["visited_urls"]:
+                url_id = url_ids.setdefault(url, len(url_ids))
+                query_clicks[url_id] = query_clicks.get(url_id, 0) + 1
+
+    if not clicks:
+        raise ValueError("No clicked-through queries.")
+
+    rows: List[int] = []
+    cols: List[int] = []
+    counts: List[int] = []
+    for row, query_clicks in enumerate(clicks.values()):
+        rows.extend([row] * len(query_clicks))
+        cols.extend(query_clicks)
+        counts.extend(query_clicks.values())
+    click_matrix = scipy.sparse.csr_matrix(
+        (np.array(counts, dtype=np.float32), (rows, cols)), shape=(len(clicks), len(url_ids))
+    )
 
-    return df, vectorizer, similarity_matrix
+    return LSHIndex.build(list(clicks), click_matrix, list(url_ids))
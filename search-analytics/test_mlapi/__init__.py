@@ -0,0 +1,155 @@
+import itertools
+import threading
+import unittest
+from typing import Dict, List, Tuple
+from unittest.mock import patch
+
+import psycopg2
+from mlapi.custom_exc import InsertionError
+from mlapi.ingestion import WriteBehindBuffer
+
+
+class FakeRepository:
+    """The write side of `PostgresMLAPIRepository`, in memory: rows already written are skipped, like the
+    `on conflict do nothing` of the real one.
+    """
+
+    def __init__(self) -> None:
+        self.ids = itertools.count(1)
+        self.search_queries: Dict[int, Tuple[int, str, List[str]]] = {}
+        self.clicks: List[Tuple[int, str]] = []
+        self.failures: List[Exception] = []
+        self.written = threading.Event()
+        self.last_id = 0
+        self.last_id_reads = 0
+
+    def reserve_search_query_ids(self, count: int) -> List[int]:
+        search_query_ids = [next(self.ids) for _ in range(count)]
+        self.last_id = search_query_ids[-1]
+        return search_query_ids
+
+    def fetch_last_search_query_id(self) -> int:
+        self.last_id_reads += 1
+        return self.last_id
+
+    def insert_search_queries(self, rows: List[Tuple[int, int, str, List[str]]]) -> None:
+        if self.failures:
+            raise InsertionError from self.failures.pop(0)
+        for search_query_id, user_profile_id, query, visited_urls in rows:
+            if search_query_id not in self.search_queries:
+                self.search_queries[search_query_id] = (user_profile_id, query, visited_urls)
+        self.written.set()
+
+    def append_visited_urls(self, visited_urls: List[Tuple[int, str]]) -> List[int]:
+        appended = [
+            (search_query_id, url) for search_query_id, url in visited_urls if search_query_id in self.search_queries
+        ]
+        self.clicks.extend(appended)
+        return list({search_query_id for search_query_id, _ in appended})
+
+
+class WriteBehindBufferTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.repo = FakeRepository()
+        # no background flushes unless a test asks for them
+        patcher = patch("mlapi.ingestion.INGEST_FLUSH_INTERVAL", 3600)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_buffer(self) -> WriteBehindBuffer:
+        with patch("mlapi.ingestion.atexit") as mock_atexit:
+            write_buffer = WriteBehindBuffer(self.repo)  # type: ignore[arg-type]
+        mock_atexit.register.assert_called_once_with(write_buffer.try_flush)
+        return write_buffer
+
+    def test_flushes_once_enough_events_are_buffered(self):
+        with patch("mlapi.ingestion.INGEST_FLUSH_SIZE", 3):
+            write_buffer = self.make_buffer()
+            write_buffer.add_search_queries([(1, "pizza", [])])
+            write_buffer.add_visited_urls([(1, "http://pizza.com/")])
+            self.assertFalse(self.repo.written.wait(0.1))
+
+            write_buffer.add_search_queries([(1, "pasta", [])])
+            self.assertTrue(self.repo.written.wait(1))
+
+        self.assertEqual(sorted(query for _, query, _ in self.repo.search_queries.values()), ["pasta", "pizza"])
+
+    def test_flushes_every_interval(self):
+        with patch("mlapi.ingestion.INGEST_FLUSH_INTERVAL", 0.05):
+            write_buffer = self.make_buffer()
+            (search_query_id,) = write_buffer.add_search_queries([(1, "pizza", [])])
+            self.assertTrue(self.repo.written.wait(1))
+
+        self.assertEqual(self.repo.search_queries, {search_query_id: (1, "pizza", [])})
+
+    def test_failed_flush_is_replayed_under_the_same_ids(self):
+        write_buffer = self.make_buffer()
+        search_query_ids = write_buffer.add_search_queries([(1, "pizza", []), (2, "pasta", [])])
+        write_buffer.add_visited_urls([(search_query_ids[0], "http://pizza.com/")])
+
+        self.repo.failures.append(psycopg2.OperationalError("connection lost"))
+        with self.assertLogs("mlapi.ingestion", "ERROR"):
+            write_buffer.try_flush()
+        self.assertEqual(self.repo.search_queries, {})
+
+        write_buffer.try_flush()
+        # a replay of rows that were already written is a no-op
+        write_buffer.add_search_queries([(1, "pizza", [])], search_query_ids[:1])
+        write_buffer.try_flush()
+
+        self.assertEqual(
+            self.repo.search_queries, {search_query_ids[0]: (1, "pizza", []), search_query_ids[1]: (2, "pasta", [])}
+        )
+        self.assertEqual(self.repo.clicks, [(search_query_ids[0], "http://pizza.com/")])
+
+    def test_unwritable_rows_are_dropped(self):
+        write_buffer = self.make_buffer()
+        write_buffer.add_search_queries([(1, "pizza", []), (2, "pasta", [])])
+
+        self.repo.failures.append(psycopg2.IntegrityError("unknown user profile"))
+        self.repo.failures.append(psycopg2.IntegrityError("unknown user profile"))
+        with self.assertLogs("mlapi.ingestion", "WARNING") as logs:
+            write_buffer.try_flush()
+
+        self.assertEqual(list(self.repo.search_queries.values()), [(2, "pasta", [])])
+        self.assertIn("Dropping search query", logs.output[0])
+
+    def test_visited_urls_of_missing_search_queries_are_dropped_with_a_trace(self):
+        write_buffer = self.make_buffer()
+        write_buffer.add_visited_urls([(42, "http://pizza.com/")])
+
+        with patch("mlapi.ingestion.INGEST_MAX_ATTEMPTS", 2):
+            write_buffer.try_flush()
+            self.assertEqual(len(write_buffer.visited_urls), 1)
+            with self.assertLogs("mlapi.ingestion", "WARNING") as logs:
+                write_buffer.try_flush()
+
+        self.assertEqual(write_buffer.visited_urls, [])
+        self.assertIn("(42, 'http://pizza.com/')", logs.output[0])
+
+    def test_exit_drains_the_buffer(self):
+        write_buffer = self.make_buffer()
+        (search_query_id,) = write_buffer.add_search_queries([(1, "pizza", [])])
+        write_buffer.add_visited_urls([(search_query_id, "http://pizza.com/")])
+
+        # what runs at exit
+        write_buffer.try_flush()
+
+        self.assertEqual(self.repo.search_queries, {search_query_id: (1, "pizza", [])})
+        self.assertEqual(self.repo.clicks, [(search_query_id, "http://pizza.com/")])
+        self.assertEqual((write_buffer.search_queries, write_buffer.visited_urls), ([], []))
+
+    def test_only_reserved_ids_are_accepted(self):
+        write_buffer = self.make_buffer()
+        self.repo.reserve_search_query_ids(5)
+
+        self.assertTrue(write_buffer.is_reserved(3))
+        self.assertTrue(write_buffer.is_reserved(5))
+        self.assertFalse(write_buffer.is_reserved(6))
+        self.assertFalse(write_buffer.is_reserved(0))
+        # ids up to the last one seen are checked without reading the sequence again
+        self.assertEqual(self.repo.last_id_reads, 2)
+
+        # reserved by another process meanwhile
+        self.repo.reserve_search_query_ids(5)
+        self.assertTrue(write_buffer.is_reserved(6))
@@ -0,0 +1,103 @@
+import os
+import unittest
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import scipy.sparse
+from pipeline.constants import PIPELINE_CURSOR_KEY, RECOMMENDER_KEY
+from pipeline.main import run
+from pipeline.workflows import top_k_neighbors
+from sklearn.preprocessing import normalize
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class SharedModulesTestCase(unittest.TestCase):
+    """The pipeline writes what the search API reads with its own copy of these modules."""
+
+    def assertIdenticalCopies(self, name: str) -> None:
+        copies = []
+        for path in [("search-analytics", "pipeline", name), ("search", "api", name)]:
+            with open(os.path.join(REPO_ROOT, *path), "rb") as f:
+                copies.append(f.read())
+        self.assertEqual(copies[0], copies[1], "%s differs between the pipeline and the search API" % name)
+
+    def test_model_codec_copies_are_identical(self):
+        self.assertIdenticalCopies("model_codec.py")
+
+    def test_lsh_copies_are_identical(self):
+        self.assertIdenticalCopies("lsh.py")
+
+
+class TopKNeighborsTestCase(unittest.TestCase):
+    def test_matches_dense_top_k(self):
+        rng = np.random.default_rng(0)
+        query_matrix = normalize(scipy.sparse.random(40, 25, density=0.2, format="csr", random_state=rng))
+        k, threshold = 5, 0.1
+
+        # a few rows per block, so the rows are split across many of them
+        with patch("pipeline.workflows.NEIGHBORS_BLOCK_CELLS", 3 * 40):
+            neighbors = top_k_neighbors(query_matrix, k, threshold)
+
+        sims = (query_matrix @ query_matrix.T).toarray()
+        np.fill_diagonal(sims, 0)
+        expected = np.zeros_like(sims)
+        for row, row_sims in enumerate(sims):
+            top = np.argsort(-row_sims)[:k]
+            top = top[(row_sims[top] >= threshold) & (row_sims[top] > 0)]
+            expected[row, top] = row_sims[top]
+
+        np.testing.assert_allclose(neighbors.toarray(), expected, rtol=1e-6)
+        self.assertTrue(neighbors.nnz > 0)
+
+    def test_single_query_has_no_neighbors(self):
+        neighbors = top_k_neighbors(scipy.sparse.csr_matrix(np.ones((1, 3)) / np.sqrt(3)), 5, 0.1)
+
+        self.assertEqual((neighbors.shape, neighbors.nnz), ((1, 1), 0))
+
+
+class RunTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.redis = MagicMock()
+        self.redis.get.return_value = "5"
+        patcher = patch("pipeline.main.redis_instance", self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def written(self, key: str) -> List[str]:
+        return [call.args[1] for call in self.redis.set.call_args_list if call.args[0] == key]
+
+    def test_failed_user_is_skipped_and_holds_the_cursor(self):
+        batches = [([(1, "a"), (2, "b")], 7), ([(3, "bad"), (4, "d")], 9), ([(5, "e")], 11)]
+
+        def train_user(search_queries: str) -> Optional[bytes]:
+            if search_queries == "bad":
+                raise ValueError("unusable history")
+            return search_queries.encode()
+
+        with patch("pipeline.main.changed_batches", return_value=iter(batches)):
+            with patch("pipeline.main.train_user", side_effect=train_user):
+                with self.assertLogs("pipeline.main", "ERROR") as logs:
+                    run(None)
+
+        self.assertIn("user profile 3", logs.output[0])
+        for user_profile_id, model in [(1, b"a"), (2, b"b"), (4, b"d"), (5, b"e")]:
+            self.assertEqual(self.written(RECOMMENDER_KEY % user_profile_id), [model])
+        self.assertEqual(self.written(RECOMMENDER_KEY % 3), [])
+        # the next run starts again from the batch of the failed user
+        self.assertEqual(self.written(PIPELINE_CURSOR_KEY), [7])
+
+    def test_broken_pool_ends_the_run(self):
+        future: "Future[Optional[bytes]]" = Future()
+        future.set_exception(BrokenProcessPool("a training process died"))
+        executor = MagicMock()
+        executor.submit.return_value = future
+
+        with patch("pipeline.main.changed_batches", return_value=iter([([(1, "a")], 7)])):
+            with self.assertRaises(BrokenProcessPool):
+                run(executor)
+
+        self.assertEqual(self.written(PIPELINE_CURSOR_KEY), [])
@@ -1,4 +1,7 @@
-from typing import Any, Dict, List
+import heapq
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
 
 from .constants import K
 
@@ -9,3 +12,97 @@ def okapi_bm25(doc_content: str, keyword_aggragate_data: List[Dict[str, Any]], a
         mapping["idf"] * mapping["f"] * (K + 1) / (mapping["f"] + K * (0.25 + 0.75 * doc_len / avgdl))
         for mapping in keyword_aggragate_data
     )
+
+
+def bm25_inputs(
+    documents: Dict[str, Dict[str, Any]], keywords: List[str], keyword_stats: Dict[str, Dict[str, Any]]
+) -> Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """Lays the candidate set out as a docs x terms frequency matrix, a doc length vector and an idf vector."""
+    doc_ids = list(documents)
+    row_of = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+
+    tf_matrix = np.zeros((len(doc_ids), len(keywords)))
+    idf = np.zeros(len(keywords))
+    for col, keyword in enumerate(keywords):
+        stats = keyword_stats[keyword]
+        idf[col] = stats["idf"] or 0.0
+        for doc_id, freq in stats["freqs"].items():
+            if doc_id in row_of:
+                tf_matrix[row_of[doc_id], col] = freq
+
+    doc_lengths = np.fromiter(
+        (doc["doc_length"] if "doc_length" in doc else len(doc["content"]) for doc in documents.values()),
+        dtype=np.float64,
+        count=len(doc_ids),
+    )
+
+    return doc_ids, tf_matrix, doc_lengths, idf
+
+
+def okapi_bm25_batch(tf_matrix: np.ndarray, doc_lengths: np.ndarray, idf: np.ndarray, avgdl: float) -> np.ndarray:
+    """Scores every candidate in one pass; row `i` matches `okapi_bm25` for document `i`."""
+    norm = K * (0.25 + 0.75 * doc_lengths / avgdl)
+    return (tf_matrix * (K + 1) / (tf_matrix + norm[:, np.newaxis])) @ idf
+
+
+def top_k_bm25(
+    documents: Dict[str, Dict[str, Any]],
+    keywords: List[str],
+    keyword_stats: Dict[str, Dict[str, Any]],
+    avgdl: float,
+    k: int,
+) -> List[Tuple[str, float]]:
+    """Returns the `k` best `(doc_id, score)` pairs, best first, using MaxScore pruning.
+
+    Terms are visited from the highest score upper bound down. A document first met in the posting list of
+    term `i` can only contain terms `0..i`, so once the summed upper bounds of those terms cannot beat the
+    current k-th score, neither that document nor any later one can enter the heap.
+    """
+    terms = [(keyword_stats[w]["freqs"], keyword_stats[w]["idf"] or 0.0) for w in keywords]
+    if not terms or not documents or k <= 0:
+        return []
+
+    def doc_norm(doc: Dict[str, Any]) -> float:
+        doc_len = doc["doc_length"] if "doc_length" in doc else len(doc["content"])
+        return K * (0.25 + 0.75 * doc_len / avgdl)
+
+    min_norm = min(doc_norm(doc) for doc in documents.values())
+    upper_bounds = [
+        max(0.0, idf * max(freqs.values()) * (K + 1) / (max(freqs.values()) + min_norm)) if freqs else 0.0
+        for freqs, idf in terms
+    ]
+    order = sorted(range(len(terms)), key=lambda t: upper_bounds[t])
+    prefix_bounds = np.cumsum([upper_bounds[t] for t in order]).tolist()
+
+    heap: List[Tuple[float, str]] = []
+    seen = set()
+    for i in range(len(order) - 1, -1, -1):
+        if len(heap) == k and prefix_bounds[i] <= heap[0][0]:
+            break
+
+        freqs, idf = terms[order[i]]
+        for doc_id, freq in freqs.items():
+            if doc_id in seen or doc_id not in documents:
+                continue
+            seen.add(doc_id)
+
+            if len(heap) == k and prefix_bounds[i] <= heap[0][0]:
+                break
+
+            norm = doc_norm(documents[doc_id])
+            score = idf * freq * (K + 1) / (freq + norm)
+            for j in range(i - 1, -1, -1):
+                if len(heap) == k and score + prefix_bounds[j] <= heap[0][0]:
+                    break
+
+                other_freqs, other_idf = terms[order[j]]
+                other_freq = other_freqs.get(doc_id, 0)
+                if other_freq:
+                    score += other_idf * other_freq * (K + 1) / (other_freq + norm)
+            else:
+                if len(heap) < k:
+                    heapq.heappush(heap, (score, doc_id))
+                elif score > heap[0][0]:
+                    heapq.heapreplace(heap, (score, doc_id))
+
+    return [(doc_id, score) for score, doc_id in sorted(heap, reverse=True)]
@@ -0,0 +1,21 @@
+"""Text analysis shared by indexing and querying.
+
+Kept identical in `search/crawler/analysis.py` and `search/api/analysis.py`: pages are indexed, by the crawler or
+the memory-mapped index, under the terms `tokenize` returns, so queries must be split the same way to find them.
+"""
+
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def analyze(text: str) -> Tuple[Dict[str, int], int]:
+    """Returns the term frequencies and the length, in tokens, of `text`."""
+    tokens = tokenize(text)
+    return dict(Counter(tokens)), len(tokens)
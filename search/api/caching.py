@@ -0,0 +1,119 @@
+import json
+import math
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple, cast
+
+import redis
+
+from .constants import INDEX_GENERATION_REFRESH_PERIOD, RESULT_CACHE_LRU_SIZE, RESULT_CACHE_TTL
+
+# bumped by the crawler whenever it indexes or deletes pages, see `crawler/corpus_stats.py`
+GENERATION_KEY = "corpus:generation"
+
+
+class LRUCache:
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self.entries[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class TTLCache(LRUCache):
+    def __init__(self, max_size: int, ttl: float) -> None:
+        super().__init__(max_size)
+        self.ttl = ttl
+
+    def get(self, key: Hashable) -> Any:
+        entry = super().get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        return value if expires_at > time.monotonic() else None
+
+    def set(self, key: Hashable, value: Any) -> None:
+        super().set(key, (time.monotonic() + self.ttl, value))
+
+
+def encode_result(value: Any) -> bytes:
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode())
+
+
+def decode_result(blob: bytes) -> Any:
+    return json.loads(zlib.decompress(blob))
+
+
+class ResultCache:
+    """Query result cache: a per-process LRU in front of Redis.
+
+    Entries are keyed by the index generation, so everything cached before the crawler last changed the
+    index is never served again and simply expires from Redis after `RESULT_CACHE_TTL` seconds.
+    """
+
+    def __init__(self, redis_instance: redis.Redis, generation_redis_instance: redis.Redis) -> None:
+        self.redis = redis_instance
+        self.generation_redis = generation_redis_instance
+        self.local = LRUCache(RESULT_CACHE_LRU_SIZE)
+        self._generation = 0
+        self._generation_read_at = -math.inf
+
+    def generation(self) -> int:
+        if time.monotonic() - self._generation_read_at > INDEX_GENERATION_REFRESH_PERIOD:
+            try:
+                self._generation = int(cast(Optional[str], self.generation_redis.get(GENERATION_KEY)) or 0)
+            except redis.RedisError:
+                pass
+            self._generation_read_at = time.monotonic()
+        return self._generation
+
+    def _entry_keys(self, key: str) -> Tuple[Tuple[int, str], str]:
+        generation = self.generation()
+        return (generation, key), "results:%d:%s" % (generation, key)
+
+    def get(self, key: str) -> Optional[Any]:
+        local_key, redis_key = self._entry_keys(key)
+        entry = self.local.get(local_key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                return value
+
+        try:
+            with self.redis.pipeline(transaction=False) as pipe:
+                pipe.get(redis_key)
+                pipe.ttl(redis_key)
+                blob, ttl = pipe.execute()
+        except redis.RedisError:
+            return None
+        if blob is None:
+            return None
+
+        value = decode_result(blob)
+        self.local.set(local_key, (time.monotonic() + max(ttl, 0), value))
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        local_key, redis_key = self._entry_keys(key)
+        self.local.set(local_key, (time.monotonic() + RESULT_CACHE_TTL, value))
+        try:
+            self.redis.set(redis_key, encode_result(value), ex=RESULT_CACHE_TTL)
+        except redis.RedisError:
+            pass
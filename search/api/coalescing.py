@@ -0,0 +1,86 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import redis
+
+from .constants import COALESCE_LOCK_TTL, COALESCE_POLL_INTERVAL, COALESCE_WAIT_TIMEOUT
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent computations of the same key.
+
+    Within a process, the first caller of a key becomes the leader and the others wait for its result.
+    With a Redis instance, leaders of different workers also take a short Redis lock; a worker that finds
+    the lock taken polls `lookup` (normally the shared result cache) until the other worker's result shows
+    up, and only computes it itself if it does not within `COALESCE_WAIT_TIMEOUT` seconds.
+    """
+
+    def __init__(self, redis_instance: Optional[redis.Redis] = None) -> None:
+        self.redis = redis_instance
+        self.lock = threading.Lock()
+        self.calls: Dict[str, _Call] = {}
+
+    def do(self, key: str, compute: Callable[[], Any], lookup: Callable[[], Any] = lambda: None) -> Any:
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if call is None:
+                call = self.calls[key] = _Call()
+
+        if not is_leader:
+            if call.done.wait(COALESCE_WAIT_TIMEOUT):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            return compute()
+
+        try:
+            call.result = self._do_across_workers(key, compute, lookup)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def _do_across_workers(self, key: str, compute: Callable[[], Any], lookup: Callable[[], Any]) -> Any:
+        if self.redis is None:
+            return compute()
+
+        lock = self.redis.lock("single_flight:%s" % key, timeout=COALESCE_LOCK_TTL)
+        try:
+            acquired = lock.acquire(blocking=False)
+        except redis.RedisError:
+            return compute()
+
+        if not acquired:
+            deadline = time.monotonic() + COALESCE_WAIT_TIMEOUT
+            while time.monotonic() < deadline:
+                time.sleep(COALESCE_POLL_INTERVAL)
+                result = lookup()
+                if result is not None:
+                    return result
+                try:
+                    if not lock.locked():
+                        break
+                except redis.RedisError:
+                    break
+            return compute()
+
+        try:
+            return compute()
+        finally:
+            try:
+                lock.release()
+            except redis.RedisError:
+                pass
@@ -1,11 +1,47 @@
 import os
 
 MLAPI_BASE_URL = os.getenv("MLAPI_BASE_URL")
+MLAPI_POOL_SIZE = 32
+MLAPI_CONNECT_TIMEOUT = 0.5
+MLAPI_READ_TIMEOUT = 1.0
+# seconds a search waits for its recommendations and search query id before answering without them
+PERSONALIZATION_TIMEOUT = 0.3
+# search query ids reserved from the ML API per round trip
+MLAPI_ID_BLOCK_SIZE = 100
+PROFILE_ID_CACHE_SIZE = 100_000
+PROFILE_ID_CACHE_TTL = 3600
+
+SEARCH_FANOUT_WORKERS = 32
+
+RECOMMENDER_KEY = "recommender:%s"
+MODEL_CACHE_SIZE = 10_000
+MODEL_CACHE_TTL = 300
+GLOBAL_RECOMMENDER_KEY = "recommender:global"
+GLOBAL_RECOMMENDER_VERSION_KEY = "recommender:global:version"
+GLOBAL_INDEX_REFRESH_PERIOD = 60
 
 K = 1.6
 
+INV_IDX_BACKEND = os.getenv("INV_IDX_BACKEND", "elasticsearch")
+MMAP_INDEX_PATH = os.getenv("MMAP_INDEX_PATH", "web_pages.idx")
+
 ES_CONN_STR = os.getenv("ES_CONN_STR", "https://localhost:9200")
 ES_INDEX = "web_pages"
 ES_RESULTS_SIZE = 1000
+ES_MGET_BATCH_SIZE = 500
+
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_PAGE_SIZE = 100
+SNIPPET_LENGTH = 160
 
 REDIS_RESULTS_CONN_STR = os.getenv("REDIS_RESULTS_CONN_STR", "redis://localhost:6379/0")
+REDIS_CORPUS_CONN_STR = os.getenv("REDIS_CORPUS_CONN_STR", "redis://localhost:6379/2")
+RESULT_CACHE_TTL = 600
+RESULT_CACHE_LRU_SIZE = 512
+INDEX_GENERATION_REFRESH_PERIOD = 5
+
+COALESCE_LOCK_TTL = 10
+COALESCE_WAIT_TIMEOUT = 5
+COALESCE_POLL_INTERVAL = 0.05
+CORPUS_STATS_REFRESH_PERIOD = 60
+CORPUS_STATS_MAX_TERMS = 100_000
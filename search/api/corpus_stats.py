@@ -0,0 +1,62 @@
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, cast
+
+import redis
+
+from .constants import CORPUS_STATS_MAX_TERMS, CORPUS_STATS_REFRESH_PERIOD
+
+# maintained by the crawler, see `crawler/corpus_stats.py`
+STATS_KEY = "corpus:stats"
+DOC_FREQS_KEY = "corpus:df"
+
+
+class CorpusStatsCache:
+    """In-process view of the corpus statistics, refreshed every `CORPUS_STATS_REFRESH_PERIOD` seconds."""
+
+    def __init__(self, redis_instance: redis.Redis) -> None:
+        self.redis = redis_instance
+        self.lock = threading.Lock()
+        self.refreshed_at = -math.inf
+        self.num_docs = 0
+        self.total_length = 0
+        self.doc_freqs: Dict[str, int] = {}
+
+    def refresh(self) -> None:
+        stats = cast(Dict[str, str], self.redis.hgetall(STATS_KEY))
+        with self.lock:
+            self.num_docs = int(stats.get("num_docs", 0))
+            self.total_length = int(stats.get("total_length", 0))
+            self.doc_freqs = {}
+            self.refreshed_at = time.monotonic()
+
+    def get(self, keywords: List[str]) -> Tuple[int, float, Dict[str, int]]:
+        """Returns the number of documents, the average document length and the document frequencies.
+
+        Zero documents are reported while the statistics are unavailable.
+        """
+        try:
+            return self._get(keywords)
+        except redis.RedisError:
+            return 0, 0, {}
+
+    def _get(self, keywords: List[str]) -> Tuple[int, float, Dict[str, int]]:
+        if time.monotonic() - self.refreshed_at > CORPUS_STATS_REFRESH_PERIOD:
+            self.refresh()
+
+        with self.lock:
+            num_docs, total_length, doc_freqs = self.num_docs, self.total_length, self.doc_freqs
+            missing = [kw for kw in dict.fromkeys(keywords) if kw not in doc_freqs]
+
+        if missing:
+            stored = cast(List[Optional[str]], self.redis.hmget(DOC_FREQS_KEY, missing))
+            fetched = {kw: int(df or 0) for kw, df in zip(missing, stored)}
+            with self.lock:
+                if len(self.doc_freqs) + len(fetched) > CORPUS_STATS_MAX_TERMS:
+                    self.doc_freqs = {}
+                self.doc_freqs.update(fetched)
+            doc_freqs = {**doc_freqs, **fetched}
+
+        avgdl = total_length / num_docs if num_docs > 0 else 0
+        return num_docs, avgdl, {kw: doc_freqs[kw] for kw in keywords}
@@ -0,0 +1,199 @@
+"""Random-projection LSH index over the queries of every user, for recommendations that need no user history.
+
+Kept identical in `search-analytics/pipeline/lsh.py` and `search/api/lsh.py`: the pipeline builds the index,
+the search API queries it, and both must hash and project queries the same way.
+
+Queries are hashed into `n_features` dimensions (so there is no vocabulary to ship) and projected onto
+`n_tables * n_bits` random +-1 directions, regenerated from `seed` on both sides. The signs of each group of
+`n_bits` projections are the query's bucket in one table; queries in the same bucket, or in one a single
+bit away, in any table are candidates, re-ranked by their exact cosine similarity. The URLs clicked for the
+most similar queries are weighted by that similarity and by how often they were clicked.
+"""
+
+import math
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import scipy.sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.utils import murmurhash3_32
+
+N_FEATURES = 2**16
+N_TABLES = 8
+# buckets per table are sized for about `BUCKET_SIZE` queries each, within `MIN_BITS` to `MAX_BITS` bits
+BUCKET_SIZE = 8
+MIN_BITS = 8
+MAX_BITS = 16
+SEED = 20
+# rows hashed and projected at a time while building
+BUILD_BLOCK_ROWS = 10_000
+# similar queries whose clicks make up a recommendation
+N_NEIGHBORS = 20
+MIN_SIMILARITY = 0.2
+
+# the analysis of `HashingVectorizer`, and of the `TfidfVectorizer` of the per-user models
+TOKEN_RE = re.compile(r"(?u)\b\w\w+\b")
+
+
+def make_vectorizer(params: Dict[str, int]) -> HashingVectorizer:
+    return HashingVectorizer(n_features=params["n_features"], alternate_sign=False, norm="l2")
+
+
+def hash_query(query: str, n_features: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The row `make_vectorizer` makes of `query`, as sorted feature indices and values, without the overhead
+    of building a sparse matrix for one row.
+    """
+    counts: Dict[int, int] = {}
+    for token in TOKEN_RE.findall(query.lower()):
+        feature = abs(murmurhash3_32(token, seed=0)) % n_features
+        counts[feature] = counts.get(feature, 0) + 1
+
+    indices = np.array(sorted(counts), dtype=np.int32)
+    values = np.array([counts[feature] for feature in indices.tolist()], dtype=np.float32)
+    norm = np.linalg.norm(values)
+    return indices, values / norm if norm > 0 else values
+
+
+def make_projection(params: Dict[str, int]) -> np.ndarray:
+    rng = np.random.default_rng(params["seed"])
+    return rng.choice(
+        np.array([-1, 1], dtype=np.int8), size=(params["n_features"], params["n_tables"] * params["n_bits"])
+    )
+
+
+def signatures(
+    indices: np.ndarray, data: np.ndarray, indptr: np.ndarray, projection: np.ndarray, params: Dict[str, int]
+) -> np.ndarray:
+    """Returns the bucket of each row of the CSR arrays in each table, shaped `(n_tables, rows)`."""
+    n_tables, n_bits = params["n_tables"], params["n_bits"]
+    # only the rows of `projection` for the features present, rather than a sparse-dense product that would
+    # convert all of it
+    weighted = projection[indices] * data[:, None]
+    projected = np.zeros((len(indptr) - 1, projection.shape[1]), dtype=np.float32)
+    non_empty = np.diff(indptr) > 0
+    if weighted.size:
+        projected[non_empty] = np.add.reduceat(weighted, indptr[:-1][non_empty], axis=0)
+
+    bits = projected > 0
+    weights = np.left_shift(np.uint32(1), np.arange(n_bits, dtype=np.uint32))
+    return (bits.reshape(-1, n_tables, n_bits) * weights).sum(axis=2, dtype=np.uint32).T
+
+
+def row_positions(indptr: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the positions in the CSR `indices`/`data` of the entries of `rows`, and the row of each."""
+    lengths = indptr[rows + 1] - indptr[rows]
+    ends = np.cumsum(lengths)
+    positions = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths - indptr[rows], lengths)
+    return positions, np.repeat(np.arange(len(rows)), lengths)
+
+
+class LSHIndex:
+    def __init__(
+        self,
+        params: Dict[str, int],
+        query_matrix: scipy.sparse.csr_matrix,
+        sorted_signatures: np.ndarray,
+        order: np.ndarray,
+        clicks: scipy.sparse.csr_matrix,
+        urls: List[str],
+    ) -> None:
+        self.params = params
+        self.projection = make_projection(params)
+        self.query_matrix = query_matrix
+        self.sorted_signatures = sorted_signatures
+        self.order = order
+        self.clicks = clicks
+        self.urls = urls
+
+    @classmethod
+    def build(
+        cls,
+        queries: List[str],
+        clicks: scipy.sparse.csr_matrix,
+        urls: List[str],
+        n_features: int = N_FEATURES,
+        n_tables: int = N_TABLES,
+        n_bits: Optional[int] = None,
+        seed: int = SEED,
+    ) -> "LSHIndex":
+        """`clicks[i, j]` is how often `urls[j]` was visited after searching `queries[i]`."""
+        if n_bits is None:
+            n_bits = min(max(math.ceil(math.log2(max(len(queries) / BUCKET_SIZE, 1))), MIN_BITS), MAX_BITS)
+        params = {"n_features": n_features, "n_tables": n_tables, "n_bits": n_bits, "seed": seed}
+        query_matrix = make_vectorizer(params).transform(queries).astype(np.float32).tocsr()
+        projection = make_projection(params)
+        blocks = [np.empty((n_tables, 0), dtype=np.uint32)]
+        for start in range(0, query_matrix.shape[0], BUILD_BLOCK_ROWS):
+            end = start + BUILD_BLOCK_ROWS
+            block = query_matrix[start:end]
+            blocks.append(signatures(block.indices, block.data, block.indptr, projection, params))
+        query_signatures = np.hstack(blocks)
+        order = np.argsort(query_signatures, axis=1, kind="stable").astype(np.int32)
+        return cls(params, query_matrix, np.take_along_axis(query_signatures, order, axis=1), order, clicks, urls)
+
+    @classmethod
+    def from_fields(cls, fields: Dict[str, Any]) -> "LSHIndex":
+        return cls(
+            fields["params"],
+            fields["query_matrix"],
+            fields["sorted_signatures"],
+            fields["order"],
+            fields["clicks"],
+            fields["urls"],
+        )
+
+    def fields(self) -> Dict[str, Any]:
+        """What `from_fields` takes, in the shape `model_codec.encode` stores."""
+        return {
+            "params": self.params,
+            "query_matrix": self.query_matrix,
+            "sorted_signatures": self.sorted_signatures,
+            "order": self.order,
+            "clicks": self.clicks,
+            "urls": self.urls,
+        }
+
+    def recommend(self, query: str, top_n: int = 5) -> List[str]:
+        indices, values = hash_query(query, self.params["n_features"])
+        if not len(indices) or not len(self.urls):
+            return []
+
+        # the query's bucket and the ones a bit flip away from it
+        bits = np.left_shift(np.uint32(1), np.arange(self.params["n_bits"], dtype=np.uint32))
+        flips = np.concatenate([np.zeros(1, dtype=np.uint32), bits])
+        query_signatures = signatures(indices, values, np.array([0, len(indices)]), self.projection, self.params)
+        hits = [np.empty(0, dtype=np.int32)]
+        for table, signature in enumerate(query_signatures[:, 0]):
+            probes = np.bitwise_xor(signature, flips)
+            buckets = self.sorted_signatures[table]
+            los, his = np.searchsorted(buckets, probes, "left"), np.searchsorted(buckets, probes, "right")
+            hits.extend(self.order[table][lo:hi] for lo, hi in zip(los, his) if hi > lo)
+        candidates = np.unique(np.concatenate(hits))
+        if not len(candidates):
+            return []
+
+        # cosine similarities, straight from the CSR arrays: scipy's row indexing costs more than the math
+        positions, rows = row_positions(self.query_matrix.indptr, candidates)
+        features = self.query_matrix.indices[positions]
+        # `indices` is sorted: where each feature of the candidates is in the query, if at all
+        in_query = np.minimum(np.searchsorted(indices, features), len(indices) - 1)
+        matches = indices[in_query] == features
+        similarities = np.bincount(
+            rows[matches],
+            weights=self.query_matrix.data[positions][matches] * values[in_query[matches]],
+            minlength=len(candidates),
+        )
+
+        if len(candidates) > N_NEIGHBORS:
+            top = np.argpartition(-similarities, N_NEIGHBORS - 1)[:N_NEIGHBORS]
+            candidates, similarities = candidates[top], similarities[top]
+        similar = similarities >= MIN_SIMILARITY
+        if not similar.any():
+            return []
+
+        positions, rows = row_positions(self.clicks.indptr, candidates[similar])
+        url_ids, url_rows = np.unique(self.clicks.indices[positions], return_inverse=True)
+        scores = np.bincount(url_rows, weights=self.clicks.data[positions] * similarities[similar][rows])
+        top = np.argsort(-scores, kind="stable")[:top_n]
+        return [self.urls[url_ids[idx]] for idx in top if scores[idx] > 0]
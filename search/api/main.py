@@ -1,85 +1,237 @@
-import re
-from typing import Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import redis
 import requests
 from flask import Flask, Response, jsonify, request
 
-from .algorithms import okapi_bm25
-from .constants import MLAPI_BASE_URL, REDIS_RESULTS_CONN_STR
+from .algorithms import bm25_inputs, okapi_bm25_batch, top_k_bm25
+from .analysis import tokenize
+from .caching import ResultCache
+from .coalescing import SingleFlight
+from .constants import (
+    PERSONALIZATION_TIMEOUT,
+    REDIS_CORPUS_CONN_STR,
+    REDIS_RESULTS_CONN_STR,
+    SEARCH_FANOUT_WORKERS,
+    SEARCH_MAX_PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
+)
+from .corpus_stats import CorpusStatsCache
 from .custom_exc import DocumentRetrievalError
-from .repository import InvIdxDBRepository
-from .service_utils import get_recommendations
+from .mlapi_client import MLAPIClient
+from .recommender import GlobalIndexCache, ModelCache
+from .repository import get_inv_idx_repository
+from .service_utils import get_recommendations, make_snippet
 
 app = Flask(__name__)
 
 redis_instance = redis.Redis.from_url(REDIS_RESULTS_CONN_STR, decode_responses=True)
-repo = InvIdxDBRepository()
+binary_redis_instance = redis.Redis.from_url(REDIS_RESULTS_CONN_STR)
+corpus_redis_instance = redis.Redis.from_url(REDIS_CORPUS_CONN_STR, decode_responses=True)
+result_cache = ResultCache(binary_redis_instance, corpus_redis_instance)
+corpus_stats = CorpusStatsCache(corpus_redis_instance)
+repo = get_inv_idx_repository(corpus_stats)
+single_flight = SingleFlight(redis_instance)
+model_cache = ModelCache(binary_redis_instance)
+global_index_cache = GlobalIndexCache(binary_redis_instance)
+mlapi = MLAPIClient()
+executor = ThreadPoolExecutor(max_workers=SEARCH_FANOUT_WORKERS)
+
+
+def personalize(client_ip: str, query: str) -> Tuple[Optional[int], List[str]]:
+    """Runs the per-user part of a search next to the retrieval: profile lookup, query logging, recommendations.
+
+    Returns the id the search query is logged under, if any, and the recommended URLs. The id is reserved up
+    front, so the query itself is logged off the response path. Users without a model, or whose history has
+    nothing on `query`, get recommendations from the queries of every user.
+    """
+    search_query_id = None
+    model = None
+    try:
+        user_profile_id = mlapi.get_user_profile_id(client_ip)
+    except requests.RequestException:
+        user_profile_id = 0
+
+    if user_profile_id:
+        try:
+            search_query_id = mlapi.reserve_search_query_id()
+        except requests.RequestException:
+            search_query_id = None
+        if search_query_id is not None:
+            executor.submit(mlapi.log_search_query, search_query_id, user_profile_id, query)
+        try:
+            model = model_cache.get(user_profile_id)
+        except redis.RedisError:
+            model = None
+
+    recs = get_recommendations(model, query) if model is not None else []
+    if not recs:
+        global_index = global_index_cache.get()
+        if global_index is not None:
+            recs = get_recommendations(global_index, query)
+
+    return search_query_id, recs
+
+
+def rank_documents(keywords: List[str], k: Optional[int]) -> List[Dict[str, Any]]:
+    """Retrieves and ranks the documents for `keywords`; the part of a search shared by every user.
+
+    Only ids and scores are kept, bodies are fetched per page by `render_page`.
+    """
+    if not keywords:
+        return []
+
+    documents, avgdl, keyword_stats = repo.get_documents(keywords, with_content=False)
+    if not documents:
+        return []
+
+    scored: Iterable[Tuple[str, float]]
+    if k is None:
+        doc_ids, tf_matrix, doc_lengths, idf = bm25_inputs(documents, keywords, keyword_stats)
+        scored = zip(doc_ids, okapi_bm25_batch(tf_matrix, doc_lengths, idf, avgdl).tolist())
+    else:
+        scored = top_k_bm25(documents, keywords, keyword_stats, avgdl, k)
+
+    ranked_documents = [{"id": doc_id, "url": doc_id, "score": score} for doc_id, score in scored]
+    return sorted(ranked_documents, key=lambda doc: doc["score"], reverse=True)
+
+
+def rank_and_cache(keywords: List[str], k: Optional[int], cache_key: str) -> List[Dict[str, Any]]:
+    ranked_documents = rank_documents(keywords, k)
+    result_cache.set(cache_key, ranked_documents)
+    return ranked_documents
+
+
+def get_ranking(keywords: List[str], k: Optional[int], cache_key: str) -> List[Dict[str, Any]]:
+    # concurrent misses of the same query share one retrieval
+    ranked_documents = result_cache.get(cache_key)
+    if ranked_documents is None:
+        ranked_documents = single_flight.do(
+            cache_key, lambda: rank_and_cache(keywords, k, cache_key), lambda: result_cache.get(cache_key)
+        )
+    return ranked_documents
+
+
+def merge_recommendations(
+    ranked_documents: List[Dict[str, Any]], recommendations: List[str], k: Optional[int]
+) -> List[Dict[str, Any]]:
+    documents = {doc["id"]: dict(doc) for doc in ranked_documents}
+    for rec in recommendations:
+        documents[rec] = {"id": rec, "url": rec, "score": 1}
+    return sorted(documents.values(), key=lambda doc: doc["score"], reverse=True)[:k]
+
+
+def render_page(
+    ranked_documents: List[Dict[str, Any]], keywords: List[str], page: int, size: int, view: str
+) -> List[Dict[str, Any]]:
+    start, end = (page - 1) * size, page * size
+    page_documents = ranked_documents[start:end]
+    contents = repo.get_documents_content(doc["id"] for doc in page_documents)
+
+    rendered = []
+    for doc in page_documents:
+        if doc["id"] not in contents:
+            continue
+
+        entry = {**doc, "snippet": make_snippet(contents[doc["id"]], keywords)}
+        if view == "full":
+            entry["content"] = contents[doc["id"]]
+        rendered.append(entry)
+
+    return rendered
+
+
+def parse_positive_int(request_params: Dict[str, str], name: str, default: int) -> int:
+    value = int(request_params.get(name, default))
+    if value <= 0:
+        raise ValueError("%s must be positive" % name)
+    return value
+
+
+def parse_optional_positive_int(request_params: Dict[str, str], name: str) -> Optional[int]:
+    if name not in request_params:
+        return None
+    return parse_positive_int(request_params, name, 0)
 
 
 @app.route("/search", methods=["GET"])
 def search() -> Tuple[Response, int]:
     request_params = request.args.to_dict()
-    if not all(elem in ["q"] for elem in request_params.keys()):
+    if not all(elem in ["q", "k", "page", "size", "view"] for elem in request_params.keys()):
+        return jsonify({"error": "Malformed query params"}), 400
+
+    try:
+        k = parse_optional_positive_int(request_params, "k")
+        page = parse_positive_int(request_params, "page", 1)
+        size = parse_positive_int(request_params, "size", SEARCH_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "Malformed query params"}), 400
+
+    view = request_params.get("view", "compact")
+    if size > SEARCH_MAX_PAGE_SIZE or view not in ["compact", "full"]:
         return jsonify({"error": "Malformed query params"}), 400
 
     query = request_params["q"]
-    keywords = re.split(r"[ ,.!?;:$*()]+", query.lower())
+    # split the way the crawler and the mmap index split pages, or the terms would not match
+    keywords = tokenize(query)
     query_sorted = "+".join(sorted(keywords))
+    cache_key = query_sorted if k is None else "%s@%d" % (query_sorted, k)
+    page_cache_key = "page:%d:%d:%s:%s" % (page, size, view, cache_key)
 
-    cached_result = redis_instance.get(query_sorted)
-    if cached_result is not None:
-        return jsonify(cached_result), 200
-
-    response_dict = {}
+    response_dict: Dict[str, Any] = {"page": page, "size": size}
 
     client_ip = "".join(part.zfill(3) for part in request.environ.get("HTTP_X_REAL_IP", request.remote_addr).split("."))
-
-    user_profile_id = 0
-
-    resp = requests.get("%s//user_profiles/%s" % (MLAPI_BASE_URL, client_ip))
-    if resp.status_code == 404:
-        resp = requests.post("%s/user_profiles/" % MLAPI_BASE_URL, json={"ip": client_ip})
-        if resp.ok:
-            user_profile_id = resp.json()["id"]
-    elif resp.status_code == 200:
-        user_profile_id = resp.json()["user_profile"]["id"]
-
-    recommendations = None
-    if user_profile_id:
-        resp = requests.post(
-            "%s/search_queries/" % MLAPI_BASE_URL, json={"user_profile_id": user_profile_id, "query": query}
-        )
-
-        search_query_id = resp.json()["id"]
-        response_dict["search_query_id"] = search_query_id
-        model = redis_instance.get(user_profile_id)
-        recommendations = get_recommendations(model["dataframe"], model["vectorizer"], query)
+    # every search is logged and gets its recommendations, cached or not
+    personalization = executor.submit(personalize, client_ip, query)
+    personalization_deadline = time.monotonic() + PERSONALIZATION_TIMEOUT
 
     try:
-        documents, avgdl, keyword_stats = repo.get_documents(keywords)
+        # the cached ranking and pages are shared by every user: recommendations are merged in after the lookup
+        shared_pages = result_cache.get(page_cache_key)
+        ranked_documents = get_ranking(keywords, k, cache_key) if shared_pages is None else []
+
+        try:
+            search_query_id, recommendations = personalization.result(
+                timeout=max(personalization_deadline - time.monotonic(), 0)
+            )
+        except Exception:
+            # slow or failing ML API, `TimeoutError` included: answer without recommendations or a search query id
+            search_query_id, recommendations = None, []
+
+        if recommendations:
+            if shared_pages is not None:
+                ranked_documents = get_ranking(keywords, k, cache_key)
+            ranked_documents = merge_recommendations(ranked_documents, recommendations, k)
+            response_dict["pages"] = render_page(ranked_documents, keywords, page, size, view)
+        elif shared_pages is None:
+            response_dict["pages"] = render_page(ranked_documents, keywords, page, size, view)
+            result_cache.set(page_cache_key, response_dict["pages"])
+        else:
+            response_dict["pages"] = shared_pages
     except DocumentRetrievalError as e:
         return jsonify({"error": "Something went wrong while fetching results.", "details": str(e)}), 500
 
-    for doc in documents.values():
-        kw_aggregate_data = [
-            {"keyword": w, "f": keyword_stats[w]["freqs"].get(doc["id"], 0), "idf": keyword_stats[w]["idf"]}
-            for w in keywords
-        ]
-        doc["score"] = okapi_bm25(doc["content"], kw_aggregate_data, avgdl)
+    if search_query_id is not None:
+        response_dict["search_query_id"] = search_query_id
+
+    return jsonify(response_dict), 200
 
-    for rec in recommendations:
-        if rec in documents:
-            documents[rec]["score"] = 1
-        else:
-            try:
-                rec_content = repo.get_document_content(rec)
-                documents[rec] = {"id": rec, "content": rec_content, "url": rec, "score": 1}
-            except DocumentRetrievalError:
-                continue
 
-    ranked_documents = sorted(documents.values(), key=lambda doc: doc["score"], reverse=True)
-    response_dict["pages"] = ranked_documents
-    redis_instance.set(query_sorted, ranked_documents)
+@app.route("/documents", methods=["GET"])
+def get_document() -> Tuple[Response, int]:
+    """Full body of a single search result, for clients that only fetched the snippet."""
+    request_params = request.args.to_dict()
+    if list(request_params.keys()) != ["url"]:
+        return jsonify({"error": "Malformed query params"}), 400
+
+    url = request_params["url"]
+    try:
+        contents = repo.get_documents_content([url])
+    except DocumentRetrievalError as e:
+        return jsonify({"error": "Something went wrong while fetching the document.", "details": str(e)}), 500
 
-    return jsonify(response_dict), 200
+    if url not in contents:
+        return jsonify({"error": "Document not found."}), 404
+    return jsonify({"id": url, "url": url, "content": contents[url]}), 200
@@ -0,0 +1,73 @@
+import threading
+from collections import deque
+from typing import Deque, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .caching import TTLCache
+from .constants import (
+    MLAPI_BASE_URL,
+    MLAPI_CONNECT_TIMEOUT,
+    MLAPI_ID_BLOCK_SIZE,
+    MLAPI_POOL_SIZE,
+    MLAPI_READ_TIMEOUT,
+    PROFILE_ID_CACHE_SIZE,
+    PROFILE_ID_CACHE_TTL,
+)
+
+
+class MLAPIClient:
+    """Calls to the ML API over one pooled keep-alive session, each with a deadline."""
+
+    def __init__(self) -> None:
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MLAPI_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = (MLAPI_CONNECT_TIMEOUT, MLAPI_READ_TIMEOUT)
+        self.profile_ids = TTLCache(PROFILE_ID_CACHE_SIZE, PROFILE_ID_CACHE_TTL)
+        self.ids_lock = threading.Lock()
+        self.reserved_ids: Deque[int] = deque()
+
+    def fetch_user_profile_id(self, client_ip: str) -> int:
+        resp = self.session.get("%s/user_profiles/%s/id/" % (MLAPI_BASE_URL, client_ip), timeout=self.timeout)
+        if resp.status_code == 200:
+            return resp.json()["id"]
+        return 0
+
+    def get_user_profile_id(self, client_ip: str) -> int:
+        """Returns the id of the profile of `client_ip`, creating the profile if needed; 0 if unavailable."""
+        user_profile_id = self.profile_ids.get(client_ip)
+        if user_profile_id is not None:
+            return user_profile_id
+
+        user_profile_id = self.fetch_user_profile_id(client_ip)
+        if not user_profile_id:
+            resp = self.session.post("%s/user_profiles/" % MLAPI_BASE_URL, json={"ip": client_ip}, timeout=self.timeout)
+            # a concurrent request may have created it first
+            user_profile_id = resp.json()["id"] if resp.ok else self.fetch_user_profile_id(client_ip)
+
+        if user_profile_id:
+            self.profile_ids.set(client_ip, user_profile_id)
+        return user_profile_id
+
+    def reserve_search_query_id(self) -> Optional[int]:
+        """An id to log a search query under, from a block reserved in one round trip; None if unavailable."""
+        with self.ids_lock:
+            if not self.reserved_ids:
+                resp = self.session.post(
+                    "%s/search_queries/ids/" % MLAPI_BASE_URL, json={"count": MLAPI_ID_BLOCK_SIZE}, timeout=self.timeout
+                )
+                if not resp.ok:
+                    return None
+                self.reserved_ids.extend(resp.json()["ids"])
+            return self.reserved_ids.popleft()
+
+    def log_search_query(self, search_query_id: int, user_profile_id: int, query: str) -> bool:
+        resp = self.session.post(
+            "%s/search_queries/" % MLAPI_BASE_URL,
+            json={"id": search_query_id, "user_profile_id": user_profile_id, "query": query},
+            timeout=self.timeout,
+        )
+        return resp.ok
@@ -0,0 +1,251 @@
+"""Embedded, memory-mapped inverted index.
+
+Layout of an index file (little-endian, every array section 8-byte aligned):
+    * header: magic, version, number of documents, number of terms, total length, section offsets;
+    * term dictionary: sorted UTF-8 terms as an offsets array plus a blob;
+    * postings: per-term offsets and document frequencies, and a blob of varint-encoded
+      `(doc number delta, term frequency)` pairs;
+    * documents: doc length array, and the ids and contents as offsets arrays plus blobs, sorted by id.
+
+The file is built offline from the documents the crawler indexed (`python -m api.mmap_index <path>`) and
+read through `mmap`, so every API worker shares one copy through the page cache.
+"""
+
+import math
+import mmap
+import os
+import struct
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import elasticsearch
+import elasticsearch.helpers
+import numpy as np
+
+from .analysis import analyze
+from .constants import ES_CONN_STR, ES_INDEX
+from .custom_exc import DocumentRetrievalError
+
+MAGIC = b"EIDX"
+VERSION = 1
+
+# magic, version, num docs, num terms, total length, then the offsets of the 9 sections below
+HEADER = struct.Struct("<4sIIIQ9Q")
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_postings(buf: memoryview, count: int) -> Iterator[Tuple[int, int]]:
+    pos = 0
+    doc_num = 0
+    for _ in range(count):
+        pair = []
+        for _ in range(2):
+            value = shift = 0
+            while True:
+                byte = buf[pos]
+                pos += 1
+                value |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            pair.append(value)
+
+        doc_num += pair[0]
+        yield doc_num, pair[1]
+
+
+def _pad(out: bytearray) -> int:
+    out.extend(b"\0" * (-len(out) % 8))
+    return len(out)
+
+
+def _strings_section(strings: List[bytes]) -> Tuple[np.ndarray, bytes]:
+    offsets = np.zeros(len(strings) + 1, dtype="<u8")
+    offsets[1:] = np.cumsum([len(s) for s in strings], dtype="<u8")
+    return offsets, b"".join(strings)
+
+
+def write_index(path: str, documents: Iterable[Tuple[str, str]]) -> None:
+    """Writes `(document id, content)` pairs as an index file, atomically replacing `path`."""
+    docs = sorted(documents)
+    doc_lengths = np.zeros(len(docs), dtype="<u4")
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    for doc_num, (_, content) in enumerate(docs):
+        term_freqs, doc_lengths[doc_num] = analyze(content)
+        for term, freq in term_freqs.items():
+            postings.setdefault(term, []).append((doc_num, freq))
+
+    terms = sorted(postings)
+    postings_blob = bytearray()
+    postings_offsets = np.zeros(len(terms) + 1, dtype="<u8")
+    doc_freqs = np.zeros(len(terms), dtype="<u4")
+    for i, term in enumerate(terms):
+        prev = 0
+        for doc_num, freq in postings[term]:
+            encode_varint(doc_num - prev, postings_blob)
+            encode_varint(freq, postings_blob)
+            prev = doc_num
+        postings_offsets[i + 1] = len(postings_blob)
+        doc_freqs[i] = len(postings[term])
+
+    term_offsets, terms_blob = _strings_section([t.encode() for t in terms])
+    id_offsets, ids_blob = _strings_section([doc_id.encode() for doc_id, _ in docs])
+    content_offsets, contents_blob = _strings_section([content.encode() for _, content in docs])
+
+    out = bytearray(HEADER.size)
+    section_offsets = []
+    for section in (
+        term_offsets.tobytes(),
+        terms_blob,
+        postings_offsets.tobytes(),
+        doc_freqs.tobytes(),
+        bytes(postings_blob),
+        doc_lengths.tobytes(),
+        id_offsets.tobytes(),
+        ids_blob,
+        content_offsets.tobytes(),
+    ):
+        section_offsets.append(_pad(out))
+        out.extend(section)
+    contents_offset = _pad(out)
+
+    HEADER.pack_into(
+        out, 0, MAGIC, VERSION, len(docs), len(terms), int(doc_lengths.sum()), *section_offsets[1:], contents_offset
+    )
+
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "wb") as f:
+        f.write(out)
+        f.write(contents_blob)
+    os.replace(tmp_path, path)
+
+
+class MmapInvIdxRepository:
+    """Read-only inverted index repository with the same contract as `InvIdxDBRepository`."""
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.mm)
+
+        (
+            magic,
+            version,
+            self.num_docs,
+            self.num_terms,
+            self.total_length,
+            terms_blob_off,
+            postings_offsets_off,
+            doc_freqs_off,
+            postings_off,
+            doc_lengths_off,
+            id_offsets_off,
+            ids_blob_off,
+            content_offsets_off,
+            contents_blob_off,
+        ) = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d index file." % (path, VERSION))
+
+        self.term_offsets = np.frombuffer(self.mm, dtype="<u8", count=self.num_terms + 1, offset=HEADER.size)
+        self.terms_blob_off = terms_blob_off
+        self.postings_offsets = np.frombuffer(
+            self.mm, dtype="<u8", count=self.num_terms + 1, offset=postings_offsets_off
+        )
+        self.doc_freqs = np.frombuffer(self.mm, dtype="<u4", count=self.num_terms, offset=doc_freqs_off)
+        self.postings_off = postings_off
+        self.doc_lengths = np.frombuffer(self.mm, dtype="<u4", count=self.num_docs, offset=doc_lengths_off)
+        self.id_offsets = np.frombuffer(self.mm, dtype="<u8", count=self.num_docs + 1, offset=id_offsets_off)
+        self.ids_blob_off = ids_blob_off
+        self.content_offsets = np.frombuffer(self.mm, dtype="<u8", count=self.num_docs + 1, offset=content_offsets_off)
+        self.contents_blob_off = contents_blob_off
+
+    @staticmethod
+    def _bisect(key: bytes, count: int, get: Any) -> int:
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if get(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < count and get(lo) == key else -1
+
+    def _term(self, i: int) -> bytes:
+        start = self.terms_blob_off + int(self.term_offsets[i])
+        end = self.terms_blob_off + int(self.term_offsets[i + 1])
+        return bytes(self.buf[start:end])
+
+    def _doc_id(self, doc_num: int) -> str:
+        start = self.ids_blob_off + int(self.id_offsets[doc_num])
+        end = self.ids_blob_off + int(self.id_offsets[doc_num + 1])
+        return bytes(self.buf[start:end]).decode()
+
+    def _content(self, doc_num: int) -> str:
+        start = self.contents_blob_off + int(self.content_offsets[doc_num])
+        end = self.contents_blob_off + int(self.content_offsets[doc_num + 1])
+        return bytes(self.buf[start:end]).decode()
+
+    def fetch_postings(self, keyword: str) -> List[Tuple[int, int]]:
+        i = self._bisect(keyword.encode(), self.num_terms, self._term)
+        if i < 0:
+            return []
+
+        start = self.postings_off + int(self.postings_offsets[i])
+        end = self.postings_off + int(self.postings_offsets[i + 1])
+        return list(decode_postings(self.buf[start:end], int(self.doc_freqs[i])))
+
+    def get_document_content(self, document_id: str) -> str:
+        doc_num = self._bisect(document_id.encode(), self.num_docs, lambda n: self._doc_id(n).encode())
+        if doc_num < 0:
+            raise DocumentRetrievalError("Document %s is not in the index." % document_id)
+        return self._content(doc_num)
+
+    def get_documents_content(self, document_ids: Iterable[str]) -> Dict[str, str]:
+        contents = {}
+        for document_id in document_ids:
+            try:
+                contents[document_id] = self.get_document_content(document_id)
+            except DocumentRetrievalError:
+                continue
+        return contents
+
+    def get_documents(
+        self, keywords: List[str], with_content: bool = True
+    ) -> Tuple[Dict[str, Dict[str, Any]], float, Dict[str, Dict[str, Any]]]:
+        documents: Dict[str, Dict[str, Any]] = {}
+        keyword_stats: Dict[str, Dict[str, Any]] = {kw: {"idf": None, "doc_freq": 0, "freqs": {}} for kw in keywords}
+        doc_nums: Dict[int, str] = {}
+
+        for keyword, stats in keyword_stats.items():
+            postings = self.fetch_postings(keyword)
+            for doc_num, freq in postings:
+                if doc_num not in doc_nums:
+                    doc_id = doc_nums[doc_num] = self._doc_id(doc_num)
+                    documents[doc_id] = {"id": doc_id, "url": doc_id, "doc_length": int(self.doc_lengths[doc_num])}
+                    if with_content:
+                        documents[doc_id]["content"] = self._content(doc_num)
+                stats["freqs"][doc_nums[doc_num]] = freq
+
+            stats["doc_freq"] = len(postings)
+            if stats["doc_freq"] > 0:
+                stats["idf"] = math.log((self.num_docs - stats["doc_freq"] + 0.5) / (stats["doc_freq"] + 0.5))
+
+        avgdl = self.total_length / self.num_docs if self.num_docs > 0 else 0
+        return documents, avgdl, keyword_stats
+
+
+def scan_es_documents() -> Iterator[Tuple[str, str]]:
+    es = elasticsearch.Elasticsearch(ES_CONN_STR)
+    for hit in elasticsearch.helpers.scan(es, index=ES_INDEX, _source=["content"]):
+        yield hit["_id"], hit["_source"]["content"]
+
+
+if __name__ == "__main__":
+    write_index(sys.argv[1], scan_es_documents())
@@ -0,0 +1,101 @@
+"""Binary codec for the models the analytics pipeline publishes to Redis.
+
+Kept identical in `search-analytics/pipeline/model_codec.py` and `search/api/model_codec.py`, the writer and
+the reader of the models.
+
+Layout: a header (magic, format version, flags), then the zlib-compressed body. The body is the length of a
+JSON metadata block, the metadata, and the raw little-endian buffers of the arrays it describes. Sparse
+matrices are stored as their CSR `data`, `indices` and `indptr` arrays, so the size of a model scales with
+its non-zeros; any other JSON-serialisable value is kept in the metadata as is.
+"""
+
+import json
+import struct
+import zlib
+from typing import Any, Dict
+
+import numpy as np
+import scipy.sparse
+
+MAGIC = b"EMDL"
+VERSION = 1
+FLAG_COMPRESSED = 1
+
+HEADER = struct.Struct("<4sHH")
+META_LENGTH = struct.Struct("<I")
+
+
+def _array_meta(array: np.ndarray, offset: int) -> Dict[str, Any]:
+    return {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset, "nbytes": array.nbytes}
+
+
+def encode(fields: Dict[str, Any], compress: bool = True) -> bytes:
+    meta: Dict[str, Any] = {}
+    buffers = []
+    offset = 0
+
+    def add_array(array: np.ndarray) -> Dict[str, Any]:
+        nonlocal offset
+        array = np.ascontiguousarray(array).astype(array.dtype.newbyteorder("<"), copy=False)
+        array_meta = _array_meta(array, offset)
+        buffers.append(array.tobytes())
+        offset += array.nbytes
+        return array_meta
+
+    for name, value in fields.items():
+        if scipy.sparse.issparse(value):
+            csr = value.tocsr()
+            meta[name] = {
+                "kind": "csr",
+                "shape": list(csr.shape),
+                "data": add_array(csr.data.astype(np.float32)),
+                "indices": add_array(csr.indices.astype(np.int32)),
+                "indptr": add_array(csr.indptr.astype(np.int32)),
+            }
+        elif isinstance(value, np.ndarray):
+            meta[name] = {"kind": "array", "array": add_array(value)}
+        else:
+            meta[name] = {"kind": "json", "value": value}
+
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode()
+    body = META_LENGTH.pack(len(meta_bytes)) + meta_bytes + b"".join(buffers)
+    if compress:
+        body = zlib.compress(body)
+
+    return HEADER.pack(MAGIC, VERSION, FLAG_COMPRESSED if compress else 0) + body
+
+
+def decode(blob: bytes) -> Dict[str, Any]:
+    magic, version, flags = HEADER.unpack_from(blob, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version %d model." % VERSION)
+
+    body_start = HEADER.size
+    body = blob[body_start:]
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+
+    (meta_length,) = META_LENGTH.unpack_from(body, 0)
+    meta_start, buffers_offset = META_LENGTH.size, META_LENGTH.size + meta_length
+    meta = json.loads(body[meta_start:buffers_offset])
+
+    def get_array(array_meta: Dict[str, Any]) -> np.ndarray:
+        count = array_meta["nbytes"] // np.dtype(array_meta["dtype"]).itemsize
+        array = np.frombuffer(
+            body, dtype=array_meta["dtype"], count=count, offset=buffers_offset + array_meta["offset"]
+        )
+        return array.reshape(array_meta["shape"])
+
+    fields: Dict[str, Any] = {}
+    for name, field_meta in meta.items():
+        if field_meta["kind"] == "csr":
+            fields[name] = scipy.sparse.csr_matrix(
+                (get_array(field_meta["data"]), get_array(field_meta["indices"]), get_array(field_meta["indptr"])),
+                shape=tuple(field_meta["shape"]),
+            )
+        elif field_meta["kind"] == "array":
+            fields[name] = get_array(field_meta["array"])
+        else:
+            fields[name] = field_meta["value"]
+
+    return fields
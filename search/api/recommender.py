@@ -0,0 +1,151 @@
+import math
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, cast
+
+import numpy as np
+import redis
+import scipy.sparse
+
+from .caching import TTLCache
+from .constants import (
+    GLOBAL_INDEX_REFRESH_PERIOD,
+    GLOBAL_RECOMMENDER_KEY,
+    GLOBAL_RECOMMENDER_VERSION_KEY,
+    MODEL_CACHE_SIZE,
+    MODEL_CACHE_TTL,
+    RECOMMENDER_KEY,
+)
+from .lsh import LSHIndex
+from .model_codec import decode
+
+# same analysis as the `TfidfVectorizer` the pipeline fits
+TOKEN_RE = re.compile(r"(?u)\b\w\w+\b")
+
+
+class RecommendationModel:
+    """Serving side of the per-user artifact published by the analytics pipeline.
+
+    Holds the fitted vocabulary and idf, the L2-normalised TF-IDF matrix of the user's distinct queries and
+    the URLs clicked for each of them, so a recommendation is one sparse mat-vec and a lookup. The optional
+    sparse top-k neighbor graph of the queries fills up recommendations the direct matches leave short.
+    """
+
+    def __init__(
+        self,
+        vocabulary: List[str],
+        idf: np.ndarray,
+        query_matrix: scipy.sparse.csr_matrix,
+        urls: List[List[str]],
+        neighbors: Optional[scipy.sparse.csr_matrix] = None,
+    ) -> None:
+        self.vocabulary = {term: i for i, term in enumerate(vocabulary)}
+        self.idf = idf
+        self.query_matrix = query_matrix
+        self.urls = urls
+        self.neighbors = neighbors
+
+    @classmethod
+    def from_artifact(cls, artifact: Dict[str, Any]) -> "RecommendationModel":
+        return cls(
+            artifact["vocabulary"],
+            artifact["idf"],
+            artifact["query_matrix"],
+            artifact["urls"],
+            artifact.get("neighbors"),
+        )
+
+    def vectorize(self, query: str) -> np.ndarray:
+        vector = np.zeros(len(self.vocabulary))
+        for token in TOKEN_RE.findall(query.lower()):
+            col = self.vocabulary.get(token)
+            if col is not None:
+                vector[col] += 1
+
+        vector *= self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def recommend(self, query: str, top_n: int = 5) -> List[str]:
+        scores = self.query_matrix @ self.vectorize(query)
+        if not scores.any():
+            return []
+
+        top = np.argpartition(-scores, min(top_n, len(scores) - 1))[:top_n]
+        top = top[np.argsort(-scores[top])]
+        top = top[scores[top] > 0]
+        recommended_urls: Dict[str, None] = {}
+        for idx in top:
+            recommended_urls.update(dict.fromkeys(self.urls[idx]))
+
+        if len(recommended_urls) < top_n and self.neighbors is not None:
+            # what was clicked for the queries most similar to the best match
+            row = self.neighbors[top[0]]
+            for idx in row.indices[np.argsort(-row.data)]:
+                recommended_urls.update(dict.fromkeys(self.urls[idx]))
+
+        return list(recommended_urls)[:top_n]
+
+
+class ModelCache:
+    """Bounded in-process cache of the recommendation models, reloaded from Redis after `MODEL_CACHE_TTL`.
+
+    Models are binary (see `model_codec`), so `redis_instance` must not decode responses.
+    """
+
+    def __init__(self, redis_instance: redis.Redis) -> None:
+        self.redis = redis_instance
+        self.models = TTLCache(MODEL_CACHE_SIZE, MODEL_CACHE_TTL)
+
+    def get(self, user_profile_id: int) -> Optional[RecommendationModel]:
+        model = self.models.get(user_profile_id)
+        if model is not None:
+            # `False` marks users without a model yet
+            return model or None
+
+        artifact = cast(Optional[bytes], self.redis.get(RECOMMENDER_KEY % user_profile_id))
+        if artifact is None:
+            self.models.set(user_profile_id, False)
+            return None
+
+        try:
+            model = RecommendationModel.from_artifact(decode(artifact))
+        except ValueError:
+            # written in a format this worker does not read yet
+            return None
+
+        self.models.set(user_profile_id, model)
+        return model
+
+
+class GlobalIndexCache:
+    """The LSH index over the queries of every user, reloaded from Redis once the pipeline publishes a new one.
+
+    The version is checked every `GLOBAL_INDEX_REFRESH_PERIOD` seconds by one request at a time; the others
+    keep using the index they have. Models are binary, so `redis_instance` must not decode responses.
+    """
+
+    def __init__(self, redis_instance: redis.Redis) -> None:
+        self.redis = redis_instance
+        self.index: Optional[LSHIndex] = None
+        self.version: Optional[bytes] = None
+        self.checked_at = -math.inf
+        self.lock = threading.Lock()
+
+    def get(self) -> Optional[LSHIndex]:
+        if time.monotonic() - self.checked_at > GLOBAL_INDEX_REFRESH_PERIOD and self.lock.acquire(blocking=False):
+            try:
+                self.checked_at = time.monotonic()
+                version = cast(Optional[bytes], self.redis.get(GLOBAL_RECOMMENDER_VERSION_KEY))
+                if version is not None and version != self.version:
+                    artifact = cast(Optional[bytes], self.redis.get(GLOBAL_RECOMMENDER_KEY))
+                    if artifact is not None:
+                        self.index = LSHIndex.from_fields(decode(artifact))
+                        self.version = version
+            except (redis.RedisError, ValueError):
+                pass
+            finally:
+                self.lock.release()
+
+        return self.index
@@ -1,56 +1,94 @@
 import math
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterable, List, Tuple
 
 import elasticsearch
 
-from .constants import ES_CONN_STR, ES_INDEX, ES_RESULTS_SIZE
+from .constants import ES_CONN_STR, ES_INDEX, ES_MGET_BATCH_SIZE, ES_RESULTS_SIZE, INV_IDX_BACKEND, MMAP_INDEX_PATH
+from .corpus_stats import CorpusStatsCache
 from .custom_exc import DocumentRetrievalError
+from .mmap_index import MmapInvIdxRepository
 
 
 class InvIdxDBRepository:
-    def __init__(self) -> None:
+    def __init__(self, corpus_stats: CorpusStatsCache | None = None) -> None:
         self.es = elasticsearch.Elasticsearch(ES_CONN_STR)
+        self.corpus_stats = corpus_stats
 
-    def fetch_keyword_data(self, keyword: str) -> List[Dict[str, Any]]:
-        response = self.es.search(
-            index=ES_INDEX,
-            body={
-                "query": {"match": {"content": keyword}},
-                "size": ES_RESULTS_SIZE,
-                "_source": ["frequency", "doc_length"],
-            },
-        )
+    @staticmethod
+    def build_keyword_search(keyword: str) -> Dict[str, Any]:
+        # `frequency` maps every term of the document to its count: only the keyword's is shipped back
+        return {
+            "query": {"match": {"content": keyword}},
+            "size": ES_RESULTS_SIZE,
+            "_source": ["frequency.%s" % keyword, "doc_length"],
+        }
 
+    @staticmethod
+    def parse_keyword_hits(keyword: str, response: Dict[str, Any]) -> List[Dict[str, Any]]:
         return [
             {
                 "document_id": hit["_id"],
-                "frequency": hit["_source"]["frequency"],
+                "frequency": hit["_source"].get("frequency", {}).get(keyword, 0),
                 "doc_length": hit["_source"]["doc_length"],
             }
             for hit in response["hits"]["hits"]
         ]
 
-    def get_document_content(self, document_id: str) -> str:
-        response = self.es.get(index=ES_INDEX, id=document_id)
-        return response["_source"]["content"]
+    def fetch_keywords_data(self, keywords: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """Resolves all the keywords in a single multi-search round trip."""
+        searches: List[Dict[str, Any]] = []
+        for keyword in keywords:
+            searches.append({"index": ES_INDEX})
+            searches.append(self.build_keyword_search(keyword))
 
-    def get_documents(self, keywords: List[str]) -> Tuple[Dict[str, Dict[str, str]], float, Dict[str, Dict[str, Any]]]:
-        documents = {}
-        keyword_stats = {kw: {"idf": None, "doc_freq": 0, "freqs": {}} for kw in keywords}
-        total_length = 0
-        num_docs = 0
+        response = self.es.msearch(searches=searches)
 
-        for keyword in keywords:
+        keywords_data = {}
+        for keyword, item in zip(keywords, response["responses"]):
+            if "error" in item:
+                raise DocumentRetrievalError("Search for '%s' failed: %s" % (keyword, item["error"]))
+
+            keywords_data[keyword] = self.parse_keyword_hits(keyword, item)
+
+        return keywords_data
+
+    def get_documents_content(self, document_ids: Iterable[str]) -> Dict[str, str]:
+        """Fetches document bodies in batched multi-gets; documents that are gone are left out."""
+        document_ids = list(document_ids)
+        contents = {}
+        for start in range(0, len(document_ids), ES_MGET_BATCH_SIZE):
+            end = start + ES_MGET_BATCH_SIZE
             try:
-                results = self.fetch_keyword_data(keyword)
-            except (elasticsearch.ConnectionError, elasticsearch.TransportError):
-                raise DocumentRetrievalError
+                response = self.es.mget(index=ES_INDEX, ids=document_ids[start:end], source_includes=["content"])
+            except (elasticsearch.ConnectionError, elasticsearch.TransportError) as e:
+                raise DocumentRetrievalError from e
+
+            for doc in response["docs"]:
+                if doc.get("found"):
+                    contents[doc["_id"]] = doc["_source"]["content"]
+
+        return contents
+
+    def get_documents(
+        self, keywords: List[str], with_content: bool = True
+    ) -> Tuple[Dict[str, Dict[str, Any]], float, Dict[str, Dict[str, Any]]]:
+        """Collects the candidate documents and the BM25 inputs for `keywords`.
 
+        With `with_content=False` the bodies are not fetched at all, so the caller can rank first and then
+        fetch only the bodies it needs through `get_documents_content`.
+        """
+        documents: Dict[str, Dict[str, Any]] = {}
+        keyword_stats = {kw: {"idf": None, "doc_freq": 0, "freqs": {}} for kw in keywords}
+
+        try:
+            keywords_data = self.fetch_keywords_data(list(keyword_stats))
+        except (elasticsearch.ConnectionError, elasticsearch.TransportError) as e:
+            raise DocumentRetrievalError from e
+
+        for keyword, results in keywords_data.items():
             for result in results:
                 doc_id = result["document_id"]
                 freq = result["frequency"]
-                doc_length = result["doc_length"]
-                total_length += doc_length
 
                 if doc_id not in keyword_stats[keyword]["freqs"]:
                     keyword_stats[keyword]["freqs"][doc_id] = freq
@@ -59,16 +97,40 @@ class InvIdxDBRepository:
 
                 keyword_stats[keyword]["doc_freq"] += 1
                 if doc_id not in documents:
-                    try:
-                        documents[doc_id] = {"id": doc_id, "content": self.get_document_content(doc_id), "url": doc_id}
-                    except (elasticsearch.ConnectionError, elasticsearch.NotFoundError, elasticsearch.TransportError):
-                        raise DocumentRetrievalError
+                    documents[doc_id] = {"id": doc_id, "url": doc_id, "doc_length": result["doc_length"]}
 
-                    num_docs += 1
+        if with_content:
+            contents = self.get_documents_content(documents)
+            for doc_id in list(documents):
+                if doc_id in contents:
+                    documents[doc_id]["content"] = contents[doc_id]
+                else:
+                    del documents[doc_id]
+
+        num_docs = 0
+        if self.corpus_stats is not None:
+            num_docs, avgdl, doc_freqs = self.corpus_stats.get(list(keyword_stats))
+            if num_docs > 0:
+                for keyword, doc_freq in doc_freqs.items():
+                    keyword_stats[keyword]["doc_freq"] = doc_freq
+
+        if num_docs == 0:
+            # no corpus statistics yet, estimate them from the hits, document frequencies included
+            num_docs = len(documents)
+            total_length = sum(doc["doc_length"] for doc in documents.values())
+            avgdl = total_length / num_docs if num_docs > 0 else 0
 
-        avgdl = total_length / num_docs if num_docs > 0 else 0
         for stats in keyword_stats.values():
             if num_docs > 0 and stats["doc_freq"] > 0:
                 stats["idf"] = math.log((num_docs - stats["doc_freq"] + 0.5) / (stats["doc_freq"] + 0.5))
 
         return documents, avgdl, keyword_stats
+
+
+def get_inv_idx_repository(
+    corpus_stats: CorpusStatsCache | None = None,
+) -> InvIdxDBRepository | MmapInvIdxRepository:
+    if INV_IDX_BACKEND == "mmap":
+        # the index file carries its own corpus statistics
+        return MmapInvIdxRepository(MMAP_INDEX_PATH)
+    return InvIdxDBRepository(corpus_stats)
@@ -1,31 +1,32 @@
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics import precision_score, recall_score
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.model_selection import train_test_split
 
+from .constants import SNIPPET_LENGTH
+from .lsh import LSHIndex
+from .recommender import RecommendationModel
 
-def get_recommendations(df: pd.DataFrame, vectorizer: TfidfVectorizer, new_query: str, top_n: int = 5) -> List[str]:
-    query_vectors = vectorizer.fit_transform(df["search_query"])
 
-    new_query_vector = vectorizer.transform([new_query])
-    similarity_scores = cosine_similarity(new_query_vector, query_vectors).flatten()
-    similar_indices = similarity_scores.argsort()[-top_n:][::-1]
+def make_snippet(content: str, keywords: List[str], length: int = SNIPPET_LENGTH) -> str:
+    """Cuts a `length` characters window of `content` around the first keyword occurrence."""
+    lowered = content.lower()
+    positions = [pos for pos in (lowered.find(kw) for kw in keywords if kw) if pos >= 0]
+    start = max(0, min(positions) - length // 4) if positions else 0
+    end = start + length
 
-    recommended_urls = []
-    for idx in similar_indices:
-        query = df.iloc[idx]["search_query"]
-        urls = df[df["search_query"] == query]["visited_url"].tolist()
-        recommended_urls.extend(urls)
+    snippet = " ".join(content[start:end].split())
+    return "%s%s%s" % ("..." if start > 0 else "", snippet, "..." if end < len(content) else "")
 
-    return list(set(recommended_urls))[:top_n]
+
+def get_recommendations(model: Union[RecommendationModel, LSHIndex], new_query: str, top_n: int = 5) -> List[str]:
+    return model.recommend(new_query, top_n)
 
 
 def evaluate_recommender(
-    df: pd.DataFrame, vectorizer: TfidfVectorizer, similarity_matrix: np.ndarray, top_n: int = 5
+    df: pd.DataFrame, model: RecommendationModel, top_n: int = 5
 ) -> Tuple[float | np.ndarray, float | np.ndarray]:
     _, test_data = train_test_split(df, test_size=0.2, random_state=42)
     test_df = pd.DataFrame(
@@ -40,7 +41,7 @@ def evaluate_recommender(
     y_pred = []
     for query in test_df["search_query"].unique():
         true_urls = test_df[test_df["search_query"] == query]["visited_url"].tolist()
-        recommended_urls = get_recommendations(query, df, vectorizer, similarity_matrix, top_n)
+        recommended_urls = get_recommendations(model, query, top_n)
         y_true.extend([1] * len(true_urls))
         y_pred.extend([1 if url in recommended_urls else 0 for url in true_urls])
 
@@ -23,7 +23,7 @@ searchForm.addEventListener('submit', (event) => {
                 const li = document.createElement('li');
                 const a = document.createElement('a');
                 a.href = page.url;
-                a.textContent = page.content.substring(0, 97) + '...';
+                a.textContent = page.snippet;
                 a.onclick = () => {
                     if (search_query_id) {
                         fetch(`${MLAPI_BASE_URL}/search-queries/${search_query_id}/visited-urls/`, {
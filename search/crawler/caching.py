@@ -5,16 +5,24 @@ from concurrent.futures import ThreadPoolExecutor
 import elasticsearch
 import redis
 
-from .constants import ES_INDEX, MAX_WORKERS
+from .constants import ES_INDEX, VALIDATOR_WORKERS
+from .corpus_stats import CorpusStats
 from .crawler import Crawler
 
 
 class CacheValidator:
     def __init__(
-        self, redis_instance: redis.Redis, es_instance: elasticsearch.Elasticsearch, logger: logging.Logger
+        self,
+        redis_instance: redis.Redis,
+        binary_redis_instance: redis.Redis,
+        es_instance: elasticsearch.Elasticsearch,
+        corpus_stats: CorpusStats,
+        logger: logging.Logger,
     ) -> None:
         self.redis = redis_instance
+        self.binary_redis = binary_redis_instance
         self.es = es_instance
+        self.corpus_stats = corpus_stats
         self.logger = logger
 
     def is_cache_valid(self, url: str) -> bool:
@@ -33,8 +41,8 @@ class CacheValidator:
             self.logger.error("Failed to validate cache for %s: %s" % (url, e))
             return False
 
-    def invalidate(self, url: bytes) -> str | None:
-        real_url = url.decode().split("metadata:")[1]
+    def invalidate(self, metadata_key: str) -> str | None:
+        real_url = metadata_key.split("metadata:")[1]
         if not self.is_cache_valid(real_url):
             try:
                 _ = self.es.delete(index=ES_INDEX, id=real_url)
@@ -42,6 +50,7 @@ class CacheValidator:
                 self.logger.error("Deleting the document at %s failed." % real_url)
                 return
 
+            self.corpus_stats.remove_document(real_url)
             self.redis.delete(real_url)
             self.redis.delete("metadata:%s" % real_url)
             self.logger.info("Cache invalidated for %s." % real_url)
@@ -50,8 +59,9 @@ class CacheValidator:
 
     def run(self) -> None:
         self.logger.info("Validating cache.")
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as cache_ops_exec:
+        with ThreadPoolExecutor(max_workers=VALIDATOR_WORKERS) as cache_ops_exec:
             results = cache_ops_exec.map(self.invalidate, self.redis.scan_iter(match="metadata:*"))
+            invalidated = [url for url in results if url is not None]
 
-        if results:
-            Crawler(results[-1], self.redis, self.es, self.logger).run()
+        if invalidated:
+            Crawler(invalidated[-1], self.redis, self.binary_redis, self.es, self.corpus_stats, self.logger).run()
@@ -2,8 +2,38 @@ import os
 
 ES_CONN_STR = os.getenv("ES_CONN_STR", "https://localhost:9200")
 ES_INDEX = "web_pages"
+# pages indexed per bulk request, at most this much content, and at most this many seconds after crawling;
+# a rejected page is tried in this many bulk requests
+ES_BULK_SIZE = 500
+ES_BULK_MAX_BYTES = 10 * 1024 * 1024
+ES_BULK_INTERVAL = 5
+ES_BULK_MAX_ATTEMPTS = 5
 
 REDIS_CRAWLER_CONN_STR = os.getenv("REDIS_CRAWLER_CONN_STR", "redis://localhost:6379/0")
+REDIS_CORPUS_CONN_STR = os.getenv("REDIS_CORPUS_CONN_STR", "redis://localhost:6379/2")
 EXPIRES_AFTER = 86_400
-MAX_WORKERS = 10_000
+PAGE_COMPRESSION_LEVEL = 6
+# pages fetched at once, connections kept alive per host, and fetch deadlines in seconds
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "1000"))
+CRAWL_CONNECTIONS_PER_HOST = 8
+FETCH_CONNECT_TIMEOUT = 10
+FETCH_TIMEOUT = 30
+USER_AGENT = "EnGINE"
+# seconds between two requests to one host, unless its robots.txt asks for more (up to the max)
+CRAWL_DELAY = 1.0
+MAX_CRAWL_DELAY = 60.0
+ROBOTS_TTL = 86_400
+# fetches of a URL before it is dropped; the host backs off `RETRY_BACKOFF` seconds, doubling, after each failure
+FETCH_MAX_ATTEMPTS = 4
+RETRY_BACKOFF = 5.0
+MAX_RETRY_BACKOFF = 300.0
+# URLs discovered, remembered in a Bloom filter checkpointed with the frontier every `SEEN_CHECKPOINT_PERIOD` seconds
+SEEN_CAPACITY = int(os.getenv("SEEN_CAPACITY", "10000000"))
+SEEN_FALSE_POSITIVE_RATE = float(os.getenv("SEEN_FALSE_POSITIVE_RATE", "0.001"))
+SEEN_CHECKPOINT_PATH = os.getenv("SEEN_CHECKPOINT_PATH", "seen.bloom")
+SEEN_CHECKPOINT_PERIOD = 60
+# weight of a link's path depth against its crawl depth in its priority
+LINK_PATH_WEIGHT = 0.1
 VALIDATOR_PERIOD = 3600
+# HEAD requests in flight at once while validating the page cache
+VALIDATOR_WORKERS = 32
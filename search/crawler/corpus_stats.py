@@ -0,0 +1,61 @@
+"""Corpus-wide term statistics shared with the search API.
+
+Layout in Redis:
+    * `corpus:stats`: hash with the number of documents and their total length;
+    * `corpus:df`: hash of term to the number of documents containing it;
+    * `corpus:doc:<url>`: JSON with the length and the terms of an indexed document, so that it can be
+      taken back out of the statistics when it is re-indexed or deleted;
+    * `corpus:generation`: counter bumped on every change, the search API keys its result cache by it.
+"""
+
+import json
+from typing import Dict, List, Optional, Tuple, cast
+
+import redis
+
+STATS_KEY = "corpus:stats"
+DOC_FREQS_KEY = "corpus:df"
+DOC_KEY_PREFIX = "corpus:doc:"
+GENERATION_KEY = "corpus:generation"
+
+
+class CorpusStats:
+    def __init__(self, redis_instance: redis.Redis) -> None:
+        self.redis = redis_instance
+
+    def _unaccount(self, pipe: redis.client.Pipeline, url: str, stored: Optional[str]) -> None:
+        if stored is None:
+            return
+
+        doc = json.loads(stored)
+        pipe.hincrby(STATS_KEY, "num_docs", -1)
+        pipe.hincrby(STATS_KEY, "total_length", -doc["length"])
+        for term in doc["terms"]:
+            pipe.hincrby(DOC_FREQS_KEY, term, -1)
+        pipe.delete("%s%s" % (DOC_KEY_PREFIX, url))
+
+    def add_documents(self, documents: List[Tuple[str, Dict[str, int], int]]) -> None:
+        """Accounts `(url, term frequencies, length)` documents in one round trip and one generation."""
+        # the last version of a document wins, and each is taken out of the statistics once
+        by_url = {url: (term_freqs, doc_length) for url, term_freqs, doc_length in documents}
+        if not by_url:
+            return
+
+        stored_docs = cast(List[Optional[str]], self.redis.mget(["%s%s" % (DOC_KEY_PREFIX, url) for url in by_url]))
+        with self.redis.pipeline() as pipe:
+            for (url, (term_freqs, doc_length)), stored in zip(by_url.items(), stored_docs):
+                self._unaccount(pipe, url, stored)
+                pipe.hincrby(STATS_KEY, "num_docs", 1)
+                pipe.hincrby(STATS_KEY, "total_length", doc_length)
+                for term in term_freqs:
+                    pipe.hincrby(DOC_FREQS_KEY, term, 1)
+                pipe.set("%s%s" % (DOC_KEY_PREFIX, url), json.dumps({"length": doc_length, "terms": list(term_freqs)}))
+            pipe.incr(GENERATION_KEY)
+            pipe.execute()
+
+    def remove_document(self, url: str) -> None:
+        stored = cast(Optional[str], self.redis.get("%s%s" % (DOC_KEY_PREFIX, url)))
+        with self.redis.pipeline() as pipe:
+            self._unaccount(pipe, url, stored)
+            pipe.incr(GENERATION_KEY)
+            pipe.execute()
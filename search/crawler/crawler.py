@@ -1,107 +1,131 @@
 """Crawler module.
 
 Features:
-    * multi-threaded;
-    * persists documents in a key-value store;
+    * asynchronous: thousands of fetches in flight on one thread, over per-host keep-alive connections;
+    * remembers the URLs it has discovered in a compact filter that survives restarts;
+    * polite: honours robots.txt and a per-host crawl delay, retries failed fetches with backoff;
+    * breadth-first, preferring shallow links;
+    * extracts the text, title and links of a page in a single parse;
+    * persists pages compressed in a key-value store, and indexes their text in bulk with its term statistics;
     * uses smart caching.
 """
-import io
+
+import asyncio
+import gzip
 import logging
-import urllib.request
-from concurrent.futures import ThreadPoolExecutor
-from gzip import GzipFile
-from html.parser import HTMLParser
-from typing import List
+from typing import List, Optional, Tuple
 from urllib.parse import urlparse
 
+import aiohttp
 import elasticsearch
 import redis
 
-from .constants import ES_INDEX, EXPIRES_AFTER, MAX_WORKERS
+from .constants import (
+    CRAWL_CONCURRENCY,
+    CRAWL_CONNECTIONS_PER_HOST,
+    ES_BULK_INTERVAL,
+    EXPIRES_AFTER,
+    FETCH_CONNECT_TIMEOUT,
+    FETCH_TIMEOUT,
+    LINK_PATH_WEIGHT,
+    SEEN_CAPACITY,
+    SEEN_CHECKPOINT_PATH,
+    SEEN_CHECKPOINT_PERIOD,
+    SEEN_FALSE_POSITIVE_RATE,
+    USER_AGENT,
+)
+from .corpus_stats import CorpusStats
+from .custom_exc import FetchError
+from .extraction import extract
+from .frontier import Frontier, FrontierEntry
+from .indexing import BulkIndexer
+from .page_cache import get_page
+from .robots import RobotsCache
+from .seen import load, save
 
 
-class URLCollector(HTMLParser):
-    def __init__(self) -> None:
-        super().__init__()
-        self.urls: List[str] = []
+def get_ttl(cache_control: str) -> int:
+    ttl = EXPIRES_AFTER
+    cache_control_parts = cache_control.split("=")
+    if len(cache_control_parts) >= 2:
+        try:
+            ttl = int(cache_control_parts[1])
+        except ValueError:
+            pass
+    return ttl
 
-    def handle_starttag(self, tag: str, attrs: List[tuple[str, str | None]]) -> None:
-        dict_attrs = dict(attrs)
-        if tag == "a" and "href" in dict_attrs:
-            self.urls.append(dict_attrs["href"])
 
-    def flush(self) -> List[str]:
-        urls = self.urls
-        self.urls = []
-        return urls
+def link_priority(url: str, depth: int) -> float:
+    """Lower first: links fewer hops from the start, then with shorter paths."""
+    path_depth = len([part for part in urlparse(url).path.split("/") if part])
+    return depth + LINK_PATH_WEIGHT * path_depth
 
 
 class Crawler:
+    """Crawls from `start_url` with up to `CRAWL_CONCURRENCY` fetches in flight, spread across hosts by the
+    `Frontier`.
+
+    Fetches run on the event loop; the blocking Redis and Elasticsearch calls and the HTML parsing run in the
+    default thread pool, so they never stall it. Cached pages are binary (see `page_cache`), so
+    `binary_redis_instance` must not decode responses.
+    """
+
     def __init__(
         self,
         start_url: str,
         redis_instance: redis.Redis,
+        binary_redis_instance: redis.Redis,
         es_instance: elasticsearch.Elasticsearch,
+        corpus_stats: CorpusStats,
         logger: logging.Logger,
     ) -> None:
         start_long_url = start_url
         if "://" not in start_url:
             start_long_url = "http://%s" % start_long_url
 
-        self.url_collector = URLCollector()
-
-        self.queue = set([start_long_url])
+        self.start_url = start_long_url
+        self.robots = RobotsCache()
+        # the URLs the frontier held at the last checkpoint are seen, so they are crawled from there
+        self.seen, self.pending = load(SEEN_CHECKPOINT_PATH, SEEN_CAPACITY, SEEN_FALSE_POSITIVE_RATE, EXPIRES_AFTER)
         self.redis = redis_instance
+        self.binary_redis = binary_redis_instance
         self.es = es_instance
+        self.corpus_stats = corpus_stats
+        self.indexer = BulkIndexer(binary_redis_instance, es_instance, corpus_stats, logger)
 
         self.logger = logger
 
-    def parse_links(self, page: str) -> List[str]:
-        self.url_collector.feed(page)
-        return self.url_collector.flush()
-
-    def process_single_url(self, url: str) -> None:
-        self.logger.info("Attempting to bring %s from cache." % url)
-
-        page = self.redis.get(url)
-        if not page:
-            self.logger.info("Not found in cache. Starting fetch on %s." % url)
-            try:
-                resp = urllib.request.urlopen(url)
-            except (urllib.error.URLError, ValueError):
-                self.logger.info("Fetch failed: putting %s back into the queue." % url)
-                self.queue.add(url)
-                return
+    async def fetch(self, session: aiohttp.ClientSession, url: str) -> Tuple[str, str, int]:
+        """Returns the page at `url`, its charset and for how long to cache it.
 
-            charset = resp.info().get_content_charset() or "utf-8"
-            try:
-                page = resp.read().decode(charset)
-            except UnicodeDecodeError:
-                gzip_file = GzipFile(fileobj=io.BytesIO(resp.read()))
-                page = gzip_file.read().decode()
-
-            ttl = EXPIRES_AFTER
-            cache_control_parts = resp.headers.get("cache-control", "").split("=")
-            if len(cache_control_parts) >= 2:
-                try:
-                    ttl = int(cache_control_parts[1])
-                except ValueError:
-                    pass
+        Raises `FetchError` if there is no page: retryable on network errors, throttling (429) and server errors
+        (5xx), not on the other client errors (4xx).
+        """
+        try:
+            async with session.get(url) as resp:
+                if resp.status >= 400:
+                    raise FetchError(
+                        "%s answered %d." % (url, resp.status), retryable=resp.status == 429 or resp.status >= 500
+                    )
+                body = await resp.read()
+                charset = resp.charset or "utf-8"
+                ttl = get_ttl(resp.headers.get("cache-control", ""))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise FetchError("Fetching %s failed: %r." % (url, e), retryable=True) from e
 
+        try:
+            page = body.decode(charset)
+        except (UnicodeDecodeError, LookupError):
             try:
-                _ = self.es.index(index=ES_INDEX, id=url, document={"content": page})
-            except (elasticsearch.ConnectionError, elasticsearch.TransportError):
-                self.logger.error("Indexing the document at %s failed." % url)
-                return
-
-            self.redis.set(url, page, ex=ttl)
-            self.redis.hset("metadata:%s" % url, mapping={"charset": charset, "expires": ttl})
+                page = gzip.decompress(body).decode()
+            except (OSError, UnicodeDecodeError):
+                page = body.decode("utf-8", errors="replace")
 
-            self.logger.info("Fetched and cached page from %s." % url)
-        else:
-            self.logger.info("Brought page from %s." % url)
+        return page, charset, ttl
 
-        for link_url in self.parse_links(page):
+    def link_urls(self, url: str, links: List[str]) -> List[str]:
+        link_long_urls = []
+        for link_url in links:
             try:
                 link_long_url = link_url.decode()
             except AttributeError:
@@ -111,31 +135,146 @@ class Crawler:
             if not link_parse_res.netloc:
                 curr_parse_res = urlparse(url)
                 link_long_url = link_parse_res._replace(
-                    scheme=curr_parse_res.scheme, netloc=curr_parse_res.hostname
+                    scheme=curr_parse_res.scheme, netloc=curr_parse_res.netloc
                 ).geturl()
 
             if not (link_parse_res.params or link_long_url.endswith("/")):
                 link_long_url += "/"
 
-            if not self.redis.exists(link_long_url):
+            link_long_urls.append(link_long_url)
+        return link_long_urls
+
+    def uncached(self, link_long_urls: List[str]) -> List[str]:
+        with self.redis.pipeline(transaction=False) as pipe:
+            for link_long_url in link_long_urls:
+                pipe.exists(link_long_url)
+            cached = pipe.execute()
+        return [link_long_url for link_long_url, is_cached in zip(link_long_urls, cached) if not is_cached]
+
+    def handle_page(self, url: str, page: str, fetched: Optional[Tuple[str, int]]) -> List[str]:
+        """Parses `page` once, queues it for indexing if it was just `fetched` (with its charset and ttl), and
+        returns its links.
+        """
+        extracted = extract(page)
+        if fetched is not None:
+            charset, ttl = fetched
+            self.indexer.add(url, page, extracted, charset, ttl)
+        return self.link_urls(url, extracted.links)
+
+    async def process_url(self, session: aiohttp.ClientSession, frontier: Frontier, entry: FrontierEntry) -> bool:
+        """Returns whether fetching `entry` failed."""
+        url = entry.url
+        self.logger.info("Attempting to bring %s from cache." % url)
+
+        page = await asyncio.to_thread(get_page, self.binary_redis, url)
+        if page is None:
+            self.logger.info("Not found in cache. Starting fetch on %s." % url)
+            try:
+                page, charset, ttl = await self.fetch(session, url)
+            except FetchError as e:
+                if e.retryable:
+                    self.logger.info("%s It will be retried later if attempts remain." % e)
+                    return True
+                self.logger.info("%s Dropping it." % e)
+                return False
+
+            link_long_urls = await asyncio.to_thread(self.handle_page, url, page, (charset, ttl))
+            self.logger.info("Fetched page from %s; queued for indexing." % url)
+        else:
+            link_long_urls = await asyncio.to_thread(self.handle_page, url, page, None)
+            self.logger.info("Brought page from %s." % url)
+
+        # the filter first, on the loop where it is never touched concurrently; Redis only for the links it has
+        # not seen, which it may still have cached from before the filter was last reset
+        unseen = [link_long_url for link_long_url in link_long_urls if link_long_url not in self.seen]
+        if not unseen:
+            return False
+
+        uncached = set(await asyncio.to_thread(self.uncached, unseen))
+        # a link is only marked seen together with being queued (or found cached), so no checkpoint holds a seen
+        # link that the frontier does not
+        for link_long_url in unseen:
+            if not self.seen.add(link_long_url) or link_long_url not in uncached:
+                continue
+            if frontier.add(link_long_url, entry.depth + 1, link_priority(link_long_url, entry.depth + 1)):
                 self.logger.info("New link detected: %s. Adding to the queue." % link_long_url)
-                self.queue.add(link_long_url)
+        return False
+
+    async def is_allowed(self, session: aiohttp.ClientSession, frontier: Frontier, url: str) -> Optional[bool]:
+        """Whether robots.txt allows fetching `url`; None if it could not be read."""
+        parse_res = urlparse(url)
+        rules = await self.robots.get(session, parse_res.scheme, parse_res.netloc)
+        if rules is None:
+            return None
+
+        frontier.set_delay(parse_res.netloc, self.robots.crawl_delay(rules))
+        return rules.can_fetch(USER_AGENT, url)
+
+    async def worker(self, session: aiohttp.ClientSession, frontier: Frontier) -> None:
+        while True:
+            got = await frontier.get()
+            if got is None:
+                return
+
+            entry, priority = got
+            failed = False
+            try:
+                allowed = await self.is_allowed(session, frontier, entry.url)
+                if allowed is None:
+                    self.logger.info("Could not read robots.txt for %s." % entry.url)
+                    failed = True
+                elif allowed:
+                    failed = await self.process_url(session, frontier, entry)
+                else:
+                    self.logger.info("Disallowed by robots.txt: %s." % entry.url)
+            except Exception as e:
+                self.logger.error("Error processing URL: %s" % e)
+            finally:
+                frontier.done(entry, priority, failed)
+
+    async def checkpoint(self, frontier: Frontier) -> None:
+        # `dumps` copies the bits and the frontier on the loop, so the write in the thread sees them consistent
+        try:
+            await asyncio.to_thread(save, self.seen.dumps(frontier.snapshot()), SEEN_CHECKPOINT_PATH)
+        except OSError as e:
+            self.logger.error("Checkpointing the seen URLs failed: %s" % e)
+
+    async def checkpoint_periodically(self, frontier: Frontier) -> None:
+        while True:
+            await asyncio.sleep(SEEN_CHECKPOINT_PERIOD)
+            await self.checkpoint(frontier)
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(ES_BULK_INTERVAL)
+            await asyncio.to_thread(self.indexer.flush_if_due)
+
+    async def crawl(self) -> None:
+        await asyncio.to_thread(self.indexer.ensure_index)
+        frontier = Frontier()
+        for url, depth, attempts, priority in self.pending:
+            frontier.add(url, depth, priority, attempts)
+        if self.pending:
+            self.logger.info("Resuming with %d URLs from the last checkpoint." % len(self.pending))
+        self.seen.add(self.start_url)
+        frontier.add(self.start_url, 0, link_priority(self.start_url, 0))
+
+        connector = aiohttp.TCPConnector(limit=CRAWL_CONCURRENCY, limit_per_host=CRAWL_CONNECTIONS_PER_HOST)
+        timeout = aiohttp.ClientTimeout(total=FETCH_TIMEOUT, sock_connect=FETCH_CONNECT_TIMEOUT)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers={"User-Agent": USER_AGENT}
+        ) as session:
+            background = [
+                asyncio.create_task(self.checkpoint_periodically(frontier)),
+                asyncio.create_task(self.flush_periodically()),
+            ]
+            await asyncio.gather(*(self.worker(session, frontier) for _ in range(CRAWL_CONCURRENCY)))
+            for task in background:
+                task.cancel()
+
+        await asyncio.to_thread(self.indexer.drain)
+        await self.checkpoint(frontier)
 
     def run(self) -> None:
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as process_ops_exec:
-            futures = set()
-            while self.queue or futures:
-                while self.queue and len(futures) < MAX_WORKERS:
-                    current_url = self.queue.pop()
-                    future = process_ops_exec.submit(self.process_single_url, current_url)
-                    futures.add(future)
-
-                done_futures = {f for f in futures if f.done()}
-                futures.difference_update(done_futures)
-                for future in done_futures:
-                    try:
-                        future.result()
-                    except Exception as e:
-                        self.logger.error("Error processing URL: %s" % e)
-
-            self.logger.info("Crawler is done!")
+        asyncio.run(self.crawl())
+        self.logger.info("Crawler is done!")
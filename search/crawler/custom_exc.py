@@ -0,0 +1,6 @@
+class FetchError(Exception):
+    """A page could not be fetched; `retryable` if a later attempt may succeed."""
+
+    def __init__(self, message: str, retryable: bool) -> None:
+        super().__init__(message)
+        self.retryable = retryable
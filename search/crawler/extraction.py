@@ -0,0 +1,60 @@
+from html.parser import HTMLParser
+from typing import List, NamedTuple
+
+
+class ExtractedPage(NamedTuple):
+    text: str
+    title: str
+    links: List[str]
+
+
+class PageExtractor(HTMLParser):
+    """Collects the visible text, the title and the links of a page in one pass."""
+
+    # elements whose content is never shown as text
+    SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg"}
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.urls: List[str] = []
+        self.text_parts: List[str] = []
+        self.title_parts: List[str] = []
+        self.skip_depth = 0
+        self.in_title = False
+
+    def handle_starttag(self, tag: str, attrs: List[tuple[str, str | None]]) -> None:
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag == "title":
+            self.in_title = True
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            if href is not None:
+                self.urls.append(href)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag == "title":
+            self.in_title = False
+
+    def handle_data(self, data: str) -> None:
+        if self.skip_depth:
+            return
+        if self.in_title:
+            self.title_parts.append(data)
+        else:
+            self.text_parts.append(data)
+
+    def result(self) -> ExtractedPage:
+        # HTML collapses runs of whitespace when rendering, and so does the text
+        return ExtractedPage(
+            " ".join(" ".join(self.text_parts).split()), " ".join(" ".join(self.title_parts).split()), self.urls
+        )
+
+
+def extract(page: str) -> ExtractedPage:
+    extractor = PageExtractor()
+    extractor.feed(page)
+    extractor.close()
+    return extractor.result()
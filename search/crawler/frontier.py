@@ -0,0 +1,113 @@
+"""URL frontier: what to crawl next, and when.
+
+URLs wait in one priority queue per host (lower priority first); hosts wait in a heap by the time they may be
+hit again. A host hands out one URL at a time and only becomes ready again `delay` seconds after that URL is
+done, so no host sees more than one request per delay however many workers are crawling.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+from .constants import CRAWL_DELAY, FETCH_MAX_ATTEMPTS, MAX_RETRY_BACKOFF, RETRY_BACKOFF
+
+
+class FrontierEntry(NamedTuple):
+    url: str
+    depth: int
+    attempts: int = 0
+
+
+def get_host(url: str) -> str:
+    return urlparse(url).netloc
+
+
+class Frontier:
+    def __init__(self) -> None:
+        self.counter = itertools.count()
+        # per host: (priority, insertion order, entry)
+        self.queues: Dict[str, List[Tuple[float, int, FrontierEntry]]] = {}
+        # (ready at, host) of the hosts with queued URLs and none in flight
+        self.ready: List[Tuple[float, str]] = []
+        self.delays: Dict[str, float] = {}
+        # when each host that had a URL done may be hit again, so one going idle does not reset its delay
+        self.not_before: Dict[str, float] = {}
+        # queued or in flight, so a URL is only ever in the frontier once
+        self.pending: Set[str] = set()
+        # url -> (entry, priority) of the URLs handed out and not done yet
+        self.in_flight: Dict[str, Tuple[FrontierEntry, float]] = {}
+        self.changed = asyncio.Event()
+
+    def add(self, url: str, depth: int, priority: float, attempts: int = 0) -> bool:
+        """Queues `url` unless it is already pending; returns whether it was queued."""
+        if url in self.pending:
+            return False
+
+        self.pending.add(url)
+        self._push(FrontierEntry(url, depth, attempts), priority, time.monotonic())
+        return True
+
+    def snapshot(self) -> List[Tuple[str, int, int, float]]:
+        """`(url, depth, attempts, priority)` of every URL queued or in flight, to `add` them back after a restart."""
+        entries = [(entry, priority) for queue in self.queues.values() for priority, _, entry in queue]
+        entries.extend(self.in_flight.values())
+        return [(entry.url, entry.depth, entry.attempts, priority) for entry, priority in entries]
+
+    def _push(self, entry: FrontierEntry, priority: float, ready_at: float) -> None:
+        host = get_host(entry.url)
+        queue = self.queues.get(host)
+        if queue is None:
+            # idle host: schedule it; a busy one is scheduled again when its URL is done
+            queue = self.queues[host] = []
+            heapq.heappush(self.ready, (max(ready_at, self.not_before.get(host, ready_at)), host))
+        heapq.heappush(queue, (priority, next(self.counter), entry))
+        self.changed.set()
+
+    def set_delay(self, host: str, delay: float) -> None:
+        self.delays[host] = delay
+
+    async def get(self) -> Optional[Tuple[FrontierEntry, float]]:
+        """Waits for a URL whose host may be hit now; None once the frontier is empty and nothing is in flight."""
+        while True:
+            now = time.monotonic()
+            if self.ready and self.ready[0][0] <= now:
+                _, host = heapq.heappop(self.ready)
+                priority, _, entry = heapq.heappop(self.queues[host])
+                self.in_flight[entry.url] = (entry, priority)
+                return entry, priority
+
+            if not self.ready and not self.in_flight:
+                return None
+
+            self.changed.clear()
+            timeout = self.ready[0][0] - now if self.ready else None
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, entry: FrontierEntry, priority: float, failed: bool = False) -> None:
+        """Marks `entry` as handled; a failed one is retried after a backoff, up to `FETCH_MAX_ATTEMPTS` times.
+
+        The host of a failed URL backs off as a whole: failures are mostly the host being down or throttling.
+        """
+        del self.in_flight[entry.url]
+        host = get_host(entry.url)
+        ready_at = time.monotonic() + self.delays.get(host, CRAWL_DELAY)
+        queue = self.queues[host]
+
+        if failed and entry.attempts + 1 < FETCH_MAX_ATTEMPTS:
+            ready_at += min(RETRY_BACKOFF * 2**entry.attempts, MAX_RETRY_BACKOFF)
+            heapq.heappush(queue, (priority, next(self.counter), entry._replace(attempts=entry.attempts + 1)))
+        else:
+            self.pending.discard(entry.url)
+
+        self.not_before[host] = ready_at
+        if queue:
+            heapq.heappush(self.ready, (ready_at, host))
+        else:
+            del self.queues[host]
+        self.changed.set()
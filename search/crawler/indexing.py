@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import elasticsearch
+import redis
+from elasticsearch import helpers
+
+from .analysis import analyze
+from .constants import ES_BULK_INTERVAL, ES_BULK_MAX_ATTEMPTS, ES_BULK_MAX_BYTES, ES_BULK_SIZE, ES_INDEX
+from .corpus_stats import CorpusStats
+from .extraction import ExtractedPage
+from .page_cache import compress_page
+
+# `frequency` maps every term of a page to its count: kept in `_source` for the search API to read, but not
+# indexed, or each new term would add a field to the mapping
+ES_PROPERTIES: Dict[str, Dict[str, Any]] = {
+    "content": {"type": "text"},
+    "title": {"type": "text"},
+    "frequency": {"type": "object", "enabled": False},
+    "doc_length": {"type": "integer"},
+}
+ES_MAPPINGS = {"properties": ES_PROPERTIES}
+
+
+def is_retryable(item: Optional[Dict[str, Any]]) -> bool:
+    """Whether a failed bulk item may succeed later: the request failed, or the item was throttled or hit a
+    server error, rather than being a document Elasticsearch will never take.
+    """
+    if item is None:
+        return True
+    status = next(iter(item.values())).get("status", 500)
+    return status == 429 or status >= 500
+
+
+class BulkIndexer:
+    """Buffers crawled pages and indexes their text through the bulk API.
+
+    A batch is shipped once `ES_BULK_SIZE` pages or `ES_BULK_MAX_BYTES` of content are buffered, or when
+    `flush_if_due` finds the oldest page has waited `ES_BULK_INTERVAL` seconds. Only the pages Elasticsearch
+    accepted are cached in Redis and counted in the corpus statistics, with one corpus generation bump per
+    batch. Pages it throttles or fails on, or that a failed request never delivered, are put back for the next
+    batch, up to `ES_BULK_MAX_ATTEMPTS` times.
+    """
+
+    def __init__(
+        self,
+        binary_redis_instance: redis.Redis,
+        es_instance: elasticsearch.Elasticsearch,
+        corpus_stats: CorpusStats,
+        logger: logging.Logger,
+    ) -> None:
+        self.redis = binary_redis_instance
+        self.es = es_instance
+        self.corpus_stats = corpus_stats
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        # (url, document, compressed page, charset, ttl, attempts)
+        self.pending: List[Tuple[str, Dict[str, Any], bytes, str, int, int]] = []
+        self.pending_bytes = 0
+        self.oldest_at = 0.0
+
+    def ensure_index(self) -> None:
+        try:
+            if self.es.indices.exists(index=ES_INDEX):
+                self.es.indices.put_mapping(index=ES_INDEX, properties=ES_PROPERTIES)
+            else:
+                self.es.indices.create(index=ES_INDEX, mappings=ES_MAPPINGS)
+        except (elasticsearch.ApiError, elasticsearch.TransportError) as e:
+            self.logger.error("Setting up the mappings of %s failed: %s" % (ES_INDEX, e))
+
+    def add(self, url: str, page: str, extracted: ExtractedPage, charset: str, ttl: int) -> None:
+        term_freqs, doc_length = analyze(extracted.text)
+        document = {
+            "content": extracted.text,
+            "title": extracted.title,
+            "frequency": term_freqs,
+            "doc_length": doc_length,
+        }
+        with self.lock:
+            if not self.pending:
+                self.oldest_at = time.monotonic()
+            self.pending.append((url, document, compress_page(page), charset, ttl, 0))
+            self.pending_bytes += len(extracted.text)
+            full = len(self.pending) >= ES_BULK_SIZE or self.pending_bytes >= ES_BULK_MAX_BYTES
+
+        if full:
+            self.flush()
+
+    def flush_if_due(self) -> None:
+        with self.lock:
+            due = bool(self.pending) and time.monotonic() - self.oldest_at >= ES_BULK_INTERVAL
+
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                self.pending_bytes = 0
+
+            if not batch:
+                return
+
+            actions = ({"_index": ES_INDEX, "_id": url, "_source": document} for url, document, *_ in batch)
+            # one outcome per action, in order; items rejected as too many requests are retried by a later flush
+            outcomes: List[Tuple[bool, Any]] = []
+            try:
+                outcomes.extend(
+                    helpers.streaming_bulk(
+                        self.es,
+                        actions,
+                        chunk_size=ES_BULK_SIZE,
+                        max_chunk_bytes=ES_BULK_MAX_BYTES,
+                        raise_on_error=False,
+                        raise_on_exception=False,
+                    )
+                )
+            except elasticsearch.TransportError as e:
+                self.logger.error("Bulk indexing failed: %s" % e)
+            outcomes.extend([(False, None)] * (len(batch) - len(outcomes)))
+
+            indexed = []
+            failed = []
+            for (url, document, compressed, charset, ttl, attempts), (ok, item) in zip(batch, outcomes):
+                if ok:
+                    indexed.append((url, document, compressed, charset, ttl))
+                elif is_retryable(item) and attempts + 1 < ES_BULK_MAX_ATTEMPTS:
+                    failed.append((url, document, compressed, charset, ttl, attempts + 1))
+                else:
+                    self.logger.error("Indexing the document at %s failed: %s" % (url, item))
+
+            self._requeue(failed)
+            if indexed:
+                self._publish(indexed)
+
+    def drain(self) -> None:
+        """Flushes until every page is indexed or out of attempts."""
+        self.flush()
+        while self.pending:
+            time.sleep(ES_BULK_INTERVAL)
+            self.flush()
+
+    def _publish(self, indexed: List[Tuple[str, Dict[str, Any], bytes, str, int]]) -> None:
+        self.corpus_stats.add_documents(
+            [(url, document["frequency"], document["doc_length"]) for url, document, *_ in indexed]
+        )
+        with self.redis.pipeline(transaction=False) as pipe:
+            for url, _, compressed, charset, ttl in indexed:
+                pipe.set(url, compressed, ex=ttl)
+                pipe.hset("metadata:%s" % url, mapping={"charset": charset, "expires": ttl})
+            pipe.execute()
+
+    def _requeue(self, failed: List[Tuple[str, Dict[str, Any], bytes, str, int, int]]) -> None:
+        if not failed:
+            return
+
+        with self.lock:
+            if not self.pending:
+                self.oldest_at = time.monotonic()
+            self.pending[:0] = failed
+            self.pending_bytes += sum(len(document["content"]) for _, document, *_ in failed)
@@ -5,14 +5,19 @@ import elasticsearch
 import redis
 
 from .caching import CacheValidator
-from .constants import ES_CONN_STR, REDIS_CRAWLER_CONN_STR, VALIDATOR_PERIOD
+from .constants import ES_CONN_STR, REDIS_CORPUS_CONN_STR, REDIS_CRAWLER_CONN_STR, VALIDATOR_PERIOD
+from .corpus_stats import CorpusStats
 from .crawler import Crawler
 
 if __name__ == "__main__":
     r = redis.Redis.from_url(REDIS_CRAWLER_CONN_STR, decode_responses=True)
+    # for the compressed page cache
+    binary_r = redis.Redis.from_url(REDIS_CRAWLER_CONN_STR)
 
     es = elasticsearch.Elasticsearch(ES_CONN_STR)
 
+    corpus_stats = CorpusStats(redis.Redis.from_url(REDIS_CORPUS_CONN_STR, decode_responses=True))
+
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
     handler = logging.StreamHandler(sys.stdout)
@@ -20,7 +25,7 @@ if __name__ == "__main__":
     logger.addHandler(handler)
 
     # run once
-    crawler = Crawler("https://isitchristmas.com/", r, es, logger)
+    crawler = Crawler("https://isitchristmas.com/", r, binary_r, es, corpus_stats, logger)
 
     import time
 
@@ -31,7 +36,7 @@ if __name__ == "__main__":
 
     # schedule a cache validator run
     elapsed = once_elapsed
-    cache_validator = CacheValidator(r, es, logger)
+    cache_validator = CacheValidator(r, binary_r, es, corpus_stats, logger)
     while True:
         time.sleep(VALIDATOR_PERIOD - elapsed)
         run_start = time.perf_counter()
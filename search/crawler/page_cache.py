@@ -0,0 +1,28 @@
+"""Raw pages cached in Redis under their URL, zlib-compressed.
+
+The cached values are binary, so they are read and written through a client that does not decode responses.
+Pages cached before compression was introduced are plain UTF-8 and are still read as such.
+"""
+
+import zlib
+from typing import Optional, cast
+
+import redis
+
+from .constants import PAGE_COMPRESSION_LEVEL
+
+
+def compress_page(page: str) -> bytes:
+    return zlib.compress(page.encode(), PAGE_COMPRESSION_LEVEL)
+
+
+def decompress_page(blob: bytes) -> str:
+    try:
+        return zlib.decompress(blob).decode()
+    except zlib.error:
+        return blob.decode("utf-8", errors="replace")
+
+
+def get_page(binary_redis_instance: redis.Redis, url: str) -> Optional[str]:
+    blob = cast(Optional[bytes], binary_redis_instance.get(url))
+    return decompress_page(blob) if blob else None
@@ -0,0 +1,44 @@
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+from urllib.robotparser import RobotFileParser
+
+import aiohttp
+
+from .constants import CRAWL_DELAY, MAX_CRAWL_DELAY, ROBOTS_TTL, USER_AGENT
+
+
+class RobotsCache:
+    """The robots.txt rules of each host, fetched once per `ROBOTS_TTL` seconds.
+
+    As in RFC 9309, a missing robots.txt (4xx) allows everything; an unreachable one (5xx, network errors) is
+    not cached, and the host is not crawled until it can be read.
+    """
+
+    def __init__(self) -> None:
+        self.rules: Dict[str, Tuple[RobotFileParser, float]] = {}
+
+    async def get(self, session: aiohttp.ClientSession, scheme: str, host: str) -> Optional[RobotFileParser]:
+        """The rules of `host`; None if its robots.txt is unreachable."""
+        cached = self.rules.get(host)
+        if cached is not None and time.monotonic() - cached[1] < ROBOTS_TTL:
+            return cached[0]
+
+        rules = RobotFileParser()
+        try:
+            async with session.get("%s://%s/robots.txt" % (scheme, host)) as resp:
+                if resp.status >= 500:
+                    return None
+                # no robots.txt: no rules, everything is allowed
+                lines = (await resp.text(errors="replace")).splitlines() if resp.status < 400 else []
+                rules.parse(lines)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+
+        self.rules[host] = (rules, time.monotonic())
+        return rules
+
+    @staticmethod
+    def crawl_delay(rules: RobotFileParser) -> float:
+        delay = rules.crawl_delay(USER_AGENT)
+        return min(float(delay), MAX_CRAWL_DELAY) if delay is not None else CRAWL_DELAY
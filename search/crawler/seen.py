@@ -0,0 +1,102 @@
+"""Bloom filter of the URLs the crawler has already discovered.
+
+A URL is `n_hashes` bits of an `n_bits` array, picked by double hashing one 128-bit BLAKE2 digest. Sized for
+`capacity` URLs at a `false_positive_rate`, it takes about 1.44 * log2(1 / rate) bits per URL, e.g. 1.8 MB
+for ten million URLs at 0.1%. A false positive makes the crawler skip a URL it has not actually seen.
+
+Checkpoint layout: a header (magic, format version, bits, hashes, URLs added, creation time), the bits, then
+the URLs still in the frontier as JSON. The filter counts those as seen too, so without them a restarted crawl
+would never get to them.
+"""
+
+import hashlib
+import json
+import math
+import os
+import struct
+import time
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+MAGIC = b"EBLM"
+VERSION = 2
+
+HEADER = struct.Struct("<4sHQIQd")
+
+# (url, depth, attempts, priority) of a URL queued or in flight in the frontier
+PendingURL = Tuple[str, int, int, float]
+
+
+class SeenFilter:
+    def __init__(self, n_bits: int, n_hashes: int, bits: Optional[bytearray] = None, count: int = 0) -> None:
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.bits = bits if bits is not None else bytearray((n_bits + 7) // 8)
+        self.count = count
+        self.created_at = time.time()
+
+    @classmethod
+    def for_capacity(cls, capacity: int, false_positive_rate: float) -> "SeenFilter":
+        n_bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        return cls(n_bits, max(round(n_bits / capacity * math.log(2)), 1))
+
+    def _positions(self, url: str) -> Iterator[int]:
+        digest = hashlib.blake2b(url.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def __contains__(self, url: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(url))
+
+    def add(self, url: str) -> bool:
+        """Adds `url`; returns whether it was new (as far as the filter can tell)."""
+        new = False
+        for pos in self._positions(url):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                new = True
+
+        self.count += new
+        return new
+
+    def dumps(self, pending: Sequence[PendingURL] = ()) -> bytes:
+        header = HEADER.pack(MAGIC, VERSION, self.n_bits, self.n_hashes, self.count, self.created_at)
+        return header + bytes(self.bits) + json.dumps(pending, separators=(",", ":")).encode()
+
+    @classmethod
+    def loads(cls, blob: bytes) -> Tuple["SeenFilter", List[PendingURL]]:
+        """The filter and the pending URLs checkpointed with it."""
+        magic, version, n_bits, n_hashes, count, created_at = HEADER.unpack_from(blob, 0)
+        bits_start, bits_end = HEADER.size, HEADER.size + (n_bits + 7) // 8
+        if magic != MAGIC or version != VERSION or len(blob) < bits_end:
+            raise ValueError("Not a version %d seen filter." % VERSION)
+
+        seen = cls(n_bits, n_hashes, bytearray(blob[bits_start:bits_end]), count)
+        seen.created_at = created_at
+        pending = [(url, depth, attempts, priority) for url, depth, attempts, priority in json.loads(blob[bits_end:])]
+        return seen, pending
+
+
+def save(blob: bytes, path: str) -> None:
+    """Writes a checkpoint made by `SeenFilter.dumps` so that a crash never leaves a partial one."""
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "wb") as f:
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def load(path: str, capacity: int, false_positive_rate: float, max_age: float) -> Tuple[SeenFilter, List[PendingURL]]:
+    """The checkpointed filter at `path` and the pending URLs to restore into the frontier, or an empty filter
+    and none if there is no checkpoint, it is unreadable, sized for other settings, or older than `max_age`
+    seconds: by then the pages it remembers have expired from the cache and are due to be crawled again.
+    """
+    fresh = SeenFilter.for_capacity(capacity, false_positive_rate)
+    try:
+        with open(path, "rb") as f:
+            seen, pending = SeenFilter.loads(f.read())
+    except (OSError, ValueError, TypeError, struct.error):
+        return fresh, []
+
+    if (seen.n_bits, seen.n_hashes) != (fresh.n_bits, fresh.n_hashes) or time.time() - seen.created_at > max_age:
+        return fresh, []
+    return seen, pending
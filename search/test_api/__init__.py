@@ -1,10 +1,30 @@
+import math
 import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
 from unittest.mock import MagicMock, patch
 
+import numpy as np
+import scipy.sparse
+from api.algorithms import bm25_inputs, okapi_bm25, okapi_bm25_batch, top_k_bm25
+from api.analysis import analyze, tokenize
+from api.caching import ResultCache
+from api.coalescing import SingleFlight
 from api.custom_exc import DocumentRetrievalError
-from api.main import app, get_recommendations, redis_instance, repo  # noqa: F401
+from api.lsh import LSHIndex, hash_query, make_vectorizer
+from api.main import app, get_recommendations, personalize, redis_instance, repo  # noqa: F401
+from api.mlapi_client import MLAPIClient
+from api.mmap_index import MmapInvIdxRepository, write_index
+from api.model_codec import decode, encode
+from api.recommender import RecommendationModel
 from flask import Flask  # noqa: F401
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
 
 
 class SearchTestCase(unittest.TestCase):
@@ -12,32 +32,40 @@ class SearchTestCase(unittest.TestCase):
         self.app = app.test_client()
         self.app.testing = True
 
-        os.environ["MLAPI_BASE_URL"] = "localhost:5070"
-        os.environ["ES_CONN_STR"] = None
-        os.environ["REDIS_RESULTS_CONN_STR"] = None
-
-    def tearDown(self) -> None:
-        del os.environ["MLAPI_BASE_URL"]
-        del os.environ["ES_CONN_STR"]
-        del os.environ["REDIS_RESULTS_CONN_STR"]
+        patcher = patch.dict(
+            os.environ, {"MLAPI_BASE_URL": "localhost:5070", "ES_CONN_STR": "", "REDIS_RESULTS_CONN_STR": ""}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
-    @patch("api.main.redis_instance")
-    @patch("api.main.requests.get")
-    @patch("api.main.requests.post")
+    @patch("api.main.executor", new_callable=lambda: ThreadPoolExecutor(max_workers=2))
+    @patch("api.main.result_cache")
+    @patch("api.main.model_cache")
+    @patch("api.main.mlapi")
+    @patch("api.main.repo.get_documents_content")
     @patch("api.main.repo.get_documents")
     @patch("api.main.get_recommendations")
-    def test_search_success(self, mock_get_recommendations, mock_get_documents, mock_post, mock_get, mock_redis):
+    def test_search_success(
+        self,
+        mock_get_recommendations,
+        mock_get_documents,
+        mock_get_documents_content,
+        mock_mlapi,
+        mock_model_cache,
+        mock_result_cache,
+        executor,
+    ):
         # Mock request parameters
         query = "test query"
         sorted_query = "query+test"
 
         # Mock Redis
-        mock_redis.get.return_value = None
-        mock_redis.set = MagicMock()
+        mock_model_cache.get.return_value = None
+        mock_result_cache.get.return_value = None
 
         # Mock external API calls
-        mock_get.return_value = MagicMock(status_code=404)
-        mock_post.return_value = MagicMock(ok=True, json=lambda: {"id": 1})
+        mock_mlapi.get_user_profile_id.return_value = 1
+        mock_mlapi.reserve_search_query_id.return_value = 7
 
         # Mock repository response
         mock_get_documents.return_value = (
@@ -45,6 +73,7 @@ class SearchTestCase(unittest.TestCase):
             1.0,
             {"test": {"freqs": {"1": 1}, "idf": 1.0}, "query": {"freqs": {"1": 1}, "idf": 1.0}},
         )
+        mock_get_documents_content.return_value = {"1": "content"}
 
         # Mock recommendations
         mock_get_recommendations.return_value = []
@@ -56,20 +85,69 @@ class SearchTestCase(unittest.TestCase):
         response_data = response.get_json()
         self.assertIn("pages", response_data)
         self.assertIsInstance(response_data["pages"], list)
-        mock_redis.set.assert_called_with(sorted_query, response_data["pages"])
+        self.assertEqual(response_data["pages"][0]["snippet"], "content")
+        self.assertNotIn("content", response_data["pages"][0])
+        mock_result_cache.set.assert_called_with("page:1:10:compact:%s" % sorted_query, response_data["pages"])
+        # the id is reserved up front, the query is logged behind the response
+        self.assertEqual(response_data["search_query_id"], 7)
+        executor.shutdown(wait=True)
+        mock_mlapi.log_search_query.assert_called_once_with(7, 1, query)
 
-    @patch("api.main.redis_instance")
-    def test_search_cached_result(self, mock_redis):
+    @patch("api.main.personalize")
+    @patch("api.main.result_cache")
+    def test_search_cached_result(self, mock_result_cache, mock_personalize):
         # Mock cached result
         cached_result = [{"id": "1", "content": "cached content", "score": 1}]
-        mock_redis.get.return_value = cached_result
+        mock_result_cache.get.return_value = cached_result
+        mock_personalize.return_value = (None, [])
 
         # Make GET request to /search
         response = self.app.get("/search?q=test")
 
         self.assertEqual(response.status_code, 200)
         response_data = response.get_json()
-        self.assertEqual(response_data, cached_result)
+        self.assertEqual(response_data, {"pages": cached_result, "page": 1, "size": 10})
+        # the search is still logged
+        mock_personalize.assert_called_once_with("127000000001", "test")
+
+    @patch("api.main.PERSONALIZATION_TIMEOUT", 0.01)
+    @patch("api.main.personalize")
+    @patch("api.main.result_cache")
+    def test_search_slow_personalization(self, mock_result_cache, mock_personalize):
+        cached_result = [{"id": "1", "content": "cached content", "score": 1}]
+        mock_result_cache.get.return_value = cached_result
+        released = threading.Event()
+        mock_personalize.side_effect = lambda client_ip, query: released.wait(5) and (7, ["http://rec.com/"])
+
+        try:
+            response = self.app.get("/search?q=test")
+        finally:
+            released.set()
+
+        # the search does not wait for the ML API past its deadline
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"pages": cached_result, "page": 1, "size": 10})
+
+    @patch("api.main.personalize")
+    @patch("api.main.repo.get_documents_content")
+    @patch("api.main.result_cache")
+    def test_search_cached_result_with_recommendations(
+        self, mock_result_cache, mock_get_documents_content, mock_personalize
+    ):
+        # The shared page is cached, but this user has recommendations: they are merged into the cached ranking
+        cached = {
+            "page:1:10:compact:test": [{"id": "1", "url": "1", "score": 0.5, "snippet": "cached content"}],
+            "test": [{"id": "1", "url": "1", "score": 0.5}],
+        }
+        mock_result_cache.get.side_effect = cached.get
+        mock_personalize.return_value = (None, ["http://rec.com/"])
+        mock_get_documents_content.return_value = {"1": "cached content", "http://rec.com/": "recommended"}
+
+        response = self.app.get("/search?q=test")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([doc["id"] for doc in response.get_json()["pages"]], ["http://rec.com/", "1"])
+        mock_result_cache.set.assert_not_called()
 
     def test_search_malformed_query(self):
         # Make GET request with incorrect query param
@@ -79,9 +157,11 @@ class SearchTestCase(unittest.TestCase):
         self.assertIn("error", response_data)
         self.assertEqual(response_data["error"], "Malformed query params")
 
+    @patch("api.main.result_cache")
     @patch("api.main.repo.get_documents")
-    def test_search_document_retrieval_error(self, mock_get_documents):
+    def test_search_document_retrieval_error(self, mock_get_documents, mock_result_cache):
         # Mock exception in document retrieval
+        mock_result_cache.get.return_value = None
         mock_get_documents.side_effect = DocumentRetrievalError("Test error")
 
         # Make GET request to /search
@@ -92,5 +172,362 @@ class SearchTestCase(unittest.TestCase):
         self.assertEqual(response_data["error"], "Something went wrong while fetching results.")
 
 
+class AnalysisTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = app.test_client()
+
+    def test_crawler_copy_is_identical(self):
+        copies = []
+        for package in ["api", "crawler"]:
+            with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), package, "analysis.py"), "rb") as f:
+                copies.append(f.read())
+        self.assertEqual(copies[0], copies[1], "analysis.py differs between the crawler and the search API")
+
+    @patch("api.main.personalize", return_value=(None, []))
+    @patch("api.main.result_cache")
+    @patch("api.main.repo.get_documents", return_value=({}, 0.0, {}))
+    def test_query_split_like_indexed_pages(self, mock_get_documents, mock_result_cache, mock_personalize):
+        mock_result_cache.get.return_value = None
+
+        response = self.client.get("/search?q=Foo-bar C%2B%2B")
+
+        self.assertEqual(response.status_code, 200)
+        term_freqs, _ = analyze("foo-bar c++")
+        self.assertEqual(mock_get_documents.call_args.args[0], list(term_freqs))
+        self.assertEqual(tokenize("Foo-bar C++"), ["foo", "bar", "c"])
+
+
+class InvIdxDBRepositoryTestCase(unittest.TestCase):
+    @patch.object(repo, "corpus_stats", None)
+    @patch.object(repo, "es")
+    def test_get_documents_bulk(self, mock_es):
+        # One multi-search for all keywords, one multi-get for all the bodies
+        mock_es.msearch.return_value = {
+            "responses": [
+                {"hits": {"hits": [{"_id": "a", "_source": {"frequency": {"test": 2}, "doc_length": 10}}]}},
+                {
+                    "hits": {
+                        "hits": [
+                            {"_id": "a", "_source": {"frequency": {"query": 1}, "doc_length": 10}},
+                            {"_id": "b", "_source": {"frequency": {"query": 3}, "doc_length": 20}},
+                        ]
+                    }
+                },
+            ]
+        }
+        mock_es.mget.return_value = {
+            "docs": [
+                {"_id": "a", "found": True, "_source": {"content": "content a"}},
+                {"_id": "b", "found": True, "_source": {"content": "content b"}},
+            ]
+        }
+
+        documents, avgdl, keyword_stats = repo.get_documents(["test", "query"])
+
+        mock_es.msearch.assert_called_once()
+        mock_es.mget.assert_called_once()
+        mock_es.search.assert_not_called()
+        mock_es.get.assert_not_called()
+        self.assertEqual(set(documents), {"a", "b"})
+        self.assertEqual(documents["b"]["content"], "content b")
+        self.assertEqual(avgdl, 15)
+        self.assertEqual(keyword_stats["query"]["freqs"], {"a": 1, "b": 3})
+        self.assertEqual(keyword_stats["test"]["freqs"], {"a": 2})
+        self.assertEqual(mock_es.msearch.call_args.kwargs["searches"][1]["_source"], ["frequency.test", "doc_length"])
+
+    @patch.object(repo, "corpus_stats", None)
+    @patch.object(repo, "es")
+    def test_get_documents_without_content(self, mock_es):
+        mock_es.msearch.return_value = {
+            "responses": [{"hits": {"hits": [{"_id": "a", "_source": {"frequency": {"test": 2}, "doc_length": 10}}]}}]
+        }
+
+        documents, _, _ = repo.get_documents(["test"], with_content=False)
+
+        mock_es.mget.assert_not_called()
+        self.assertNotIn("content", documents["a"])
+
+    @patch.object(repo, "corpus_stats")
+    @patch.object(repo, "es")
+    def test_get_documents_empty_corpus_stats(self, mock_es, mock_corpus_stats):
+        # An empty store reports no documents: the frequencies counted from the hits are kept
+        mock_es.msearch.return_value = {
+            "responses": [
+                {
+                    "hits": {
+                        "hits": [
+                            {"_id": "a", "_source": {"frequency": {"foo": 1}, "doc_length": 10}},
+                            {"_id": "b", "_source": {"frequency": {"foo": 2}, "doc_length": 20}},
+                        ]
+                    }
+                },
+                {"hits": {"hits": [{"_id": "a", "_source": {"frequency": {"bar": 1}, "doc_length": 10}}]}},
+            ]
+        }
+        mock_corpus_stats.get.return_value = (0, 0.0, {"foo": 0, "bar": 0})
+
+        _, avgdl, keyword_stats = repo.get_documents(["foo", "bar"], with_content=False)
+
+        self.assertEqual(avgdl, 15)
+        self.assertEqual(
+            {kw: (stats["doc_freq"], round(stats["idf"], 3)) for kw, stats in keyword_stats.items()},
+            {"foo": (2, -1.609), "bar": (1, 0.0)},
+        )
+
+    @patch.object(repo, "corpus_stats")
+    @patch.object(repo, "es")
+    def test_get_documents_corpus_stats(self, mock_es, mock_corpus_stats):
+        mock_es.msearch.return_value = {
+            "responses": [{"hits": {"hits": [{"_id": "a", "_source": {"frequency": {"test": 2}, "doc_length": 10}}]}}]
+        }
+        mock_corpus_stats.get.return_value = (100, 42.0, {"test": 9})
+
+        _, avgdl, keyword_stats = repo.get_documents(["test"], with_content=False)
+
+        self.assertEqual(avgdl, 42.0)
+        self.assertEqual(keyword_stats["test"]["doc_freq"], 9)
+        self.assertAlmostEqual(keyword_stats["test"]["idf"], math.log(91.5 / 9.5))
+
+
+class MmapInvIdxRepositoryTestCase(unittest.TestCase):
+    def test_get_documents(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "web_pages.idx")
+            write_index(
+                path,
+                [
+                    ("http://b.com/", "Test the query, test it!"),
+                    ("http://a.com/", "Nothing to see"),
+                    ("http://c.com/", "query " * 200),
+                ],
+            )
+            mmap_repo = MmapInvIdxRepository(path)
+
+            documents, avgdl, keyword_stats = mmap_repo.get_documents(["test", "query", "missing"])
+
+            self.assertEqual(set(documents), {"http://b.com/", "http://c.com/"})
+            self.assertEqual(documents["http://b.com/"]["content"], "Test the query, test it!")
+            self.assertEqual(documents["http://c.com/"]["doc_length"], 200)
+            self.assertEqual(avgdl, (5 + 3 + 200) / 3)
+            self.assertEqual(keyword_stats["test"]["freqs"], {"http://b.com/": 2})
+            self.assertEqual(keyword_stats["query"]["freqs"], {"http://b.com/": 1, "http://c.com/": 200})
+            self.assertEqual(keyword_stats["query"]["doc_freq"], 2)
+            self.assertIsNone(keyword_stats["missing"]["idf"])
+            self.assertEqual(mmap_repo.get_document_content("http://a.com/"), "Nothing to see")
+            self.assertEqual(mmap_repo.get_documents_content(["http://x.com/"]), {})
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store: Dict[str, bytes] = {}
+        self.generation = 0
+
+        self.redis = MagicMock()
+        self.redis.set.side_effect = lambda key, value, ex: self.store.__setitem__(key, value)
+        pipe = self.redis.pipeline.return_value.__enter__.return_value
+        pipe.execute.side_effect = lambda: [self.store.get(pipe.get.call_args.args[0]), 60]
+
+        self.generation_redis = MagicMock()
+        self.generation_redis.get.side_effect = lambda key: str(self.generation)
+
+    @patch("api.caching.INDEX_GENERATION_REFRESH_PERIOD", 0)
+    def test_round_trip_through_redis(self):
+        pages = [{"id": "1", "url": "1", "score": 0.5}]
+        ResultCache(self.redis, self.generation_redis).set("query+test", pages)
+
+        # a fresh process only has Redis to go by
+        self.assertEqual(ResultCache(self.redis, self.generation_redis).get("query+test"), pages)
+
+    @patch("api.caching.INDEX_GENERATION_REFRESH_PERIOD", 0)
+    def test_generation_bump_invalidates(self):
+        result_cache = ResultCache(self.redis, self.generation_redis)
+        result_cache.set("query+test", [])
+        self.assertEqual(result_cache.get("query+test"), [])
+
+        self.generation += 1
+        self.assertIsNone(result_cache.get("query+test"))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_concurrent_calls_share_one_computation(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return ["result"]
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(single_flight.do("query+test", compute))) for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["result"]] * 8)
+
+
+class MLAPIClientTestCase(unittest.TestCase):
+    def test_profile_id_is_cached(self):
+        mlapi = MLAPIClient()
+        mlapi.session = MagicMock()
+        mlapi.session.get.return_value = MagicMock(status_code=200, json=lambda: {"id": 3})
+
+        self.assertEqual(mlapi.get_user_profile_id("127000000001"), 3)
+        self.assertEqual(mlapi.get_user_profile_id("127000000001"), 3)
+
+        mlapi.session.get.assert_called_once()
+        self.assertTrue(mlapi.session.get.call_args.args[0].endswith("/user_profiles/127000000001/id/"))
+
+    def test_profile_created_when_missing(self):
+        mlapi = MLAPIClient()
+        mlapi.session = MagicMock()
+        mlapi.session.get.return_value = MagicMock(status_code=404)
+        mlapi.session.post.return_value = MagicMock(ok=True, json=lambda: {"id": 4})
+
+        self.assertEqual(mlapi.get_user_profile_id("127000000001"), 4)
+        self.assertEqual(mlapi.profile_ids.get("127000000001"), 4)
+
+    def test_search_query_ids_reserved_in_blocks(self):
+        mlapi = MLAPIClient()
+        mlapi.session = MagicMock()
+        mlapi.session.post.return_value = MagicMock(ok=True, json=lambda: {"ids": [5, 6]})
+
+        self.assertEqual([mlapi.reserve_search_query_id() for _ in range(3)], [5, 6, 5])
+        self.assertEqual(mlapi.session.post.call_count, 2)
+        self.assertTrue(mlapi.session.post.call_args.args[0].endswith("/search_queries/ids/"))
+
+
+class RecommendationModelTestCase(unittest.TestCase):
+    def test_matches_tfidf_cosine_similarity(self):
+        queries = ["python web framework", "flask tutorial", "best pizza in town", "python flask api"]
+        urls = [["http://a.com/"], ["http://b.com/"], ["http://c.com/"], ["http://d.com/", "http://b.com/"]]
+        vectorizer = TfidfVectorizer()
+        query_matrix = vectorizer.fit_transform(queries).tocsr()
+        model = RecommendationModel(vectorizer.get_feature_names_out().tolist(), vectorizer.idf_, query_matrix, urls)
+
+        scores = model.query_matrix @ model.vectorize("flask python")
+        expected = cosine_similarity(vectorizer.transform(["flask python"]), query_matrix).flatten()
+
+        np.testing.assert_allclose(scores, expected)
+        self.assertEqual(model.recommend("flask python", top_n=2), ["http://d.com/", "http://b.com/"])
+        self.assertEqual(model.recommend("unrelated words"), [])
+
+    def test_fills_up_from_neighbors(self):
+        queries = ["python web framework", "flask tutorial", "python flask api"]
+        urls = [["http://a.com/"], ["http://b.com/"], ["http://c.com/"]]
+        vectorizer = TfidfVectorizer()
+        query_matrix = vectorizer.fit_transform(queries).tocsr()
+        neighbors = scipy.sparse.csr_matrix(([0.2, 0.5], ([1, 1], [0, 2])), shape=(3, 3))
+        model = RecommendationModel(
+            vectorizer.get_feature_names_out().tolist(), vectorizer.idf_, query_matrix, urls, neighbors
+        )
+
+        self.assertEqual(model.recommend("tutorial", top_n=3), ["http://b.com/", "http://c.com/", "http://a.com/"])
+        self.assertEqual(model.recommend("tutorial", top_n=1), ["http://b.com/"])
+
+    def test_codec_round_trip(self):
+        vectorizer = TfidfVectorizer()
+        query_matrix = vectorizer.fit_transform(["python web framework", "flask tutorial"]).tocsr()
+        fields = {
+            "vocabulary": vectorizer.get_feature_names_out().tolist(),
+            "idf": vectorizer.idf_.astype(np.float32),
+            "query_matrix": query_matrix,
+            "urls": [["http://a.com/"], ["http://b.com/"]],
+        }
+
+        decoded = decode(encode(fields))
+
+        self.assertEqual(decoded["vocabulary"], fields["vocabulary"])
+        self.assertEqual(decoded["urls"], fields["urls"])
+        np.testing.assert_array_equal(decoded["idf"], fields["idf"])
+        np.testing.assert_allclose(decoded["query_matrix"].toarray(), query_matrix.toarray(), rtol=1e-6)
+        self.assertEqual(RecommendationModel.from_artifact(decoded).recommend("flask", top_n=1), ["http://b.com/"])
+        with self.assertRaises(ValueError):
+            decode(b"JSON" + encode(fields)[4:])
+
+
+class LSHIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        queries = ["python web framework", "flask tutorial", "best pizza in town", "python flask api"]
+        clicks = scipy.sparse.csr_matrix(np.array([[3, 0, 0], [0, 2, 0], [0, 0, 5], [1, 1, 0]], dtype=np.float32))
+        self.urls = ["http://python.org/", "http://flask.org/", "http://pizza.com/"]
+        self.index = LSHIndex.build(queries, clicks, self.urls)
+
+    def test_hash_query_matches_vectorizer(self):
+        for query in ["Python flask, FLASK api!", "caf\u00e9 cr\u00e8me", "a b"]:
+            indices, values = hash_query(query, self.index.params["n_features"])
+            expected = make_vectorizer(self.index.params).transform([query])
+            np.testing.assert_array_equal(indices, expected.indices)
+            np.testing.assert_allclose(values, expected.data, rtol=1e-6)
+
+    def test_recommends_clicks_of_similar_queries(self):
+        index = LSHIndex.from_fields(decode(encode(self.index.fields())))
+
+        self.assertEqual(index.recommend("pizza in town"), ["http://pizza.com/"])
+        self.assertEqual(index.recommend("Flask tutorial", top_n=1), ["http://flask.org/"])
+        self.assertEqual(index.recommend("unrelated words"), [])
+        self.assertEqual(index.recommend(""), [])
+
+    def test_personalize_falls_back_to_global_index(self):
+        with patch("api.main.mlapi") as mock_mlapi, patch("api.main.global_index_cache") as mock_global_index_cache:
+            mock_mlapi.get_user_profile_id.return_value = 0
+            mock_global_index_cache.get.return_value = self.index
+
+            search_query_id, recs = personalize("127.0.0.1", "best pizza")
+
+        self.assertIsNone(search_query_id)
+        self.assertEqual(recs, ["http://pizza.com/"])
+
+
+class BM25TestCase(unittest.TestCase):
+    def test_batch_matches_reference(self):
+        documents = {
+            "a": {"id": "a", "content": "short"},
+            "b": {"id": "b", "content": "a somewhat longer document"},
+            "c": {"id": "c", "content": "medium length"},
+        }
+        keywords = ["test", "query"]
+        keyword_stats = {
+            "test": {"freqs": {"a": 1, "b": 4}, "idf": 0.7},
+            "query": {"freqs": {"b": 2, "c": 1}, "idf": 1.3},
+        }
+        avgdl = 15.0
+
+        doc_ids, tf_matrix, doc_lengths, idf = bm25_inputs(documents, keywords, keyword_stats)
+        scores = okapi_bm25_batch(tf_matrix, doc_lengths, idf, avgdl)
+
+        for doc_id, score in zip(doc_ids, scores):
+            kw_aggregate_data = [
+                {"keyword": w, "f": keyword_stats[w]["freqs"].get(doc_id, 0), "idf": keyword_stats[w]["idf"]}
+                for w in keywords
+            ]
+            self.assertAlmostEqual(score, okapi_bm25(documents[doc_id]["content"], kw_aggregate_data, avgdl))
+
+    def test_top_k_matches_full_sort(self):
+        rng = random.Random(7)
+        documents = {str(i): {"id": str(i), "doc_length": rng.randint(5, 500)} for i in range(300)}
+        keywords = ["a", "b", "c"]
+        keyword_stats = {
+            w: {"freqs": {d: rng.randint(1, 9) for d in rng.sample(sorted(documents), 120)}, "idf": idf}
+            for w, idf in zip(keywords, [0.2, 1.5, 3.0])
+        }
+        avgdl = 250.0
+
+        doc_ids, tf_matrix, doc_lengths, idf = bm25_inputs(documents, keywords, keyword_stats)
+        scores = okapi_bm25_batch(tf_matrix, doc_lengths, idf, avgdl)
+        expected = sorted(zip(scores.tolist(), doc_ids), reverse=True)[:10]
+
+        top_k = top_k_bm25(documents, keywords, keyword_stats, avgdl, 10)
+
+        self.assertEqual([doc_id for doc_id, _ in top_k], [doc_id for _, doc_id in expected])
+        for (_, score), (expected_score, _) in zip(top_k, expected):
+            self.assertAlmostEqual(score, expected_score)
+
+
 if __name__ == "__main__":
     unittest.main()
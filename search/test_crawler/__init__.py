@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import os
+import tempfile
+import unittest
+from typing import Dict, List, Tuple
+from unittest.mock import MagicMock, patch
+
+import aiohttp
+import elasticsearch
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from crawler.caching import CacheValidator
+from crawler.constants import CRAWL_DELAY, FETCH_MAX_ATTEMPTS, RETRY_BACKOFF
+from crawler.crawler import Crawler
+from crawler.custom_exc import FetchError
+from crawler.extraction import ExtractedPage, extract
+from crawler.frontier import Frontier, FrontierEntry
+from crawler.indexing import BulkIndexer
+from crawler.page_cache import compress_page, decompress_page, get_page
+from crawler.seen import SeenFilter, load, save
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class FrontierTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        patcher = patch("crawler.frontier.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.frontier = Frontier()
+
+    async def test_host_waits_for_its_delay(self):
+        self.frontier.set_delay("a.com", 2.0)
+        self.frontier.add("http://a.com/1/", 1, 1.0)
+        self.frontier.add("http://a.com/2/", 1, 2.0)
+        self.frontier.add("http://b.com/1/", 1, 1.0)
+
+        entry, priority = await self.frontier.get()
+        self.assertEqual(entry.url, "http://a.com/1/")
+        # one URL per host at a time: the other host is served meanwhile
+        self.assertEqual((await self.frontier.get())[0].url, "http://b.com/1/")
+        self.frontier.done(entry, priority)
+
+        self.clock.now = 1.9
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.frontier.get(), 0.01)
+
+        self.clock.now = 2.0
+        self.assertEqual((await self.frontier.get())[0].url, "http://a.com/2/")
+
+    async def test_failed_url_retried_up_to_max_attempts(self):
+        self.frontier.add("http://a.com/", 0, 0.0)
+
+        attempts = []
+        while True:
+            got = await self.frontier.get()
+            if got is None:
+                break
+            entry, priority = got
+            attempts.append((entry.attempts, self.clock.now))
+            self.frontier.done(entry, priority, failed=True)
+            self.clock.now = self.frontier.ready[0][0] if self.frontier.ready else self.clock.now
+
+        self.assertEqual([attempt for attempt, _ in attempts], list(range(FETCH_MAX_ATTEMPTS)))
+        # the host backs off, doubling, on top of its crawl delay
+        self.assertEqual(attempts[1][1], CRAWL_DELAY + RETRY_BACKOFF)
+        self.assertEqual(attempts[2][1] - attempts[1][1], CRAWL_DELAY + 2 * RETRY_BACKOFF)
+        self.assertEqual(self.frontier.pending, set())
+
+    async def test_get_ends_once_nothing_is_queued_or_in_flight(self):
+        self.assertIsNone(await self.frontier.get())
+
+        self.frontier.add("http://a.com/", 0, 0.0)
+        entry, priority = await self.frontier.get()
+        # a URL in flight may still discover links: workers wait for it
+        waiting = asyncio.create_task(self.frontier.get())
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+
+        self.frontier.done(entry, priority)
+        self.assertIsNone(await waiting)
+
+    async def test_checkpoint_restores_queued_and_in_flight_urls(self):
+        self.frontier.add("http://a.com/1/", 1, 1.0)
+        self.frontier.add("http://b.com/1/", 2, 3.0)
+        await self.frontier.get()
+        seen = SeenFilter.for_capacity(1000, 0.01)
+        seen.add("http://a.com/1/")
+        seen.add("http://b.com/1/")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "seen.bloom")
+            save(seen.dumps(self.frontier.snapshot()), path)
+            restored, pending = load(path, 1000, 0.01, 3600)
+            with open(path, "wb") as f:
+                f.write(b"EBLM")
+            self.assertEqual(load(path, 1000, 0.01, 3600)[1], [])
+
+        self.assertIn("http://b.com/1/", restored)
+        self.assertEqual(sorted(pending), [("http://a.com/1/", 1, 0, 1.0), ("http://b.com/1/", 2, 0, 3.0)])
+
+
+class CrawlerFetchTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        async def handler(request: web.Request) -> web.Response:
+            return web.Response(
+                status=int(request.match_info["status"]),
+                text='<html><body>Status page <a href="/200/next">next</a></body></html>',
+                content_type="text/html",
+            )
+
+        app = web.Application()
+        app.router.add_get("/{status}/{page}", handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.session = aiohttp.ClientSession()
+
+        with patch("crawler.crawler.load", return_value=(MagicMock(), [])):
+            self.crawler = Crawler(
+                str(self.server.make_url("/")), MagicMock(), MagicMock(), MagicMock(), MagicMock(), logging.getLogger()
+            )
+        self.crawler.seen = MagicMock()
+        self.crawler.seen.add.return_value = True
+        self.crawler.indexer = MagicMock()
+        self.crawler.uncached = MagicMock(side_effect=lambda urls: urls)
+
+    async def asyncTearDown(self) -> None:
+        await self.session.close()
+        await self.server.close()
+
+    async def process(self, status: int) -> Tuple[bool, Frontier]:
+        frontier = Frontier()
+        entry = FrontierEntry(str(self.server.make_url("/%d/page" % status)), 0)
+        with patch("crawler.crawler.get_page", return_value=None):
+            failed = await self.crawler.process_url(self.session, frontier, entry)
+        return failed, frontier
+
+    async def test_ok_page_is_indexed(self):
+        failed, frontier = await self.process(200)
+
+        self.assertFalse(failed)
+        self.crawler.indexer.add.assert_called_once()
+        self.assertEqual(frontier.pending, {str(self.server.make_url("/200/next/"))})
+
+    async def test_not_found_is_dropped(self):
+        failed, frontier = await self.process(404)
+
+        self.assertFalse(failed)
+        self.crawler.indexer.add.assert_not_called()
+        self.assertEqual(frontier.pending, set())
+
+    async def test_throttled_is_retried(self):
+        failed, frontier = await self.process(429)
+
+        self.assertTrue(failed)
+        self.crawler.indexer.add.assert_not_called()
+        self.assertEqual(frontier.pending, set())
+
+    async def test_server_error_is_retried(self):
+        failed, _ = await self.process(503)
+
+        self.assertTrue(failed)
+        self.crawler.indexer.add.assert_not_called()
+
+    async def test_network_error_is_retryable(self):
+        url = str(self.server.make_url("/200/page"))
+        await self.server.close()
+
+        with self.assertRaises(FetchError) as raised:
+            await self.crawler.fetch(self.session, url)
+        self.assertTrue(raised.exception.retryable)
+
+
+class BulkIndexerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.redis = MagicMock()
+        self.pipe = self.redis.pipeline.return_value.__enter__.return_value
+        self.corpus_stats = MagicMock()
+        self.logger = MagicMock()
+        # a real client, for its serializer; only the bulk requests are stubbed
+        self.indexer = BulkIndexer(
+            self.redis, elasticsearch.Elasticsearch("http://localhost:9200"), self.corpus_stats, self.logger
+        )
+        self.first_response = self.bulk_response({"http://a.com/": 201, "http://b.com/": 429, "http://c.com/": 400})
+        for url in ["http://a.com/", "http://b.com/", "http://c.com/"]:
+            self.indexer.add(url, "<p>page</p>", ExtractedPage("page of %s" % url, "", []), "utf-8", 60)
+
+    @staticmethod
+    def bulk_response(statuses: Dict[str, int]) -> MagicMock:
+        items = [{"index": {"_id": url, "status": status}} for url, status in statuses.items()]
+        return MagicMock(body={"errors": True, "items": items})
+
+    def published_urls(self) -> List[str]:
+        return [url for (url, *_), _ in self.pipe.set.call_args_list]
+
+    def test_only_accepted_documents_are_published(self):
+        with patch.object(elasticsearch.Elasticsearch, "bulk") as mock_bulk:
+            mock_bulk.return_value = self.first_response
+            self.indexer.flush()
+
+        documents = self.corpus_stats.add_documents.call_args.args[0]
+        self.assertEqual([url for url, *_ in documents], ["http://a.com/"])
+        self.assertEqual(self.published_urls(), ["http://a.com/"])
+
+    def test_throttled_documents_are_retried_and_rejected_ones_dropped(self):
+        with patch.object(elasticsearch.Elasticsearch, "bulk") as mock_bulk:
+            mock_bulk.side_effect = [
+                self.first_response,
+                self.bulk_response({"http://b.com/": 201}),
+            ]
+            self.indexer.flush()
+            self.assertEqual([url for url, *_ in self.indexer.pending], ["http://b.com/"])
+            self.indexer.flush()
+
+        self.assertEqual(mock_bulk.call_count, 2)
+        self.assertEqual(self.indexer.pending, [])
+        self.assertEqual(self.published_urls(), ["http://a.com/", "http://b.com/"])
+        self.assertIn("http://c.com/", self.logger.error.call_args.args[0])
+
+
+class PageExtractorTestCase(unittest.TestCase):
+    def test_text_title_and_links_in_one_pass(self):
+        page = """
+            <html>
+            <head><title> Best   pizza </title><style>p { color: red; }</style></head>
+            <body>
+                <p>Pizza <b>in</b>\n town.</p>
+                <script>var tracking = "nothing to index";</script>
+                <a href="/menu">Menu</a> <a name="top">no href</a>
+                <a href="http://other.com/">Other</a>
+            </body>
+            </html>
+        """
+
+        extracted = extract(page)
+
+        self.assertEqual(extracted.title, "Best pizza")
+        self.assertEqual(extracted.text, "Pizza in town. Menu no href Other")
+        self.assertEqual(extracted.links, ["/menu", "http://other.com/"])
+
+
+class PageCacheTestCase(unittest.TestCase):
+    def test_compressed_round_trip(self):
+        page = "<html><body>%s</body></html>" % ("Café crème " * 100)
+        blob = compress_page(page)
+
+        self.assertLess(len(blob), len(page.encode()))
+        self.assertEqual(decompress_page(blob), page)
+
+    def test_reads_uncompressed_pages(self):
+        # pages cached before compression are plain UTF-8
+        redis_instance = MagicMock()
+        redis_instance.get.return_value = "<p>Café</p>".encode()
+
+        self.assertEqual(get_page(redis_instance, "http://a.com/"), "<p>Café</p>")
+        redis_instance.get.return_value = None
+        self.assertIsNone(get_page(redis_instance, "http://a.com/"))
+
+
+class CacheValidatorTestCase(unittest.TestCase):
+    def test_recrawls_from_an_invalidated_page(self):
+        redis_instance = MagicMock()
+        redis_instance.scan_iter.return_value = iter(["metadata:http://a.com/", "metadata:http://b.com/"])
+        validator = CacheValidator(redis_instance, MagicMock(), MagicMock(), MagicMock(), MagicMock())
+
+        stale = {"http://a.com/"}
+        with patch.object(validator, "is_cache_valid", side_effect=lambda url: url not in stale):
+            with patch("crawler.caching.Crawler") as mock_crawler:
+                validator.run()
+
+        self.assertEqual(mock_crawler.call_args.args[0], "http://a.com/")
+        mock_crawler.return_value.run.assert_called_once()
+        redis_instance.delete.assert_any_call("http://a.com/")
+
+    def test_nothing_to_recrawl_when_the_cache_is_valid(self):
+        redis_instance = MagicMock()
+        redis_instance.scan_iter.return_value = iter(["metadata:http://a.com/"])
+        validator = CacheValidator(redis_instance, MagicMock(), MagicMock(), MagicMock(), MagicMock())
+
+        with patch.object(validator, "is_cache_valid", return_value=True):
+            with patch("crawler.caching.Crawler") as mock_crawler:
+                validator.run()
+
+        mock_crawler.assert_not_called()
@@ -1,2 +1,4 @@
 #!/bin/bash
-cd search/ && python3 -m unittest test_api
+set -e
+(cd search/ && python3 -m unittest test_api test_crawler)
+(cd search-analytics/ && python3 -m unittest test_mlapi test_pipeline)